@@ -9,6 +9,7 @@ from astropy.io import fits
 from matplotlib import pyplot as plt
 from plico_dm_characterization.configuration import config
 from plico_dm_characterization.ground import zernike
+from plico_dm_characterization.ground import temp
 
 
 def linearity(tn):
@@ -36,7 +37,7 @@ def linearity(tn):
     cube = None
     for act in acts_list:
         hduList = fits.open(os.path.join(fold_for_meas, act))
-        cube_act = np.ma.masked_array(hduList[0].data, mask=hduList[1].data.astype(bool))
+        cube_act = np.ma.masked_array(hduList[0].data, mask=temp.maskFromHDU(hduList[1]))
         if cube is None:
             cube = cube_act
         else:
@@ -117,7 +118,7 @@ def closeLoop(tn_list):
     for tt in tn_list:
         path = os.path.join(config.FLAT_ROOT_FOLD, tt)
         hduList= fits.open(os.path.join(path, 'imgflat.fits'))
-        img = np.ma.masked_array(hduList[0].data, hduList[1].data.astype(bool))
+        img = np.ma.masked_array(hduList[0].data, temp.maskFromHDU(hduList[1]))
         imgflatList.append(img)
         
         hduList = fits.open(os.path.join(path, 'flatDeltaCommand.fits'))
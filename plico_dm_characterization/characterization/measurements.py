@@ -8,6 +8,7 @@ import time
 from astropy.io import fits
 import shutil
 from plico_dm_characterization.ground import zernike
+from plico_dm_characterization.ground import temp
 from plico_dm_characterization.ground.timestamp import Timestamp
 from plico_dm_characterization.influenceFunctionsMaker import IFMaker
 from plico_dm_characterization.ground.tracking_number_folder import TtFolder
@@ -51,9 +52,12 @@ class MeasurementAcquisition():
             command = converter.fromWfToDmCommand(ima_ttr)
         else:
             command = converter.fromWfToDmCommand(ima)
+        # the next flattenings with this mask load the reconstructor
+        converter.cacheReconstructor()
 
         fits.writeto(os.path.join(dove, 'imgstart.fits'), ima.data)
-        fits.append(os.path.join(dove, 'imgstart.fits'), ima.mask.astype(int))
+        temp.appendMask(os.path.join(dove, 'imgstart.fits'),
+                        np.ma.getmaskarray(ima))
         fits.writeto(os.path.join(dove, 'flatDeltaCommand.fits'), command)
 
         pos = self.dm.get_shape()
@@ -70,7 +74,8 @@ class MeasurementAcquisition():
         
         wf = self.interf.wavefront()
         fits.writeto(os.path.join(dove, 'imgflat.fits'), wf.data)
-        fits.append(os.path.join(dove, 'imgflat.fits'), wf.mask.astype(int))
+        temp.appendMask(os.path.join(dove, 'imgflat.fits'),
+                        np.ma.getmaskarray(wf))
 
         fits.writeto(os.path.join(dove, 'flatCommand.fits'), self._commandToApply)
         return tt
@@ -126,7 +131,7 @@ class MeasurementAcquisition():
             name = Timestamp.now() + '.fits'
             fits_file_name = os.path.join(dove, name)
             fits.writeto(fits_file_name, masked_ima.data)
-            fits.append(fits_file_name, masked_ima.mask.astype(int))
+            temp.appendMask(fits_file_name, np.ma.getmaskarray(masked_ima))
 
             coef, mat = zernike.zernikeFit(masked_ima, np.arange(10) + 1)
             vect = np.append(dt, coef)
@@ -183,8 +188,8 @@ class MeasurementAcquisition():
             cube = np.ma.dstack(ima_amp_list)
             fits.writeto(os.path.join(dove, 'act_%03d.fits' %actuator_to_test),
                          cube.data)
-            fits.append(os.path.join(dove, 'act_%03d.fits' %actuator_to_test),
-                         cube.mask.astype(int))
+            temp.appendMask(os.path.join(dove, 'act_%03d.fits' %actuator_to_test),
+                            np.ma.getmaskarray(cube))
         self.dm.set_shape(np.zeros(self.dm.get_number_of_actuators()))
         return tt
 
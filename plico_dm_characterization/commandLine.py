@@ -0,0 +1,106 @@
+'''
+Entry point of the plico_dm_characterization command
+
+HOW TO USE IT::
+
+    plico_dm_characterization reprocess 20241210_082811 20241211_101500 -j 8
+    plico_dm_characterization merge 20241210_082811 20241211_101500
+'''
+import argparse
+import logging
+from plico_dm_characterization import cubeReprocessing
+from plico_dm_characterization import cubeMerging
+
+
+def _reprocess(args):
+    file_names = cubeReprocessing.reprocessCubes(
+        args.tracking_numbers, repetitions=args.repetitions,
+        template=args.template, n_workers=args.workers, split=args.split,
+        cube_name=args.cube_name, storage_folder=args.storage_folder,
+        dtype=args.dtype, memory_budget=_megabytes(args.memory_budget))
+    for file_name in file_names:
+        print(file_name)
+
+
+def _merge(args):
+    weights = args.weights
+    if weights is not None and weights != 'inverse_variance':
+        weights = [float(w) for w in weights.split(',')]
+    print(cubeMerging.mergeCubes(args.tracking_numbers, weights=weights,
+                                 storage_folder=args.storage_folder,
+                                 dtype=args.dtype,
+                                 block_rows=args.block_rows))
+
+
+def _megabytes(value):
+    if value is None:
+        return None
+    return int(value * 2**20)
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='plico_dm_characterization',
+        description='Tools for the characterization of deformable mirrors')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    reprocess = subparsers.add_parser(
+        'reprocess', help='rebuild the cube of IFFunctions tracking numbers '
+                          'from their raw frames')
+    reprocess.add_argument('tracking_numbers', nargs='+',
+                           help='IFFunctions tracking numbers')
+    reprocess.add_argument('-j', '--workers', type=int, default=1,
+                           help='number of processes (default 1)')
+    reprocess.add_argument('--split', default='actuators',
+                           choices=['actuators', 'tracking_numbers'],
+                           help='spread actuators or whole tracking numbers '
+                                'across the processes (default actuators)')
+    reprocess.add_argument('--repetitions', type=int, nargs='+',
+                           help='repetitions to average (default all)')
+    reprocess.add_argument('--template', type=int, nargs='+',
+                           help='template used to combine the frames '
+                                '(default the acquisition template)')
+    reprocess.add_argument('--dtype', choices=['float32', 'float64'],
+                           help='float type of the cube '
+                                '(default the type of the existing cube)')
+    reprocess.add_argument('--memory-budget', type=float,
+                           help='memory in MB for building the cube in '
+                                'blocks written directly to disk '
+                                '(default the whole cube in memory)')
+    reprocess.add_argument('--cube-name', default='Cube.fits',
+                           help='name of the cube file (default Cube.fits)')
+    reprocess.add_argument('--storage-folder',
+                           help='root folder of the tracking numbers '
+                                '(default the configured IFFunctions folder)')
+    reprocess.set_defaults(function=_reprocess)
+
+    merge = subparsers.add_parser(
+        'merge', help='average the cubes of IFFunctions tracking numbers '
+                      'of the same mirror into a new tracking number')
+    merge.add_argument('tracking_numbers', nargs='+',
+                       help='IFFunctions tracking numbers')
+    merge.add_argument('--weights',
+                       help='comma separated weight of each cube or '
+                            'inverse_variance (default the number of '
+                            'repetitions)')
+    merge.add_argument('--dtype', choices=['float32', 'float64'],
+                       help='float type of the cube '
+                            '(default the type of the first cube)')
+    merge.add_argument('--block-rows', type=int,
+                       help='pixel rows read together from each cube '
+                            '(default the rows fitting 64 MB)')
+    merge.add_argument('--storage-folder',
+                       help='root folder of the tracking numbers '
+                            '(default the configured IFFunctions folder)')
+    merge.set_defaults(function=_merge)
+    return parser
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = _parser().parse_args(argv)
+    args.function(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,19 @@ Authors
 '''
 import numpy as np
 import os
+import itertools
+import collections
 from plico_dm_characterization.influenceFunctionsMaker import IFMaker
-from scipy.linalg import hadamard
+from plico_dm_characterization.type.modalBase import ModalBase
+from plico_dm_characterization.type.commandHistory import CmdHistory
+from plico_dm_characterization.type.commandMatrix import CommandMatrix, \
+    ZONAL, HADAMARD
 from plico_dm_characterization.ground import zernike
+from plico_dm_characterization.ground import geo
+from plico_dm_characterization.ground.pupil_index_map import \
+    PupilIndexMap, maskDigest
+from plico_dm_characterization.ground.reconstructor_cache import \
+    ReconstructorCache, DEFAULT_MAX_SIZE
 
 
 class Converter():
@@ -19,15 +29,60 @@ class Converter():
         cmd = cc.fromWfToDmCommand(wf)
     '''
 
-    def __init__(self, tt_an):
-        an = IFMaker.loadAnalyzerFromIFMaker(tt_an)
+    def __init__(self, tt_an, dtype=None, cache_size=DEFAULT_MAX_SIZE,
+                 n_masks=4):
+        '''
+        Parameters
+        ----------
+        tt_an: string
+            tracking number of the influence functions
+        dtype: numpy dtype, optional
+            float type of interaction matrix and reconstructor
+            (np.float32 or np.float64); if not indicated, the cube dtype
+        cache_size: int, optional
+            maximum bytes of the reconstructors saved in the tracking
+            number folder and reused by the next Converters;
+            0 or None to compute them every time. Only the
+            reconstructors of the masks set with setAnalysisMask are
+            saved automatically: those of the masks of the wavefronts
+            converted are read if found, saved only by cacheReconstructor
+        n_masks: int, optional
+            number of analysis masks whose interaction matrix and
+            reconstructor are kept in memory
+        '''
+        an = IFMaker.loadAnalyzerFromIFMaker(tt_an, lazy=True)
         self._cube = an.getCube()
+        if dtype is None:
+            dtype = an.getCubeDtype()
+        self._dtype = np.dtype(dtype)
         self._type = an._type_of_cmd_matrix
+        self._cmdMatrix = None
+        if self._type != ZONAL:
+            self._cmdMatrix = self._loadCommandMatrix(an._cmdMatrixTag,
+                                                      an._tt_cmdH)
         self._tn = tt_an
+        self._roi = an.getRoi()
+        self._recCache = None
+        # digests of the masks whose reconstructor is saved in the cache
+        self._persistentMasks = set()
+        # reconstructor loaded from or saved in the cache
+        self._cachedRec = None
+        if cache_size:
+            self._recCache = ReconstructorCache(an._folder, tt_an, cache_size)
         #analisi
+        self._masterMask = None
         self._analysisMask = None
+        self._pupilIndexMap = None
         self._intMat = None
+        self._svd = None
         self._rec = None
+        self._rCond = 1e-15
+        self._nModes = None
+        self._tikhonov = None
+        # digest of the mask -> (mask, index map, intMat, rec), LRU first;
+        # the SVD is kept only for the current mask
+        self._nMasks = max(int(n_masks), 1)
+        self._analyses = collections.OrderedDict()
 
 
     def fromWfToDmCommand(self, wf):
@@ -43,20 +98,99 @@ class Converter():
             command for deformable mirror
         '''
         #manca l'utilizzo delle coordinate
+        wf = self._cropToCube(wf)
         new_mask = np.ma.mask_or(wf.mask, self.getMasterMask())
-        self.setAnalysisMask(new_mask)
-        wf_masked = np.ma.masked_array(wf.data, mask=new_mask)
+        self._setAnalysisMask(new_mask, maskDigest(new_mask))
         rec = self.getReconstructor()
-        command = np.dot(rec, wf_masked.compressed())
-        if self._type == 'hadamard':
-            command = self._commandForHadamardMatrix(command)
-        return command
+        command = np.dot(rec, self._pupilIndexMap.compress(wf).astype(
+            self._dtype))
+        return self._modalToCommand(command)
+
+    def fromWfStackToDmCommands(self, wfs, batch_size=256):
+        '''
+        Converts many wavefronts: the wavefronts with the same mask are
+        converted together with one product by the reconstructor and the
+        modal commands of all the wavefronts are converted in actuator
+        commands at once
+
+        Parameters
+        ----------
+        wfs: numpy masked array [N, pixels, pixels] or iterable
+            wavefronts to convert, es. a stack or a generator reading
+            them from files
+        batch_size: int, optional
+            number of wavefronts read and grouped by mask together
+
+        Return
+        ------
+        cmds: numpy array [nActs, N]
+            command for deformable mirror of each wavefront
+        '''
+        frames = iter(wfs)
+        modal_commands = [np.zeros((self._cube.shape[2], 0),
+                                   dtype=self._dtype)]
+        while True:
+            batch = list(itertools.islice(frames, batch_size))
+            if not batch:
+                break
+            modal_commands.append(self._modalCommandsOfBatch(batch))
+        return self._modalToCommand(np.concatenate(modal_commands, axis=1))
+
+    def _modalCommandsOfBatch(self, batch):
+        groups = collections.OrderedDict()
+        for position, wf in enumerate(batch):
+            wf = self._cropToCube(wf)
+            batch[position] = wf
+            mask = np.ma.mask_or(np.ma.getmaskarray(wf),
+                                 self.getMasterMask())
+            digest = maskDigest(mask)
+            if digest not in groups:
+                groups[digest] = (mask, [])
+            groups[digest][1].append(position)
+        modal_commands = np.empty((self._cube.shape[2], len(batch)),
+                                  dtype=self._dtype)
+        for digest, (mask, positions) in groups.items():
+            self._setAnalysisMask(mask, digest)
+            wf_on_pupil = np.stack(
+                [self._pupilIndexMap.compress(batch[position])
+                 for position in positions], axis=1).astype(self._dtype)
+            modal_commands[:, positions] = np.dot(self.getReconstructor(),
+                                                  wf_on_pupil)
+        return modal_commands
 
-    def _commandForHadamardMatrix(self, zonal_command):
-        mat = hadamard(128)
-        hadaMat = mat[0:self._cube.shape[2], 0:self._cube.shape[2]]
-        command = np.matmul(hadaMat, zonal_command)
-        return command
+    def _cropToCube(self, image):
+        ''' Crops a full interferometer frame to the region of interest
+        of the cube, if the cube was stored cropped '''
+        if self._roi is None or np.shape(image)[:2] == self._cube.shape[:2]:
+            return image
+        return geo.cropToRoi(image, self._roi)
+
+    def _loadCommandMatrix(self, cmd_matrix_tag, tt_cmd_history):
+        ''' Command matrix of the modal base, or of the command history
+        of the acquisition if the modal base file is not available '''
+        try:
+            return ModalBase.loadFromFits(cmd_matrix_tag).getCommandMatrix()
+        except OSError as error:
+            missing_file = error.filename
+        if tt_cmd_history is not None:
+            try:
+                return CmdHistory.load(tt_cmd_history).getCommandMatrix()
+            except (OSError, KeyError):
+                pass
+        if self._type == HADAMARD:
+            # Hadamard of ModalBase.getHadamardMatrix
+            n_modes = self._cube.shape[2]
+            return CommandMatrix(ModalBase().getHadamardMatrix(n_modes))
+        raise OSError('Command matrix of type %s not found: missing modal '
+                      'base file %s and command history %s' % (
+                          self._type, missing_file, tt_cmd_history))
+
+    def _modalToCommand(self, modal_command):
+        ''' Command in actuator space from the modal coefficients,
+        using the structure of the command matrix '''
+        if self._cmdMatrix is None:
+            return modal_command
+        return self._cmdMatrix.dot(modal_command)
 
     def getCommandsForZernikeModeOnDM(self, n_modes, mask=None):
         '''
@@ -73,27 +207,23 @@ class Converter():
         ---------------
         mask: boolean numpy.ndarray
             mask for Zernike definition.
-            The mask must be the same size as the images/masks in the cube.
+            The mask must be the same size as the images/masks in the cube
+            or as the full interferometer frame if the cube is cropped.
         Returns
         -------
         zernike_command_matrix: numpy array [nActs, n_modes]
             matrix containing the Zernike mode for the mirror
         '''
+        if mask is not None:
+            mask = self._cropToCube(mask)
         zernike_cube = self._createZernikeOnDM(n_modes, mask)
         if mask is None:
             self.setAnalysisMaskFromMasterMask()
         else:
             self.setAnalysisMask(mask)
         rec = self.getReconstructor()
-
-        zernike_command_matrix_list = []
-        for i in range(zernike_cube.shape[2]):
-            comm = np.dot(rec, zernike_cube[:, :, i].compressed())
-            if self._type == 'hadamard':
-                comm = self._commandForHadamardMatrix(comm)
-            zernike_command_matrix_list.append(comm)
-        zernike_command_matrix = np.array(zernike_command_matrix_list)
-        return zernike_command_matrix.T
+        zernike_on_pupil = self._pupilIndexMap.compressCube(zernike_cube)
+        return self._modalToCommand(np.dot(rec, zernike_on_pupil))
 
     def _createZernikeOnDM(self, n_modes, mask=None):
         ima = self._cube[:, :, 0]
@@ -122,23 +252,49 @@ class Converter():
         Returns
         -------
         master_mask: [pixels, pixels]
-                    product of the masks of the cube
+                    union of the masks of the cube, computed once
         '''
-        aa = np.sum(self._cube.mask.astype(int), axis=2)
-        master_mask = np.zeros(aa.shape, dtype=np.bool_)
-        master_mask[np.where(aa > 0)] = True
-        return master_mask
+        if self._masterMask is None:
+            self._masterMask = np.any(self._cube.mask, axis=2)
+        return self._masterMask
 
     def setAnalysisMask(self, analysis_mask):
         ''' Set the analysis mask chosen
 
+        The interaction matrix and the reconstructor of the last n_masks
+        analysis masks are kept in memory, identified by the digest of
+        the mask: setting one of them again does not compute them again.
+
         Parameters
         ----------
         analysis_mask: numpy array [pixels, pixels]
+            mask of the size of the cube images or of the full
+            interferometer frame if the cube is cropped
         '''
-        self._intMat = None
-        self._rec = None
-        self._analysisMask = analysis_mask
+        analysis_mask = self._cropToCube(analysis_mask)
+        digest = maskDigest(analysis_mask)
+        self._persistentMasks.add(digest)
+        self._setAnalysisMask(analysis_mask, digest)
+
+    def _setAnalysisMask(self, analysis_mask, digest):
+        if self._pupilIndexMap is not None:
+            if self._pupilIndexMap.getDigest() == digest:
+                return
+            self._analyses[self._pupilIndexMap.getDigest()] = (
+                self._analysisMask, self._pupilIndexMap, self._intMat,
+                self._rec)
+        self._svd = None
+        if digest in self._analyses:
+            self._analysisMask, self._pupilIndexMap, self._intMat, \
+                self._rec = self._analyses.pop(digest)
+        else:
+            self._intMat = None
+            self._rec = None
+            self._analysisMask = analysis_mask
+            self._pupilIndexMap = PupilIndexMap(analysis_mask, digest)
+        # the current analysis is not in the dictionary
+        while len(self._analyses) >= self._nMasks:
+            self._analyses.popitem(last=False)
 
     def setAnalysisMaskFromMasterMask(self):
         ''' Set the analysis mask using the master mask of analysis cube
@@ -165,28 +321,136 @@ class Converter():
         '''
         return self._analysisMask
 
-    def _getMaskedInfluenceFunction(self, idx_influence_function):
-        return np.ma.array(self._cube[:, :, idx_influence_function],
-                           mask=self.getAnalysisMask())
+    def getPupilIndexMap(self):
+        '''
+        Returns
+        -------
+        index_map: PupilIndexMap
+            flat indexes of the valid pixels of the analysis mask
+        '''
+        return self._pupilIndexMap
 
     def _createInteractionMatrix(self):
         if self._analysisMask is None:
             self.setAnalysisMaskFromMasterMask()
-        n_acts_in_cube = self._cube.shape[2]
-        n_interferometer_pixels_in_mask = \
-                    self._getMaskedInfluenceFunction(0).compressed().shape[0]
-        self._intMat = np.zeros((n_interferometer_pixels_in_mask,
-                                 n_acts_in_cube))
-        for i in range(n_acts_in_cube):
-            self._intMat[:, i] = \
-                            self._getMaskedInfluenceFunction(i).compressed()
-
-    def _createSurfaceReconstructor(self, rCond=1e-15):
-        self._rec = self._createRecWithPseudoInverse(rCond)
+        # one gather of the valid pixels of all the influence functions
+        self._intMat = self._pupilIndexMap.compressCube(
+            self._cube.data).astype(self._dtype)
+
+    def _createSurfaceReconstructor(self):
+        if self._analysisMask is None:
+            self.setAnalysisMaskFromMasterMask()
+        if self._nModes is not None or self._tikhonov is not None:
+            self._rec = self.createReconstructor(self._rCond, self._nModes,
+                                                 self._tikhonov)
+            return
+        if self._recCache is None:
+            self._rec = self._createRecWithPseudoInverse(self._rCond)
+            return
+        digest = self._pupilIndexMap.getDigest()
+        self._rec = self._recCache.load(digest, self._rCond, self._dtype)
+        if self._rec is None:
+            self._rec = self._createRecWithPseudoInverse(self._rCond)
+            if digest in self._persistentMasks:
+                self._recCache.save(digest, self._rCond, self._dtype,
+                                    self._rec)
+                self._cachedRec = self._rec
+        else:
+            self._cachedRec = self._rec
+
+    def cacheReconstructor(self):
+        ''' Saves the reconstructor of the current analysis mask (es. the
+        mask of the last wavefront converted) in the cache of the tracking
+        number, so that the next Converters load it. Reconstructors with
+        n_modes or tikhonov regularization are not cached, and those
+        already in the cache are not written again.
+        '''
+        if self._recCache is None or self._nModes is not None or \
+                self._tikhonov is not None:
+            return
+        rec = self.getReconstructor()
+        if rec is self._cachedRec:
+            return
+        self._recCache.save(self._pupilIndexMap.getDigest(), self._rCond,
+                            self._dtype, rec)
+        self._cachedRec = rec
 
     def _createRecWithPseudoInverse(self, rCond):
+        if self._svd is not None:
+            return self.createReconstructor(rCond)
+        # no sweep: the factors are not kept
         return np.linalg.pinv(self.getInteractionMatrix(), rcond=rCond)
 
+    def _getSvd(self):
+        ''' Thin SVD of the interaction matrix, computed at the first
+        request and kept only until the analysis mask changes '''
+        if self._svd is None:
+            self._svd = np.linalg.svd(self.getInteractionMatrix(),
+                                      full_matrices=False)
+        return self._svd
+
+    def getSingularValues(self):
+        '''
+        Returns
+        -------
+        singular_values: numpy array [nActs]
+            singular values of the interaction matrix, in decreasing order
+        '''
+        return self._getSvd()[1]
+
+    def createReconstructor(self, rcond=1e-15, n_modes=None, tikhonov=None):
+        '''
+        Reconstructor of the analysis mask built from the SVD of the
+        interaction matrix, computed at the first call and kept for the
+        current analysis mask only: a sweep of the regularization does not
+        compute the SVD again. The default reconstructor (getReconstructor)
+        does not keep the SVD.
+
+        Parameters
+        ----------
+        rcond: float, optional
+            singular values smaller than rcond times the largest one are
+            discarded, as in numpy.linalg.pinv
+        n_modes: int, optional
+            number of modes to keep, those of the largest singular values
+        tikhonov: float, optional
+            Tikhonov regularization alpha: the singular values s are
+            inverted as s / (s**2 + alpha**2) instead of being discarded
+            by rcond
+
+        Returns
+        -------
+        rec: numpy array [nActs, pixels]
+            reconstructor
+        '''
+        u, s, vt = self._getSvd()
+        inverse = np.zeros_like(s)
+        if tikhonov is None:
+            keep = s > rcond * np.max(s, initial=0)
+            inverse[keep] = 1 / s[keep]
+        else:
+            inverse = s / (s**2 + tikhonov**2)
+        if n_modes is not None:
+            inverse[n_modes:] = 0
+        used = np.flatnonzero(inverse)
+        return np.dot(vt[used].T * inverse[used], u[:, used].T)
+
+    def setRegularization(self, rcond=1e-15, n_modes=None, tikhonov=None):
+        ''' Set the regularization of the reconstructor used by
+        fromWfToDmCommand and getReconstructor
+
+        Parameters
+        ----------
+        rcond, n_modes, tikhonov:
+            same of createReconstructor
+        '''
+        self._rCond = rcond
+        self._nModes = n_modes
+        self._tikhonov = tikhonov
+        self._rec = None
+        for digest, analysis in self._analyses.items():
+            self._analyses[digest] = analysis[:3] + (None,)
+
     def getInteractionMatrix(self):
         '''
         Returns
@@ -203,7 +467,8 @@ class Converter():
         Returns
         -------
         rec = numpy array
-            reconstructor calculated as pseudo inverse of the interaction matrix
+            reconstructor calculated as pseudo inverse of the interaction
+            matrix, with the regularization of setRegularization
         '''
         if self._rec is None:
             self._createSurfaceReconstructor()
@@ -0,0 +1,756 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+def templateWeights(template):
+    '''
+    Weight of each frame of a template sequence in the push-pull
+    combination used for the influence functions
+
+    The frames of a template are combined two by two
+    (image[p] * template[p] + image[p-1] * template[p-1]), so every
+    frame except the first and the last one is used twice.
+
+    Parameters
+    ----------
+    template: numpy array
+        vector composed by 1 and -1 (es. np.array([1, -1, 1]))
+
+    Returns
+    -------
+    weights: numpy array [template.size]
+        weight of each frame
+    '''
+    template = np.asarray(template)
+    if template.size < 2:
+        raise ValueError('Template must have at least two elements')
+    multiplicity = np.full(template.size, 2)
+    multiplicity[0] = 1
+    multiplicity[-1] = 1
+    return template * multiplicity
+
+
+def modeSequence(indexing_list):
+    '''
+    Parameters
+    ----------
+    indexing_list: numpy array [n_passes, nModes]
+        order in which the modes were applied in each pass; passes
+        measuring only some modes are padded with -1
+
+    Returns
+    -------
+    mode_sequence: numpy array
+        mode of each template sequence in order of acquisition
+    '''
+    sequence = np.ravel(indexing_list).astype(int)
+    return sequence[sequence >= 0]
+
+
+def repetitionCounts(indexing_list, n_modes=None):
+    '''
+    Parameters
+    ----------
+    indexing_list: numpy array [n_passes, nModes]
+        order in which the modes were applied in each pass
+        (padded with -1)
+    n_modes: int, optional
+        number of modes; if not indicated, the largest mode + 1
+
+    Returns
+    -------
+    counts: numpy array [n_modes]
+        number of repetitions of each mode
+    '''
+    return np.bincount(modeSequence(indexing_list), minlength=n_modes or 0)
+
+
+def frameIndexes(indexing_list, n_template, acts_vector=None):
+    '''
+    Index of the frames measured for each mode and repetition
+
+    Parameters
+    ----------
+    indexing_list: numpy array [n_passes, nModes]
+        order in which the modes were applied in each pass; passes
+        measuring only some modes (adaptive acquisitions) are padded
+        with -1
+    n_template: int
+        number of frames of the template sequence
+    acts_vector: numpy array, optional
+        modes in the order of the cube slices
+        if not indicated, np.arange(nModes)
+
+    Returns
+    -------
+    frame_indexes: numpy array [nActs, n_rep, n_template]
+        index of the frames of each template sequence, n_rep being the
+        largest number of repetitions; -1 for the repetitions a mode
+        does not have
+    '''
+    indexing_list = np.atleast_2d(indexing_list)
+    sequence = modeSequence(indexing_list)
+    if acts_vector is None:
+        acts_vector = np.arange(indexing_list.shape[1])
+    acts_vector = np.asarray(acts_vector)
+    n_ids = max(sequence.max(), acts_vector.max()) + 1
+    counts = np.bincount(sequence, minlength=n_ids)
+    if np.any(counts[acts_vector] == 0):
+        raise ValueError('Some modes of acts_vector were not measured')
+    order = np.argsort(sequence, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    repetition = np.arange(sequence.size) - starts[sequence[order]]
+    column = np.full((n_ids, counts.max()), -1)
+    column[sequence[order], repetition] = order
+    column = column[acts_vector]
+    frames = column[:, :, np.newaxis] * n_template + np.arange(n_template)
+    frames[column < 0] = -1
+    return frames
+
+
+def welfordUpdate(mean, m2, count, value, valid):
+    '''
+    Adds value to the running mean and sum of squared deviations of the
+    pixels where valid is True (Welford algorithm). The arrays are
+    updated in place.
+
+    Parameters
+    ----------
+    mean: numpy array
+        running mean
+    m2: numpy array
+        running sum of the squared deviations from the mean
+    count: numpy array
+        number of values accumulated in each pixel
+    value: numpy array
+        new value
+    valid: numpy array
+        boolean, True where value has to be accumulated
+    '''
+    count += valid
+    delta = np.where(valid, value - mean, 0)
+    np.add(mean, np.divide(delta, count, where=valid,
+                           out=np.zeros_like(mean)), out=mean)
+    m2 += delta * np.where(valid, value - mean, 0)
+
+
+def welfordVariance(m2, count, dtype=np.float64):
+    '''
+    Parameters
+    ----------
+    m2: numpy array
+        sum of the squared deviations from the mean
+    count: numpy array
+        number of values accumulated in each pixel
+
+    Returns
+    -------
+    variance: numpy masked array
+        sample variance, masked where less than two values were
+        accumulated
+    '''
+    variance = np.zeros(m2.shape, dtype=dtype)
+    valid = count >= 2
+    np.divide(m2, count.astype(dtype) - 1, out=variance, where=valid)
+    return np.ma.masked_array(variance, mask=~valid)
+
+
+def _normalizedInfluenceFunction(image, mask, amplitude, n_template):
+    image = np.ma.masked_array(image, mask=mask)
+    img_if = image / image.dtype.type(2 * amplitude * (n_template - 1))
+    return img_if - np.ma.median(img_if)
+
+
+class CubeEngine():
+    '''
+    Vectorized reconstruction of the influence functions cube from the
+    frames of a push-pull acquisition
+
+    The output cube is preallocated, the frames of each mode are found
+    with a single inverse permutation of the indexing list, the
+    template frames are combined with one weighted tensordot and the
+    repetitions are averaged in place with a masked Welford update,
+    which also gives the per-pixel variance between the repetitions.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.cubeBuilder import CubeEngine
+        engine = CubeEngine(indexing_list, amplitude, template)
+        cube = engine.buildCube(read_frame)
+        cube, variance = engine.buildCube(read_frame, with_variance=True)
+    '''
+
+    def __init__(self, indexing_list, amplitude, template, acts_vector=None,
+                 repetitions=None, dtype=np.float64):
+        """The constructor
+
+        Parameters
+        ----------
+        indexing_list: numpy array [n_rep, nModes]
+            order in which the modes were applied in each repetition
+        amplitude: numpy array [nActs]
+            amplitude of each mode
+        template: numpy array
+            vector composed by 1 and -1
+        acts_vector: numpy array, optional
+            modes in the order of the cube slices
+            if not indicated, np.arange(amplitude.size)
+        repetitions: numpy array, optional
+            repetitions to average; if not indicated, all of them
+        dtype: numpy dtype, optional
+            float type used for the computation and the cube
+        """
+        self._dtype = np.dtype(dtype)
+        self._template = np.asarray(template)
+        self._weights = templateWeights(self._template).astype(self._dtype)
+        self._amplitude = np.asarray(amplitude)
+        if acts_vector is None:
+            acts_vector = np.arange(self._amplitude.shape[0])
+        self._actsVector = np.asarray(acts_vector)
+        self._frameIndexes = frameIndexes(indexing_list, self._template.size,
+                                          self._actsVector)
+        if repetitions is not None:
+            self._frameIndexes = self._frameIndexes[:, np.asarray(repetitions)]
+
+    def getFrameIndexes(self):
+        '''
+        Returns
+        -------
+        frame_indexes: numpy array [nActs, n_rep, n_template]
+            index of the frames of each template sequence
+        '''
+        return self._frameIndexes
+
+    def buildCube(self, read_frame, slots=None, with_variance=False):
+        '''
+        Parameters
+        ----------
+        read_frame: function
+            function called as read_frame(index) returning the masked
+            frame of that index
+        slots: numpy array, optional
+            cube slices to build; if not indicated, all of them
+        with_variance: boolean, optional
+            if True the variance between the repetitions is returned too
+
+        Returns
+        -------
+        cube: masked array [pixels, pixels, len(slots)]
+            influence functions averaged over the repetitions
+        variance: masked array [pixels, pixels, len(slots)]
+            per-pixel variance of the repetitions, masked where less
+            than two repetitions are valid (only if with_variance)
+        '''
+        return self._toCube(self._accumulate(read_frame, slots),
+                            with_variance)
+
+    def _toCube(self, accumulators, with_variance):
+        data, count, m2 = accumulators
+        cube = np.ma.masked_array(data, mask=count == 0)
+        if with_variance:
+            return cube, welfordVariance(m2, count, self._dtype)
+        return cube
+
+    def _firstFrameIndex(self, slots):
+        measured = self._frameIndexes[slots][self._frameIndexes[slots] >= 0]
+        if measured.size == 0:
+            raise ValueError('No frames measured for the requested '
+                             'repetitions')
+        return measured[0]
+
+    def readFrameShape(self, read_frame):
+        '''
+        Parameters
+        ----------
+        read_frame: function
+            function called as read_frame(index) returning the masked
+            frame of that index
+
+        Returns
+        -------
+        shape: tuple
+            shape of the frames
+        '''
+        slots = np.arange(self._actsVector.size)
+        return read_frame(self._firstFrameIndex(slots)).shape
+
+    def getBlockSize(self, frame_shape, memory_budget):
+        '''
+        Parameters
+        ----------
+        frame_shape: tuple
+            shape of the frames
+        memory_budget: int
+            bytes available to build a block of cube slices
+
+        Returns
+        -------
+        block_size: int
+            number of cube slices built together (at least 1)
+        '''
+        n_pixels = int(np.prod(frame_shape))
+        itemsize = self._dtype.itemsize
+        frames_size = n_pixels * self._frameIndexes.shape[2] * (itemsize + 1)
+        # mean, m2 and count accumulators, output mask and variance
+        slot_size = n_pixels * (3 * itemsize + 2 + 1)
+        return max(1, int((memory_budget - frames_size) // slot_size))
+
+    def _accumulate(self, read_frame, slots):
+        if slots is None:
+            slots = np.arange(self._actsVector.size)
+        n_rep, n_template = self._frameIndexes.shape[1:]
+        first_index = self._firstFrameIndex(slots)
+        first_frame = read_frame(first_index)
+        shape = first_frame.shape
+        frames = np.zeros((n_template,) + shape, dtype=self._dtype)
+        masks = np.zeros((n_template,) + shape, dtype=bool)
+        data = np.zeros(shape + (len(slots),), dtype=self._dtype)
+        m2 = np.zeros(shape + (len(slots),), dtype=self._dtype)
+        count = np.zeros(shape + (len(slots),), dtype=np.uint16)
+        for j, slot in enumerate(slots):
+            mode = self._actsVector[slot]
+            for k in range(n_rep):
+                if self._frameIndexes[slot, k, 0] < 0:
+                    continue
+                for p, index in enumerate(self._frameIndexes[slot, k]):
+                    if index == first_index:
+                        frame = first_frame
+                    else:
+                        frame = read_frame(index)
+                    frames[p] = np.ma.getdata(frame)
+                    masks[p] = np.ma.getmaskarray(frame)
+                sequence_mask = np.any(masks, axis=0)
+                img_if = _normalizedInfluenceFunction(
+                    np.tensordot(self._weights, frames, axes=1),
+                    sequence_mask, self._amplitude[mode], n_template)
+                welfordUpdate(data[:, :, j], m2[:, :, j], count[:, :, j],
+                              img_if.filled(0), ~sequence_mask)
+        return data, count, m2
+
+    def buildCubeInParallel(self, read_frame, n_workers,
+                            with_variance=False):
+        '''
+        Builds the cube spreading blocks of actuators on a process pool
+
+        Parameters
+        ----------
+        read_frame: function
+            picklable function called as read_frame(index) returning the
+            masked frame of that index
+        n_workers: int
+            number of processes
+        with_variance: boolean, optional
+            if True the variance between the repetitions is returned too
+
+        Returns
+        -------
+        cube: masked array [pixels, pixels, nActs]
+            influence functions averaged over the repetitions
+        variance: masked array [pixels, pixels, nActs]
+            per-pixel variance of the repetitions (only if with_variance)
+        '''
+        n_slots = self._actsVector.size
+        if n_workers <= 1 or n_slots < 2:
+            return self.buildCube(read_frame, with_variance=with_variance)
+        blocks = [block for block in
+                  np.array_split(np.arange(n_slots), min(n_workers, n_slots))]
+        data = None
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(self._accumulate, read_frame, block)
+                       for block in blocks]
+            for block, future in zip(blocks, futures):
+                part_data, part_count, part_m2 = future.result()
+                if data is None:
+                    data = np.zeros(part_data.shape[:2] + (n_slots,),
+                                    dtype=self._dtype)
+                    m2 = np.zeros(data.shape, dtype=self._dtype)
+                    count = np.zeros(data.shape, dtype=np.uint16)
+                data[:, :, block] = part_data
+                m2[:, :, block] = part_m2
+                count[:, :, block] = part_count
+        cube = np.ma.masked_array(data, mask=count == 0)
+        if with_variance:
+            return cube, welfordVariance(m2, count, self._dtype)
+        return cube
+
+
+    def buildCubeOnDisk(self, read_frame, write_block, memory_budget,
+                        n_workers=1, with_variance=False):
+        '''
+        Builds the cube in blocks of actuators sized to memory_budget,
+        passing each block to write_block as soon as it is ready, so that
+        the whole cube is never in memory
+
+        The blocks are over actuators, and not over pixel rows, because
+        the frames of an actuator belong to it only: each frame is read
+        once whatever the number of blocks. In the [pixels, pixels, nActs]
+        layout a block of actuators is not contiguous, so write_block
+        should store it in an actuator-major target, as
+        FitsCubeFile.writeBlock does.
+
+        Parameters
+        ----------
+        read_frame: function
+            picklable function called as read_frame(index) returning the
+            masked frame of that index
+        write_block: function
+            function called as write_block(slots, cube, variance) with
+            the influence functions (and variance, None if not
+            with_variance) of the cube slices in slots
+        memory_budget: int
+            bytes available for the blocks being built, shared among the
+            workers
+        n_workers: int, optional
+            number of processes
+        with_variance: boolean, optional
+            if True the variance between the repetitions is computed too
+        '''
+        n_slots = self._actsVector.size
+        n_workers = max(n_workers, 1)
+        block_size = self.getBlockSize(self.readFrameShape(read_frame),
+                                       memory_budget / n_workers)
+        blocks = [np.arange(start, min(start + block_size, n_slots))
+                  for start in range(0, n_slots, block_size)]
+
+        def write(block, accumulators):
+            if with_variance:
+                cube, variance = self._toCube(accumulators, True)
+            else:
+                cube, variance = self._toCube(accumulators, False), None
+            write_block(block, cube, variance)
+
+        if n_workers == 1 or len(blocks) == 1:
+            for block in blocks:
+                write(block, self._accumulate(read_frame, block))
+            return
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for start in range(0, len(blocks), n_workers):
+                group = blocks[start:start + n_workers]
+                futures = [pool.submit(self._accumulate, read_frame, block)
+                           for block in group]
+                for block, future in zip(group, futures):
+                    write(block, future.result())
+
+
+class DriftCorrector():
+    '''
+    Callable reading the frames of an acquisition with interleaved
+    reference frames and subtracting from each of them the drift
+    estimated from the references
+
+    A reference (frame at the DM baseline) is measured before the first
+    template sequence, after every reference_every template sequences
+    and at the end of the acquisition, so that each block of frames is
+    bracketed by two references. With the 'linear' model the drift of
+    a frame is interpolated between the two references of its block at
+    the time (frame count, references included) it was measured.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.cubeBuilder import DriftCorrector
+        read_frame = DriftCorrector(read_frame, read_reference, n_template,
+                                    reference_every, n_frames)
+        cube = engine.buildCube(read_frame)
+    '''
+
+    #: available drift models
+    MODELS = ('linear',)
+
+    def __init__(self, read_frame, read_reference, n_template,
+                 reference_every, n_frames, model='linear', cache_size=4):
+        """The constructor
+
+        Parameters
+        ----------
+        read_frame: callable
+            read_frame(index) returns the masked frame of index
+        read_reference: callable
+            read_reference(index) returns the masked reference of index
+        n_template: int
+            number of frames of a template sequence
+        reference_every: int
+            number of template sequences between two references
+        n_frames: int
+            number of frames of the acquisition
+        model: string, optional
+            drift model
+        cache_size: int, optional
+            number of references kept in memory
+        """
+        if model not in self.MODELS:
+            raise ValueError('Unknown drift model %s' % model)
+        self._readFrame = read_frame
+        self._readReference = read_reference
+        self._period = int(reference_every) * int(n_template)
+        self._nFrames = n_frames
+        self._model = model
+        self._cacheSize = cache_size
+        self._cache = OrderedDict()
+
+    def _reference(self, index):
+        if index in self._cache:
+            self._cache.move_to_end(index)
+        else:
+            self._cache[index] = self._readReference(index)
+            if len(self._cache) > self._cacheSize:
+                self._cache.popitem(last=False)
+        return self._cache[index]
+
+    def driftWeight(self, index):
+        '''
+        Parameters
+        ----------
+        index: int
+            index of the frame
+
+        Returns
+        -------
+        block: int
+            index of the reference preceding the frame
+        weight: float
+            weight of the following reference in the drift of the frame
+        '''
+        block = index // self._period
+        t_a = block * self._period + block
+        t_b = min((block + 1) * self._period, self._nFrames) + block + 1
+        return block, (index + block + 1 - t_a) / (t_b - t_a)
+
+    def __call__(self, index):
+        frame = self._readFrame(index)
+        block, weight = self.driftWeight(index)
+        before = self._reference(block)
+        after = self._reference(block + 1)
+        drift = (1 - weight) * np.ma.getdata(before) + \
+            weight * np.ma.getdata(after)
+        mask = np.ma.getmaskarray(frame) | np.ma.getmaskarray(before) | \
+            np.ma.getmaskarray(after)
+        return np.ma.masked_array(np.ma.getdata(frame) - drift, mask=mask)
+
+    def close(self):
+        self._cache.clear()
+        for reader in (self._readFrame, self._readReference):
+            if hasattr(reader, 'close'):
+                reader.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = OrderedDict()
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class StreamingReducer():
+    '''
+    Reduction of the push-pull frames into the influence functions
+    cube while the frames are acquired
+
+    Every frame is added with its template weight to the accumulator of
+    its mode; when the last frame of a template sequence arrives the
+    influence function is normalized and added to the running (Welford)
+    mean and variance of the repetitions of its actuator. The cube is
+    ready when the last frame lands.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.cubeBuilder import StreamingReducer
+        reducer = StreamingReducer(indexing_list, amplitude, template)
+        for i in range(n_frames):
+            reducer.addFrame(i, interf.wavefront())
+        cube = reducer.getCube()
+    '''
+
+    def __init__(self, indexing_list, amplitude, template, acts_vector=None,
+                 dtype=np.float64):
+        """The constructor
+
+        Parameters
+        ----------
+        indexing_list: numpy array [n_rep, nModes]
+            order in which the modes were applied in each repetition
+        amplitude: numpy array [nActs]
+            amplitude of each mode
+        template: numpy array
+            vector composed by 1 and -1
+        acts_vector: numpy array, optional
+            modes in the order of the cube slices
+            if not indicated, np.arange(amplitude.size)
+        dtype: numpy dtype, optional
+            float type used for the accumulation and the cube
+        """
+        self._dtype = np.dtype(dtype)
+        self._template = np.asarray(template)
+        self._weights = templateWeights(self._template).astype(self._dtype)
+        self._amplitude = np.asarray(amplitude)
+        self._modeSequence = modeSequence(indexing_list)
+        if acts_vector is None:
+            acts_vector = np.arange(self._amplitude.shape[0])
+        self._actsVector = np.asarray(acts_vector)
+        self._slot = np.full(max(self._modeSequence.max(),
+                                 self._actsVector.max(),
+                                 self._amplitude.shape[0] - 1) + 1, -1)
+        self._slot[self._actsVector] = np.arange(self._actsVector.size)
+        self._nFrames = self._modeSequence.size * self._template.size
+        self._nExpectedSequences = np.count_nonzero(
+            self._slot[self._modeSequence] >= 0)
+        self._openSequences = {}
+        self._nReducedSequences = 0
+        self._nRepetitions = np.zeros(self._actsVector.size, dtype=int)
+        self._mean = None
+        self._m2 = None
+        self._count = None
+
+    def appendModes(self, mode_sequence):
+        '''
+        Extends the acquisition with new template sequences, whose
+        frames follow the ones already expected
+
+        Parameters
+        ----------
+        mode_sequence: numpy array
+            modes of the new template sequences in order of acquisition
+        '''
+        mode_sequence = np.asarray(mode_sequence, dtype=int)
+        self._modeSequence = np.concatenate((self._modeSequence,
+                                             mode_sequence))
+        self._nFrames = self._modeSequence.size * self._template.size
+        self._nExpectedSequences += np.count_nonzero(
+            self._slot[mode_sequence] >= 0)
+
+    def getNumberOfFrames(self):
+        '''
+        Returns
+        -------
+        n_frames: int
+            number of frames expected in the acquisition
+        '''
+        return self._nFrames
+
+    def addFrame(self, index, masked_image):
+        '''
+        Parameters
+        ----------
+        index: int
+            frame index in the command history
+        masked_image: numpy masked array
+            frame measured applying the command of index
+        '''
+        if index < 0 or index >= self._nFrames:
+            raise IndexError('Frame %d out of range (%d frames)'
+                             % (index, self._nFrames))
+        column, position = divmod(index, self._template.size)
+        if self._mean is None:
+            self._allocate(masked_image.shape)
+        data = np.ma.getdata(masked_image)
+        mask = np.ma.getmaskarray(masked_image)
+        if column not in self._openSequences:
+            self._openSequences[column] = [np.zeros(data.shape,
+                                                    dtype=self._dtype),
+                                           np.zeros(data.shape, dtype=bool),
+                                           0]
+        sequence = self._openSequences[column]
+        sequence[0] += data * self._weights[position]
+        sequence[1] |= mask
+        sequence[2] += 1
+        if sequence[2] == self._template.size:
+            del self._openSequences[column]
+            self._reduceSequence(column, sequence[0], sequence[1])
+
+    def _allocate(self, frame_shape):
+        shape = (frame_shape[0], frame_shape[1], self._actsVector.size)
+        self._mean = np.zeros(shape, dtype=self._dtype)
+        self._m2 = np.zeros(shape, dtype=self._dtype)
+        self._count = np.zeros(shape, dtype=np.uint16)
+
+    def _reduceSequence(self, column, image, mask):
+        mode = self._modeSequence[column]
+        slot = self._slot[mode]
+        if slot < 0:
+            return
+        img_if = _normalizedInfluenceFunction(image, mask,
+                                              self._amplitude[mode],
+                                              self._template.size)
+        welfordUpdate(self._mean[:, :, slot], self._m2[:, :, slot],
+                      self._count[:, :, slot], img_if.filled(0), ~mask)
+        self._nRepetitions[slot] += 1
+        self._nReducedSequences += 1
+
+    def getRepetitionCounts(self):
+        '''
+        Returns
+        -------
+        counts: numpy array [nActs]
+            number of template sequences reduced for each cube slice
+        '''
+        return self._nRepetitions.copy()
+
+    def getSnr(self):
+        '''
+        Signal to noise ratio of each influence function: rms of the
+        average over the repetitions divided by the rms of its standard
+        error, estimated from the scatter between the repetitions
+
+        Returns
+        -------
+        snr: numpy array [nActs]
+            signal to noise ratio of each cube slice; 0 where less than
+            two repetitions are available
+        '''
+        snr = np.zeros(self._actsVector.size)
+        if self._mean is None:
+            return snr
+        variance = welfordVariance(self._m2, self._count, self._dtype)
+        valid = ~variance.mask
+        error_sq = np.divide(variance.data, self._count, where=valid,
+                             out=np.zeros_like(self._mean))
+        measured = np.any(valid, axis=(0, 1))
+        mean = np.where(valid, self._mean, 0)
+        signal = np.sum(mean * mean, axis=(0, 1))
+        noise = np.sum(error_sq, axis=(0, 1))
+        snr[measured] = np.sqrt(np.divide(
+            signal[measured], noise[measured],
+            out=np.full(np.count_nonzero(measured), np.inf),
+            where=noise[measured] > 0))
+        return snr
+
+    def isComplete(self):
+        '''
+        Returns
+        -------
+        complete: boolean
+            True if all the frames of the acquisition have been reduced
+        '''
+        return self._nReducedSequences == self._nExpectedSequences
+
+    def getCube(self):
+        '''
+        Returns
+        -------
+        cube: masked array [pixels, pixels, nActs]
+            influence functions cube averaged over the repetitions
+        '''
+        if not self.isComplete():
+            raise ValueError('Acquisition not complete: %d of %d template '
+                             'sequences reduced' % (self._nReducedSequences,
+                                                    self._nExpectedSequences))
+        return np.ma.masked_array(self._mean.copy(), mask=self._count == 0)
+
+    def getVariance(self):
+        '''
+        Returns
+        -------
+        variance: masked array [pixels, pixels, nActs]
+            per-pixel variance of the repetitions, masked where less
+            than two repetitions are valid
+        '''
+        if not self.isComplete():
+            raise ValueError('Acquisition not complete: %d of %d template '
+                             'sequences reduced' % (self._nReducedSequences,
+                                                    self._nExpectedSequences))
+        return welfordVariance(self._m2, self._count, self._dtype)
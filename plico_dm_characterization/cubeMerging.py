@@ -0,0 +1,152 @@
+import os
+import logging
+import numpy as np
+from plico_dm_characterization.influenceFunctionsMaker import IFMaker
+from plico_dm_characterization.ground.lazy_cube import LazyCube
+from plico_dm_characterization.ground.cube_file import FitsCubeFile, \
+    DEFAULT_BAND_BYTES
+from plico_dm_characterization.ground.tracking_number_folder import TtFolder
+
+#: header keywords that must be equal in the cubes to merge
+COMPATIBILITY_KEYWORDS = ('NACTS', 'TYPECMD', 'CMDMTAG')
+
+
+def _checkCompatibility(infos, cubes):
+    first = cubes[0].header
+    for info, cube in zip(infos[1:], cubes[1:]):
+        for key in COMPATIBILITY_KEYWORDS:
+            if cube.header[key] != first[key]:
+                raise ValueError('%s of %s is %s, %s in %s' % (
+                    key, info._tt, cube.header[key], first[key], infos[0]._tt))
+        if cube.shape != cubes[0].shape:
+            raise ValueError('Cube %s has shape %s, %s in %s' % (
+                info._tt, cube.shape, cubes[0].shape, infos[0]._tt))
+        if info.getRoi() != infos[0].getRoi():
+            raise ValueError('Cube %s has ROI %s, %s in %s' % (
+                info._tt, info.getRoi(), infos[0].getRoi(), infos[0]._tt))
+        if not np.array_equal(info._actsVector, infos[0]._actsVector):
+            raise ValueError('Cube %s has different modes than %s'
+                             % (info._tt, infos[0]._tt))
+
+
+def _weightsOfRows(tt_list, cubes, weights, rows, dtype):
+    '''
+    Weight of each pixel of each cube in the band of rows, 0 where masked
+    '''
+    band_weights = []
+    for i, cube in enumerate(cubes):
+        mask = np.array(cube.mask[rows])
+        if isinstance(weights, str):
+            variance = cube.getVariance(rows=rows)
+            if variance is None:
+                raise ValueError('Cube %s has no variance' % tt_list[i])
+            weight = np.zeros(mask.shape, dtype=dtype)
+            valid = ~np.ma.getmaskarray(variance) & (variance.data > 0)
+            np.divide(1, variance.data, out=weight, where=valid)
+            mask = mask | ~valid
+        else:
+            weight = np.full(mask.shape, weights[i], dtype=dtype)
+        weight[mask] = 0
+        band_weights.append(weight)
+    return band_weights
+
+
+def mergeCubes(tt_list, weights=None, storage_folder=None, dtype=None,
+               block_rows=None):
+    '''
+    Merges the influence functions cubes of many tracking numbers of the
+    same mirror into their weighted mean, pixel by pixel on the valid
+    pixels. The cubes are memory-mapped and read a band of pixel rows at
+    a time, which is contiguous in the [pixels, pixels, nActs] layout, so
+    that each cube is read once and the memory used does not depend on
+    the size of the cubes.
+
+    Parameters
+    ----------
+    tt_list: list
+        tracking numbers of the influence functions to merge
+    weights: list or string, optional
+        weight of each cube, or 'inverse_variance' to weight each pixel
+        with the inverse of its variance between the repetitions.
+        If not indicated, the number of repetitions of each cube.
+    storage_folder: string, optional
+        root folder of the tracking numbers
+    dtype: numpy dtype, optional
+        float type of the merged cube; if not indicated, the type of
+        the first cube
+    block_rows: int, optional
+        number of pixel rows read together from each cube; if not
+        indicated, the rows of all the cubes fitting DEFAULT_BAND_BYTES
+
+    Returns
+    -------
+    tt: string
+        tracking number of the merged cube, whose header lists the
+        merged tracking numbers (MERGED) and the weighting (MERGEWGT)
+    '''
+    logger = logging.getLogger('CUBE_MERGING:')
+    if len(tt_list) < 2:
+        raise ValueError('At least two cubes are needed to merge')
+    infos = [IFMaker.loadInfoFromIFMaker(tt, storage_folder) for tt in tt_list]
+    cubes = [LazyCube(os.path.join(info._folder, 'Cube.fits'))
+             for info in infos]
+    try:
+        _checkCompatibility(infos, cubes)
+        if weights is None:
+            weights = [info._nRepetitions for info in infos]
+            weights_name = 'nrep'
+        elif isinstance(weights, str):
+            if weights != 'inverse_variance':
+                raise ValueError('Unknown weights %s' % weights)
+            weights_name = weights
+        else:
+            weights = np.asarray(weights, dtype=float)
+            if weights.shape != (len(tt_list),) or np.any(weights < 0):
+                raise ValueError('Weights %s must be %d non negative values'
+                                 % (weights, len(tt_list)))
+            weights_name = ','.join(str(w) for w in weights)
+
+        merged = infos[0]
+        merged._cubeDtype = np.dtype(merged._cubeDtype if dtype is None
+                                     else dtype)
+        merged._nRepetitions = int(sum(info._nRepetitions for info in infos))
+        merged._repetitions = None
+        merged._snrTarget = None
+        merged._parentTt = None
+        merged._referenceEvery = None
+        merged._driftModel = None
+        merged._mergedTts = list(tt_list)
+        if storage_folder is None:
+            storage_folder = IFMaker._storageFolder()
+        merged._folder, merged._tt = \
+            TtFolder(storage_folder).createFolderToStoreMeasurements()
+        header = merged._cubeHeader()
+        header['MERGEWGT'] = weights_name
+        logger.info('Merging %s into %s', tt_list, merged._tt)
+
+        n_rows, n_columns, n_slots = cubes[0].shape
+        if block_rows is None:
+            row_bytes = n_columns * n_slots * merged._cubeDtype.itemsize
+            block_rows = max(1, DEFAULT_BAND_BYTES //
+                             (row_bytes * (len(cubes) + 2)))
+        with FitsCubeFile(os.path.join(merged._folder, 'Cube.fits'),
+                          cubes[0].shape, merged._cubeDtype, header,
+                          merged._cubeExtensions()) as cube_file:
+            for start in range(0, n_rows, block_rows):
+                rows = slice(start, start + block_rows)
+                band_weights = _weightsOfRows(tt_list, cubes, weights,
+                                              rows, merged._cubeDtype)
+                total = np.zeros(band_weights[0].shape,
+                                 dtype=merged._cubeDtype)
+                weight_sum = np.zeros(total.shape, dtype=merged._cubeDtype)
+                for cube, weight in zip(cubes, band_weights):
+                    data = cube[rows].data
+                    total += np.where(weight > 0, data, 0) * weight
+                    weight_sum += weight
+                np.divide(total, weight_sum, out=total, where=weight_sum > 0)
+                cube_file.writeRows(
+                    start, np.ma.masked_array(total, mask=weight_sum == 0))
+    finally:
+        for cube in cubes:
+            cube.close()
+    return merged._tt
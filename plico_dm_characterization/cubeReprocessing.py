@@ -0,0 +1,146 @@
+import os
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from plico_dm_characterization.influenceFunctionsMaker import IFMaker
+from plico_dm_characterization.cubeBuilder import repetitionCounts
+from plico_dm_characterization.ground import temp
+from plico_dm_characterization.ground.acquisition_journal import \
+    AcquisitionJournal
+from plico_dm_characterization.type.commandHistory import CmdHistory
+
+
+def _acquisitionTemplate(an):
+    '''
+    Template of the acquisition, read from its journal or its command
+    history: the one of Cube.fits is the template of the last
+    reprocessing. Only for acquisitions recording neither, the template
+    of Cube.fits is returned.
+    '''
+    if AcquisitionJournal.exists(an._folder):
+        header = AcquisitionJournal.load(an._folder).getHeader()
+        return np.array([int(k) for k in header['TEMPLATE'].split(',')])
+    lazy_history = CmdHistory.load(an._tt_cmdH).getLazyCommandHistory()
+    if lazy_history is not None:
+        return np.asarray(lazy_history.getTemplate())
+    return an._template
+
+
+def _checkFrames(an):
+    '''
+    Raises ValueError for the tracking numbers without raw frames, as
+    the merged cubes
+    '''
+    if an.getMergedTrackingNumbers() is not None:
+        raise ValueError('%s is a merge of %s: merged cubes cannot be '
+                         'reprocessed from frames'
+                         % (an._tt, ','.join(an.getMergedTrackingNumbers())))
+    if temp.frameStorageType(an._folder) == 'fits' and not os.path.exists(
+            os.path.join(an._folder, 'image_0000.fits')):
+        raise ValueError('%s has no frames to reprocess' % an._tt)
+
+
+def reprocessCube(tt, repetitions=None, template=None, n_workers=1,
+                  cube_name='Cube.fits', storage_folder=None, dtype=None,
+                  memory_budget=None):
+    '''
+    Rebuilds the cube of an influence functions tracking number from its
+    raw frames. The cube is written atomically next to the frames.
+
+    Parameters
+    ----------
+    tt: string
+        tracking number of the influence functions
+    repetitions: numpy array, optional
+        repetitions to average; if not indicated, all of them, whatever
+        the repetitions used by the existing cube
+    template: numpy array, optional
+        vector composed by 1 and -1 used to combine the frames; it must
+        have the same length of the template used in the acquisition.
+        If not indicated, the template of the acquisition, whatever
+        the template used by the existing cube.
+    n_workers: int, optional
+        number of processes among which the actuators are spread
+    cube_name: string, optional
+        name of the cube file to write
+    storage_folder: string, optional
+        root folder of the tracking numbers
+    dtype: numpy dtype, optional
+        float type of the cube; if not indicated, the type of the
+        existing cube
+    memory_budget: int, optional
+        bytes available to build the cube; if indicated, the cube is
+        built in blocks of actuators written directly to the file
+
+    Returns
+    -------
+    file_name: string
+        path of the cube written
+    '''
+    logger = logging.getLogger('CUBE_REPROCESSING:')
+    an = IFMaker.loadInfoFromIFMaker(tt, storage_folder)
+    _checkFrames(an)
+    acquisition_template = _acquisitionTemplate(an)
+    if template is None:
+        template = acquisition_template
+    template = np.asarray(template)
+    if template.size != acquisition_template.size:
+        raise ValueError('Template %s must have %d elements as the '
+                         'acquisition template %s'
+                         % (template, acquisition_template.size,
+                            acquisition_template))
+    an._template = template
+    if repetitions is not None:
+        repetitions = np.asarray(repetitions)
+        n_rep = repetitionCounts(an._indexingList).max()
+        if np.any(repetitions < 0) or np.any(repetitions >= n_rep):
+            raise ValueError('Repetitions %s not in [0, %d)'
+                             % (repetitions, n_rep))
+    an._repetitions = repetitions
+    if dtype is not None:
+        an._cubeDtype = np.dtype(dtype)
+    logger.info('Reprocessing %s with %d workers', tt, n_workers)
+    if memory_budget is not None:
+        an._createCubeOnDisk(cube_name, memory_budget, n_workers)
+        an.getCube().close()
+    else:
+        an._createCube(n_workers)
+        an._saveCube(cube_name)
+    return os.path.join(an._folder, cube_name)
+
+
+def reprocessCubes(tt_list, repetitions=None, template=None, n_workers=1,
+                   split='actuators', cube_name='Cube.fits',
+                   storage_folder=None, dtype=None, memory_budget=None):
+    '''
+    Rebuilds the cubes of many influence functions tracking numbers
+
+    Parameters
+    ----------
+    tt_list: list
+        tracking numbers of the influence functions
+    split: string, optional
+        'actuators' to spread the actuators of each tracking number on
+        the process pool, 'tracking_numbers' to process one tracking
+        number per process
+
+    Other parameters are the same of reprocessCube
+
+    Returns
+    -------
+    file_names: list
+        paths of the cubes written
+    '''
+    if split == 'actuators' or n_workers <= 1:
+        return [reprocessCube(tt, repetitions, template, n_workers,
+                              cube_name, storage_folder, dtype,
+                              memory_budget)
+                for tt in tt_list]
+    if split != 'tracking_numbers':
+        raise ValueError('Unknown split %s' % split)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(reprocessCube, tt, repetitions, template, 1,
+                               cube_name, storage_folder, dtype,
+                               memory_budget)
+                   for tt in tt_list]
+        return [future.result() for future in futures]
@@ -0,0 +1,219 @@
+import os
+import threading
+import numpy as np
+from astropy.io import fits
+from plico_dm_characterization.ground import temp
+
+JOURNAL_NAME = 'journal.fits'
+
+
+class AcquisitionJournal():
+    '''
+    Progress journal of an influence functions acquisition
+
+    The journal is a small fits file in the tracking number folder with
+    the acquisition parameters in the header, the DM baseline as data
+    and the index of the last frame saved (LASTFRM). Frames saved out of
+    order (pipelined writers) are counted only when all the previous
+    ones are on disk, so that LASTFRM + 1 is always the first frame to
+    measure again. The journal is written every checkpoint_every frames,
+    after calling the flush function of the frame storage, if set.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.ground.acquisition_journal import \
+            AcquisitionJournal
+        journal = AcquisitionJournal(folder, header, baseline, n_frames)
+        journal.frameSaved(index)
+        journal = AcquisitionJournal.load(folder)
+        journal.getNextFrameIndex()
+    '''
+
+    def __init__(self, location, header, baseline, n_frames,
+                 last_frame=-1, checkpoint_every=1):
+        """The constructor
+
+        Parameters
+        ----------
+        location: string
+            tracking number folder of the acquisition
+        header: astropy fits Header
+            acquisition parameters
+        baseline: numpy array [nActs]
+            shape of the DM on which the command history is applied
+        n_frames: int
+            number of frames of the acquisition
+        last_frame: int, optional
+            index of the last frame already saved
+        checkpoint_every: int, optional
+            number of saved frames between two updates of the file
+        """
+        self._fileName = os.path.join(location, JOURNAL_NAME)
+        self._header = fits.Header(header)
+        self._baseline = np.asarray(baseline)
+        self._nFrames = n_frames
+        self._lastFrame = last_frame
+        self._lastWritten = last_frame
+        self._checkpointEvery = max(int(checkpoint_every), 1)
+        self._pending = set()
+        self._flushFrames = None
+        self._lock = threading.Lock()
+
+    def setCheckpointEvery(self, checkpoint_every):
+        '''
+        Parameters
+        ----------
+        checkpoint_every: int
+            number of saved frames between two updates of the file
+        '''
+        with self._lock:
+            self._checkpointEvery = max(int(checkpoint_every), 1)
+
+    def setFlushFunction(self, flush):
+        '''
+        Parameters
+        ----------
+        flush: function or None
+            called before each update of the file to write to disk the
+            frames that it records (es. flush of an h5 container)
+        '''
+        with self._lock:
+            self._flushFrames = flush
+
+    def getHeader(self):
+        '''
+        Returns
+        -------
+        header: astropy fits Header
+            acquisition parameters
+        '''
+        return self._header
+
+    def getBaseline(self):
+        '''
+        Returns
+        -------
+        baseline: numpy array [nActs]
+            shape of the DM on which the command history is applied
+        '''
+        return self._baseline
+
+    def getNumberOfFrames(self):
+        '''
+        Returns
+        -------
+        n_frames: int
+            number of frames of the acquisition
+        '''
+        return self._nFrames
+
+    def getNextFrameIndex(self):
+        '''
+        Returns
+        -------
+        index: int
+            first frame not saved yet
+        '''
+        with self._lock:
+            return self._lastFrame + 1
+
+    def isComplete(self):
+        '''
+        Returns
+        -------
+        complete: boolean
+            True if all the frames have been saved
+        '''
+        return self.getNextFrameIndex() >= self._nFrames
+
+    def frameSaved(self, index):
+        '''
+        Records that the frame of index is on disk.
+        Thread safe: it can be called by many writers.
+
+        Parameters
+        ----------
+        index: int
+            index of the saved frame
+        '''
+        with self._lock:
+            if index <= self._lastFrame:
+                return
+            self._pending.add(index)
+            while self._lastFrame + 1 in self._pending:
+                self._lastFrame += 1
+                self._pending.remove(self._lastFrame)
+            if self._lastFrame - self._lastWritten >= self._checkpointEvery \
+                    or self._lastFrame == self._nFrames - 1:
+                self._write()
+
+    def update(self, **keywords):
+        '''
+        Sets header keywords and writes the journal
+
+        Parameters
+        ----------
+        keywords:
+            header keywords to set (es. ROIY0=10)
+        '''
+        with self._lock:
+            for key, value in keywords.items():
+                self._header[key] = value
+            self._write()
+
+    def flush(self):
+        ''' Writes the journal with the last frame saved '''
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self._flushFrames is not None:
+            self._flushFrames()
+        header = self._header.copy()
+        header['NFRAMES'] = self._nFrames
+        header['LASTFRM'] = self._lastFrame
+        location = os.path.dirname(self._fileName)
+        tmp_file_name = temp.temporaryFileName(location)
+        try:
+            fits.writeto(tmp_file_name, self._baseline, header,
+                         overwrite=True)
+            os.replace(tmp_file_name, self._fileName)
+        except BaseException:
+            os.remove(tmp_file_name)
+            raise
+        self._lastWritten = self._lastFrame
+
+    @staticmethod
+    def exists(location):
+        '''
+        Returns
+        -------
+        exists: boolean
+            True if location contains an acquisition journal
+        '''
+        return os.path.exists(os.path.join(location, JOURNAL_NAME))
+
+    @staticmethod
+    def load(location, checkpoint_every=1):
+        ''' Creates the object from the journal in location
+
+        Parameters
+        ----------
+        location: string
+            tracking number folder of the acquisition
+
+        Returns
+        -------
+        journal: object
+            AcquisitionJournal class object
+        '''
+        file_name = os.path.join(location, JOURNAL_NAME)
+        if not os.path.exists(file_name):
+            raise OSError('No acquisition journal in %s' % location)
+        with fits.open(file_name, memmap=False) as hduList:
+            header = hduList[0].header.copy()
+            baseline = np.array(hduList[0].data)
+        n_frames = header.pop('NFRAMES')
+        last_frame = header.pop('LASTFRM')
+        return AcquisitionJournal(location, header, baseline, n_frames,
+                                  last_frame, checkpoint_every)
@@ -0,0 +1,205 @@
+import os
+import numpy as np
+from astropy.io import fits
+from plico_dm_characterization.ground import temp
+
+#: default bytes of the bands of pixel rows moved at a time by close()
+DEFAULT_BAND_BYTES = 64 * 2**20
+
+
+def _writeEmptyImage(fobj, shape, dtype, header=None, primary=False):
+    '''
+    Writes at the current position of fobj the header of an image of
+    shape and dtype and reserves the space of its data, without
+    allocating it in memory
+    '''
+    hdu_class = fits.PrimaryHDU if primary else fits.ImageHDU
+    hdu = hdu_class(data=np.zeros((1,) * len(shape), dtype=dtype),
+                    header=header)
+    for i, n in enumerate(reversed(shape)):
+        hdu.header['NAXIS%d' % (i + 1)] = n
+    fobj.write(hdu.header.tostring().encode('ascii'))
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    padded = -(-size // 2880) * 2880
+    fobj.seek(padded - 1, os.SEEK_CUR)
+    fobj.write(b'\0')
+
+
+class FitsCubeFile():
+    '''
+    Cube.fits preallocated on disk and filled block by block through a
+    memory map, so that the cube never has to fit in memory.
+
+    The layout is the one of IFMaker._saveCube: cube, uint8 mask,
+    extensions (amplitude, acts vector, template, indexing list) and,
+    optionally, the VARIANCE extension. The file is written next to
+    file_name and moved in place by close().
+
+    In the [pixels, pixels, nActs] layout of the fits file the actuator
+    axis varies fastest, so a block of actuators would be scattered on
+    every page of the file. The blocks of actuators given to writeBlock
+    are therefore staged in actuator-major scratch files, where each
+    block is contiguous, and close() moves them into the fits file in
+    bands of pixel rows, which are contiguous there: the cube is written
+    twice and read once, whatever the number of blocks. Bands of pixel
+    rows can also be written directly with writeRows.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.ground.cube_file import FitsCubeFile
+        with FitsCubeFile(file_name, shape, dtype, header, extensions) as cube:
+            cube.writeBlock(slots, cube_block)
+    '''
+
+    def __init__(self, file_name, shape, dtype, header, extensions,
+                 with_variance=False, band_bytes=DEFAULT_BAND_BYTES):
+        """The constructor
+
+        Parameters
+        ----------
+        file_name: string
+            path of the cube file
+        shape: tuple
+            shape of the cube [pixels, pixels, nActs]
+        dtype: numpy dtype
+            float type of the cube
+        header: astropy fits Header
+            header of the cube
+        extensions: list
+            numpy arrays saved as image extensions after the mask
+        with_variance: boolean, optional
+            if True the VARIANCE extension is reserved too
+        band_bytes: int, optional
+            bytes of the bands of pixel rows moved at a time from the
+            scratch files to the fits file
+        """
+        self._fileName = file_name
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+        self._bandBytes = band_bytes
+        self._staging = None
+        self._tmpFileName = temp.temporaryFileName(
+            os.path.dirname(os.path.abspath(file_name)))
+        self._hduList = None
+        try:
+            with open(self._tmpFileName, 'wb') as fobj:
+                _writeEmptyImage(fobj, shape, self._dtype, header,
+                                 primary=True)
+                _writeEmptyImage(fobj, shape, np.uint8)
+            for extension in extensions:
+                fits.append(self._tmpFileName, extension)
+            if with_variance:
+                with open(self._tmpFileName, 'r+b') as fobj:
+                    fobj.seek(0, os.SEEK_END)
+                    _writeEmptyImage(fobj, shape, self._dtype,
+                                     fits.Header([('EXTNAME', 'VARIANCE')]))
+            self._hduList = fits.open(self._tmpFileName, mode='update',
+                                      memmap=True)
+        except BaseException:
+            self.abort()
+            raise
+        self._withVariance = with_variance
+
+    def _openStaging(self):
+        folder = os.path.dirname(self._tmpFileName)
+        shape = (self._shape[2],) + self._shape[:2]
+        dtypes = [self._dtype, bool]
+        if self._withVariance:
+            dtypes.append(self._dtype)
+        self._staging = []
+        for dtype in dtypes:
+            file_name = temp.temporaryFileName(folder)
+            self._staging.append(np.memmap(file_name, dtype=dtype,
+                                           mode='w+', shape=shape))
+
+    def _closeStaging(self):
+        file_names = [array.filename for array in self._staging or []]
+        self._staging = None
+        for file_name in file_names:
+            os.remove(file_name)
+
+    def writeBlock(self, slots, cube, variance=None):
+        '''
+        Stages a block of actuators, moved into the fits file by close()
+
+        Parameters
+        ----------
+        slots: numpy array
+            cube slices of the block
+        cube: numpy masked array [pixels, pixels, len(slots)]
+            influence functions of the block
+        variance: numpy masked array [pixels, pixels, len(slots)], optional
+            variance of the repetitions of the block
+        '''
+        if self._staging is None:
+            self._openStaging()
+        slots = np.asarray(slots)
+        blocks = [np.ma.getdata(cube), np.ma.getmaskarray(cube)]
+        if self._withVariance:
+            blocks.append(np.ma.filled(variance, np.nan))
+        for array, block in zip(self._staging, blocks):
+            array[slots] = np.moveaxis(block, -1, 0)
+
+    def writeRows(self, start, cube, variance=None):
+        '''
+        Writes a band of pixel rows directly in the fits file
+
+        Parameters
+        ----------
+        start: int
+            first pixel row of the band
+        cube: numpy masked array [rows, pixels, nActs]
+            influence functions on the rows of the band
+        variance: numpy masked array [rows, pixels, nActs], optional
+            variance of the repetitions on the rows of the band
+        '''
+        rows = slice(start, start + cube.shape[0])
+        self._hduList[0].data[rows] = np.ma.getdata(cube)
+        self._hduList[1].data[rows] = np.ma.getmaskarray(cube)
+        if self._withVariance:
+            self._hduList['VARIANCE'].data[rows] = \
+                np.ma.filled(variance, np.nan)
+
+    def _moveStagedBlocks(self):
+        hdus = [self._hduList[0], self._hduList[1]]
+        if self._withVariance:
+            hdus.append(self._hduList['VARIANCE'])
+        row_bytes = self._shape[1] * self._shape[2] * sum(
+            array.dtype.itemsize for array in self._staging)
+        n_rows = max(1, self._bandBytes // row_bytes)
+        for start in range(0, self._shape[0], n_rows):
+            rows = slice(start, start + n_rows)
+            for hdu, array in zip(hdus, self._staging):
+                hdu.data[rows] = np.moveaxis(array[:, rows], 0, -1)
+
+    def close(self):
+        ''' Flushes the file and moves it to file_name '''
+        if self._staging is not None:
+            try:
+                self._moveStagedBlocks()
+            except BaseException:
+                self.abort()
+                raise
+            self._closeStaging()
+        self._hduList.close()
+        self._hduList = None
+        os.replace(self._tmpFileName, self._fileName)
+
+    def abort(self):
+        ''' Removes the partially written file '''
+        self._closeStaging()
+        if self._hduList is not None:
+            self._hduList.close()
+            self._hduList = None
+        if os.path.exists(self._tmpFileName):
+            os.remove(self._tmpFileName)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
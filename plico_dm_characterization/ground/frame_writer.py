@@ -0,0 +1,153 @@
+import queue
+import threading
+import logging
+
+
+class FrameWriter():
+    '''
+    Write-behind storage of the measured frames
+
+    The frames are put in a bounded queue and saved by background worker
+    threads while the acquisition loop goes on with the next command.
+    When the queue is full put() blocks until a worker frees a slot
+    (backpressure), so that the memory used by pending frames is bounded
+    by queue_size.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.ground.frame_writer import FrameWriter
+        with FrameWriter(save_function, queue_size=8) as writer:
+            for i in range(n_frames):
+                writer.put(i, interf.wavefront())
+        # all frames are on disk here
+    '''
+
+    def __init__(self, save_function, queue_size=8, n_writers=1):
+        """The constructor
+
+        Parameters
+        ----------
+        save_function: function
+            function called as save_function(index, masked_image)
+            to persist each frame
+        queue_size: int
+            maximum number of frames waiting to be saved
+        n_writers: int
+            number of writer threads
+        """
+        self._logger = logging.getLogger('FRAME_WRITER:')
+        self._saveFunction = save_function
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._errors = []
+        self._nWritten = 0
+        self._workers = []
+        for i in range(n_writers):
+            worker = threading.Thread(target=self._work,
+                                      name='FrameWriter-%d' % i,
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        self._closed = False
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                index, masked_image = item
+                try:
+                    self._saveFunction(index, masked_image)
+                except Exception as exc:
+                    self._logger.error('Error saving frame %d: %s', index, exc)
+                    with self._lock:
+                        self._errors.append((index, exc))
+                else:
+                    with self._lock:
+                        self._nWritten += 1
+            finally:
+                self._queue.task_done()
+
+    def _raiseIfFailed(self):
+        with self._lock:
+            if not self._errors:
+                return
+            index, exc = self._errors[0]
+            n_errors = len(self._errors)
+        raise OSError('Error saving frame %d (%d failed frames): %s'
+                      % (index, n_errors, exc)) from exc
+
+    def put(self, index, masked_image):
+        '''
+        Queue a frame to be saved. Blocks while the queue is full.
+
+        Parameters
+        ----------
+        index: int
+            frame index
+        masked_image: numpy masked array
+            frame to save
+
+        Raises
+        ------
+        OSError
+            if the writer failed to save a previous frame
+        '''
+        if self._closed:
+            raise ValueError('FrameWriter is closed')
+        self._raiseIfFailed()
+        self._queue.put((index, masked_image))
+
+    def flush(self):
+        '''
+        Wait until all the queued frames have been saved
+
+        Raises
+        ------
+        OSError
+            if the writer failed to save any frame
+        '''
+        self._queue.join()
+        self._raiseIfFailed()
+
+    def close(self):
+        '''
+        Flush the queue and stop the workers
+
+        Raises
+        ------
+        OSError
+            if the writer failed to save any frame
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._raiseIfFailed()
+
+    def getNumberOfWrittenFrames(self):
+        '''
+        Returns
+        -------
+        n_written: int
+            number of frames saved so far
+        '''
+        with self._lock:
+            return self._nWritten
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            try:
+                self.close()
+            except OSError as exc:
+                self._logger.error('Error closing writer: %s', exc)
+        return False
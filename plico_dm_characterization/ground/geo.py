@@ -114,3 +114,46 @@ def rotate(img, angle):
     img1 = img1[int((s1[0]-s0[0])/2):s0[0]+int((s1[0]-s0[0])/2),
                 int((s1[1]-s0[1])/2):s0[1]+int((s1[1]-s0[1])/2)]
     return img1
+
+def pupilRoi(mask, margin=0):
+    ''' Bounding box of the valid pixels of a mask
+    Parameters
+    ----------
+    mask: numpy array
+        boolean mask, True for the pixels outside the pupil
+        (as the mask of a masked array)
+    margin: int [pixel]
+        pixels added on each side of the bounding box
+
+    Returns
+    ------
+    roi: tuple
+        (y0, x0, ny, nx) origin and size of the region of interest
+    '''
+    valid = np.invert(np.asarray(mask, dtype=bool))
+    rows = np.flatnonzero(np.any(valid, axis=1))
+    cols = np.flatnonzero(np.any(valid, axis=0))
+    if rows.size == 0:
+        raise ValueError('The mask has no valid pixels')
+    y0 = max(rows[0] - margin, 0)
+    x0 = max(cols[0] - margin, 0)
+    y1 = min(rows[-1] + 1 + margin, valid.shape[0])
+    x1 = min(cols[-1] + 1 + margin, valid.shape[1])
+    return (int(y0), int(x0), int(y1 - y0), int(x1 - x0))
+
+def cropToRoi(img, roi):
+    ''' Crops the image to the region of interest
+    Parameters
+    ----------
+    img: numpy array or masked array
+        image to crop (the first two axes are cropped)
+    roi: tuple
+        (y0, x0, ny, nx) as returned by pupilRoi
+
+    Returns
+    ------
+    img1: numpy array or masked array
+        cropped image
+    '''
+    y0, x0, ny, nx = roi
+    return img[y0:y0 + ny, x0:x0 + nx]
@@ -0,0 +1,171 @@
+import numpy as np
+from astropy.io import fits
+from plico_dm_characterization.ground import temp
+from plico_dm_characterization.ground.cube_file import DEFAULT_BAND_BYTES
+
+
+class LazyCube():
+    '''
+    Influence functions cube memory-mapped from its fits file
+
+    Nothing is read until an actuator slice or the mask is requested,
+    so that large cubes can be opened instantly.
+
+    In the [pixels, pixels, nActs] layout of the fits file the actuator
+    axis varies fastest, so even a single actuator slice is spread on
+    every page of the file: reading actuators always reads the whole
+    cube from disk. getActuators and getVariance therefore read it
+    sequentially, in bands of contiguous pixel rows of band_bytes, and
+    keep in memory only the band and the requested actuators. Bands of
+    pixel rows (cube[start:stop]) are read without this overhead.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.ground.lazy_cube import LazyCube
+        with LazyCube(file_name) as cube:
+            cube.shape
+            ifs = cube.getActuators([0, 10, 20])
+            if0 = cube[:, :, 0]
+    '''
+
+    def __init__(self, file_name, band_bytes=DEFAULT_BAND_BYTES):
+        """The constructor
+
+        Parameters
+        ----------
+        file_name: string
+            path of the cube fits file
+        band_bytes: int, optional
+            bytes of the bands of pixel rows read at a time when
+            gathering actuators
+        """
+        self._fileName = file_name
+        self._bandBytes = band_bytes
+        self._hduList = fits.open(file_name, memmap=True,
+                                  ignore_missing_simple=True)
+        self._header = self._hduList[0].header
+        self._mask = None
+
+    @property
+    def header(self):
+        ''' header of the cube '''
+        return self._header
+
+    @property
+    def shape(self):
+        ''' shape of the cube [pixels, pixels, nActs] '''
+        naxis = self._header['NAXIS']
+        return tuple(self._header['NAXIS%d' % (naxis - i)]
+                     for i in range(naxis))
+
+    @property
+    def dtype(self):
+        ''' float type of the cube data '''
+        return np.dtype(np.float32) if self._header['BITPIX'] == -32 \
+            else np.dtype(np.float64)
+
+    @property
+    def data(self):
+        ''' memory-mapped cube data '''
+        return self._hduList[0].data
+
+    @property
+    def mask(self):
+        ''' boolean mask of the cube, memory-mapped if stored as uint8 '''
+        if self._mask is None:
+            hdu = self._hduList[1]
+            if hdu.header['BITPIX'] == 8 and \
+                    hdu.header.get('MASKENC') != 'PACKBITS':
+                self._mask = hdu.data.view(bool)
+            else:
+                self._mask = temp.maskFromHDU(hdu)
+        return self._mask
+
+    def _toNative(self, data):
+        return np.array(data, dtype=self.dtype)
+
+    def _gather(self, data, index_list):
+        '''
+        data[:, :, index_list] read in bands of pixel rows
+        '''
+        index_list = np.asarray(index_list)
+        gathered = np.empty(data.shape[:2] + index_list.shape,
+                            dtype=data.dtype)
+        row_bytes = data.shape[1] * data.shape[2] * data.dtype.itemsize
+        n_rows = max(1, self._bandBytes // row_bytes)
+        for start in range(0, data.shape[0], n_rows):
+            rows = slice(start, start + n_rows)
+            gathered[rows] = data[rows][:, :, index_list]
+        return gathered
+
+    def __getitem__(self, key):
+        '''
+        Returns
+        -------
+        masked_cube: numpy masked array
+            cube[key] read from the file
+        '''
+        return np.ma.masked_array(self._toNative(self.data[key]),
+                                  np.array(self.mask[key]))
+
+    def getActuators(self, index_list):
+        '''
+        Parameters
+        ----------
+        index_list: list or numpy array
+            index of the actuators to read
+
+        Returns
+        -------
+        ifs: numpy masked array [pixels, pixels, len(index_list)]
+            influence functions of the actuators, gathered in bands of
+            pixel rows
+        '''
+        return np.ma.masked_array(
+            self._toNative(self._gather(self.data, index_list)),
+            self._gather(self.mask, index_list))
+
+    def toMaskedArray(self):
+        '''
+        Returns
+        -------
+        cube: numpy masked array [pixels, pixels, nActs]
+            whole cube read in memory
+        '''
+        return self[:, :, :]
+
+    def getVariance(self, index_list=None, rows=None):
+        '''
+        Parameters
+        ----------
+        index_list: list or numpy array, optional
+            index of the actuators to read; if not indicated, all
+        rows: slice, optional
+            band of pixel rows to read; if not indicated, all
+
+        Returns
+        -------
+        variance: numpy masked array [pixels, pixels, len(index_list)]
+            per-pixel variance of the repetitions, masked where not
+            available; None if the cube has no VARIANCE extension
+        '''
+        if 'VARIANCE' not in self._hduList:
+            return None
+        data = self._hduList['VARIANCE'].data
+        if rows is not None:
+            data = data[rows]
+        if index_list is not None:
+            data = self._gather(data, index_list)
+        return np.ma.masked_invalid(self._toNative(data))
+
+    def close(self):
+        ''' closes the file; the arrays returned so far stay valid '''
+        self._mask = None
+        self._hduList.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,129 @@
+import hashlib
+import numpy as np
+
+
+def maskDigest(mask):
+    '''
+    Parameters
+    ----------
+    mask: boolean numpy array [pixels, pixels]
+        mask to identify
+
+    Returns
+    -------
+    digest: string
+        hexadecimal sha256 of the shape and of the packed bits of mask
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    digest = hashlib.sha256(str(mask.shape).encode('ascii'))
+    digest.update(np.packbits(mask, axis=None).tobytes())
+    return digest.hexdigest()
+
+
+class PupilIndexMap():
+    '''
+    Flat indexes of the valid pixels of a mask, computed once, to gather
+    the valid pixels of images and cubes without building masked arrays
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.ground.pupil_index_map import \
+            PupilIndexMap
+        index_map = PupilIndexMap(mask)
+        values = index_map.compress(image)
+        int_mat = index_map.compressCube(cube_data)
+    '''
+
+    def __init__(self, mask, digest=None):
+        """The constructor
+
+        Parameters
+        ----------
+        mask: boolean numpy array [pixels, pixels]
+            True on the pixels to discard
+        digest: string, optional
+            maskDigest of mask, if already computed
+        """
+        mask = np.asarray(mask, dtype=bool)
+        self._shape = mask.shape
+        self._indexes = np.flatnonzero(~mask)
+        self._digest = digest
+
+    @property
+    def shape(self):
+        ''' shape of the images [pixels, pixels] '''
+        return self._shape
+
+    @property
+    def size(self):
+        ''' number of valid pixels '''
+        return self._indexes.size
+
+    def getIndexes(self):
+        '''
+        Returns
+        -------
+        indexes: numpy array [size]
+            flat indexes of the valid pixels, in C order
+        '''
+        return self._indexes
+
+    def getMask(self):
+        '''
+        Returns
+        -------
+        mask: boolean numpy array [pixels, pixels]
+            True on the pixels to discard
+        '''
+        mask = np.ones(self._shape, dtype=bool)
+        mask.flat[self._indexes] = False
+        return mask
+
+    def getDigest(self):
+        '''
+        Returns
+        -------
+        digest: string
+            maskDigest of the mask, computed once
+        '''
+        if self._digest is None:
+            self._digest = maskDigest(self.getMask())
+        return self._digest
+
+    def _checkShape(self, shape):
+        if tuple(shape[:2]) != self._shape:
+            raise ValueError('Image of shape %s, the mask is %s'
+                             % (tuple(shape[:2]), self._shape))
+
+    def compress(self, image):
+        '''
+        Parameters
+        ----------
+        image: numpy array or masked array [pixels, pixels]
+            image whose valid pixels are gathered, whatever its own mask
+
+        Returns
+        -------
+        values: numpy array [size]
+            values of the valid pixels, as image.compressed() with the mask
+        '''
+        image = np.ma.getdata(image)
+        self._checkShape(image.shape)
+        return image.reshape(-1)[self._indexes]
+
+    def compressCube(self, cube):
+        '''
+        Parameters
+        ----------
+        cube: numpy array [pixels, pixels, N]
+            stack of images, also memory-mapped: only the rows of the
+            valid pixels are read
+
+        Returns
+        -------
+        values: numpy array [size, N]
+            values of the valid pixels of each image
+        '''
+        cube = np.ma.getdata(cube)
+        self._checkShape(cube.shape)
+        return cube.reshape(-1, cube.shape[2])[self._indexes]
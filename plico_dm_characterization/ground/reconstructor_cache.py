@@ -0,0 +1,161 @@
+import os
+import glob
+import hashlib
+import logging
+import numpy as np
+from astropy.io import fits
+from plico_dm_characterization.ground import temp
+
+#: name of the cache folder in the tracking number folder
+CACHE_FOLDER = 'ReconstructorCache'
+#: default maximum size of the cache in bytes
+DEFAULT_MAX_SIZE = 2**30
+
+
+class ReconstructorCache():
+    '''
+    Reconstructors of the influence functions of a tracking number, saved
+    on disk and keyed by analysis mask, rcond and dtype
+
+    Each entry is a fits file in the ReconstructorCache folder of the
+    tracking number, with the key and the size and modification time of
+    Cube.fits in the header: when Cube.fits changes (es. reprocessed) all
+    the entries are removed. When the cache grows over max_size the least
+    recently used entries are removed.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.ground.reconstructor_cache import \
+            ReconstructorCache
+        cache = ReconstructorCache(folder, tt)
+        rec = cache.load(mask_digest, rcond, dtype)
+        if rec is None:
+            rec = np.linalg.pinv(int_mat, rcond=rcond)
+            cache.save(mask_digest, rcond, dtype, rec)
+    '''
+
+    def __init__(self, tt_folder, tt, max_size=DEFAULT_MAX_SIZE,
+                 cube_name='Cube.fits'):
+        """The constructor
+
+        Parameters
+        ----------
+        tt_folder: string
+            folder of the influence functions tracking number
+        tt: string
+            tracking number of the influence functions
+        max_size: int, optional
+            maximum size of the cache in bytes
+        cube_name: string, optional
+            name of the cube file whose changes invalidate the cache
+        """
+        self._location = os.path.join(tt_folder, CACHE_FOLDER)
+        self._cubeFileName = os.path.join(tt_folder, cube_name)
+        self._tt = tt
+        self._maxSize = max_size
+        self._logger = logging.getLogger('RECONSTRUCTOR_CACHE:')
+
+    def _cubeSignature(self):
+        stat = os.stat(self._cubeFileName)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _fileName(self, mask_digest, rcond, dtype):
+        key = '%s %s %r %s' % (self._tt, mask_digest, float(rcond),
+                               np.dtype(dtype).name)
+        return os.path.join(self._location, hashlib.sha256(
+            key.encode('ascii')).hexdigest()[:32] + '.fits')
+
+    def _entries(self):
+        return glob.glob(os.path.join(self._location, '*.fits'))
+
+    def load(self, mask_digest, rcond, dtype):
+        '''
+        Parameters
+        ----------
+        mask_digest: string
+            digest of the analysis mask
+        rcond: float
+            cutoff of the singular values of the pseudo inverse
+        dtype: numpy dtype
+            float type of the reconstructor
+
+        Returns
+        -------
+        rec: numpy array [nActs, pixels]
+            cached reconstructor, None if not in the cache
+        '''
+        file_name = self._fileName(mask_digest, rcond, dtype)
+        if not os.path.exists(file_name):
+            return None
+        with fits.open(file_name, memmap=False) as hduList:
+            header = hduList[0].header
+            if (header['CUBESIZE'], header['CUBEMTIM']) != \
+                    self._cubeSignature():
+                self._logger.info('Cube of %s changed: clearing the cache',
+                                  self._tt)
+                self.clear()
+                return None
+            if header['MASKHASH'] != mask_digest:
+                return None
+            rec = np.asarray(hduList[0].data, dtype=dtype)
+        os.utime(file_name)
+        return rec
+
+    def save(self, mask_digest, rcond, dtype, rec):
+        ''' Saves the reconstructor and removes the least recently used
+        entries over the maximum size. The file is written atomically;
+        a cache that cannot be written is only logged.
+
+        Parameters
+        ----------
+        mask_digest, rcond, dtype:
+            key of the reconstructor, as in load
+        rec: numpy array [nActs, pixels]
+            reconstructor to save
+        '''
+        file_name = self._fileName(mask_digest, rcond, dtype)
+        header = fits.Header()
+        header['TT'] = self._tt
+        header['MASKHASH'] = mask_digest
+        header['RCOND'] = float(rcond)
+        header['DTYPE'] = np.dtype(dtype).name
+        header['CUBESIZE'], header['CUBEMTIM'] = self._cubeSignature()
+        try:
+            os.makedirs(self._location, exist_ok=True)
+            tmp_file_name = temp.temporaryFileName(self._location)
+            try:
+                fits.writeto(tmp_file_name, np.asarray(rec, dtype=dtype),
+                             header, overwrite=True)
+                os.replace(tmp_file_name, file_name)
+            except BaseException:
+                os.remove(tmp_file_name)
+                raise
+        except OSError as error:
+            self._logger.warning('Reconstructor not cached: %s', error)
+            return
+        self._evict(keep=file_name)
+
+    def _evict(self, keep):
+        entries = sorted(self._entries(), key=os.path.getmtime)
+        total = sum(os.path.getsize(entry) for entry in entries)
+        for entry in entries:
+            if total <= self._maxSize:
+                break
+            if entry == keep:
+                continue
+            total -= os.path.getsize(entry)
+            os.remove(entry)
+
+    def getSize(self):
+        '''
+        Returns
+        -------
+        size: int
+            bytes used by the cache
+        '''
+        return sum(os.path.getsize(entry) for entry in self._entries())
+
+    def clear(self):
+        ''' Removes all the entries '''
+        for entry in self._entries():
+            os.remove(entry)
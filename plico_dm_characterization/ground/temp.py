@@ -4,10 +4,106 @@ Authors
 '''
 
 import os
+import secrets
 from astropy.io import fits
 import numpy as np
 import h5py
 
+
+def temporaryFileName(location):
+    '''
+    Creates an empty file in location to be written and then moved on the
+    final file with os.replace. The file is created, as mkstemp does,
+    with O_EXCL and a random name, but with mode 0666: the kernel applies
+    the umask as for the files created by open, instead of the 0600 of
+    mkstemp, so that the final file can be read by the other users of the
+    data. The umask is never changed, since it is shared by the threads
+    writing the frames.
+
+    Returns
+    -------
+    file_name: string
+        path of the temporary file
+    '''
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+    while True:
+        file_name = os.path.join(location,
+                                 'tmp%s.tmp' % secrets.token_hex(8))
+        try:
+            fd = os.open(file_name, flags, 0o666)
+        except FileExistsError:
+            continue
+        os.close(fd)
+        return file_name
+
+
+def maskToHDU(mask, packed=True):
+    """
+    Compact encoding of a boolean mask in a fits image HDU
+
+    Parameters
+    ----------
+    mask: numpy array
+        boolean mask of any shape
+    packed: boolean, optional
+        if True the mask is bit-packed (8 pixels per byte) and its shape
+        is written in the header (MASKSHP); otherwise it is stored as uint8,
+        that can be memory-mapped
+
+    Returns
+    -------
+    hdu: astropy ImageHDU
+        HDU containing the encoded mask
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim == 0:
+        raise ValueError('Mask without shape (np.ma.nomask?): '
+                         'use np.ma.getmaskarray')
+    header = fits.Header()
+    if packed:
+        header['MASKENC'] = ('PACKBITS', 'numpy.packbits of the mask')
+        header['MASKSHP'] = (','.join(str(n) for n in mask.shape),
+                             'shape of the mask')
+        return fits.ImageHDU(np.packbits(mask, axis=None), header)
+    header['MASKENC'] = ('UINT8', 'mask stored as uint8')
+    return fits.ImageHDU(mask.astype(np.uint8), header)
+
+def maskFromHDU(hdu):
+    """
+    Decodes a mask written with maskToHDU or, for older files, as int
+
+    Parameters
+    ----------
+    hdu: astropy HDU
+        HDU containing the mask
+
+    Returns
+    -------
+    mask: numpy array
+        boolean mask
+    """
+    if hdu.header.get('MASKENC') == 'PACKBITS':
+        shape = tuple(int(n) for n in hdu.header['MASKSHP'].split(','))
+        n_pixels = int(np.prod(shape))
+        return np.unpackbits(hdu.data, count=n_pixels).view(bool).reshape(shape)
+    return hdu.data.astype(bool)
+
+def appendMask(fits_file_name, mask, packed=True):
+    """
+    Appends the mask to the fits file with the encoding of maskToHDU
+
+    Parameters
+    ----------
+    fits_file_name: string
+        fits file path
+    mask: numpy array
+        boolean mask
+    packed: boolean, optional
+        if True the mask is bit-packed, otherwise stored as uint8
+    """
+    hdu = maskToHDU(mask, packed)
+    fits.append(fits_file_name, hdu.data, hdu.header)
+
 def interf_save_phasemap(location, file_name, masked_image):
     """
     Parameters
@@ -21,7 +117,238 @@ def interf_save_phasemap(location, file_name, masked_image):
     """
     fits_file_name = os.path.join(location, file_name)
     fits.writeto(fits_file_name, masked_image.data)
-    fits.append(fits_file_name, masked_image.mask.astype(int))
+    appendMask(fits_file_name, np.ma.getmaskarray(masked_image))
+
+def interf_saveFrame(location, index, masked_image):
+    """
+    Saves the frame of index in the measurement folder
+
+    Parameters
+    ----------
+    location: string
+        measurement file path
+    index: int
+        frame index
+    masked_image: numpy masked array
+        data to save
+    """
+    interf_save_phasemap(location, 'image_%04d.fits' % index, masked_image)
+
+def interf_readFrame(location, index):
+    """
+    Parameters
+    ----------
+    location: string
+        measurement file path
+    index: int
+        frame index
+
+    Returns
+    -------
+    masked_ima: numpy masked array
+        frame of index saved in location, read from the frames container
+        if it exists and from the fits file of the frame otherwise
+    """
+    with FrameReader(location) as reader:
+        return reader(index)
+
+FRAMES_CONTAINER_NAME = 'frames.h5'
+
+class H5FrameContainer():
+    """
+    Frames of an acquisition stored in a single chunked h5 file with a
+    dataset 'data' of shape [nFrames, pixels, pixels] and a dataset
+    'mask' of the same shape. Frames are accessed by frame index.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.ground.temp import H5FrameContainer
+        with H5FrameContainer(location, 'w') as container:
+            container.save(0, masked_image)
+        with H5FrameContainer(location) as container:
+            masked_image = container.read(0)
+    """
+
+    def __init__(self, location, mode='r'):
+        """The constructor
+
+        Parameters
+        ----------
+        location: string
+            measurement file path
+        mode: string
+            'r' to read, 'w' to create the container, 'a' to append
+        """
+        self._fileName = os.path.join(location, FRAMES_CONTAINER_NAME)
+        self._file = h5py.File(self._fileName, mode)
+
+    def save(self, index, masked_image):
+        """
+        Parameters
+        ----------
+        index: int
+            frame index
+        masked_image: numpy masked array
+            data to save
+        """
+        data = np.ma.getdata(masked_image)
+        if 'data' not in self._file:
+            shape = (0,) + data.shape
+            self._file.create_dataset('data', shape=shape, dtype=data.dtype,
+                                      maxshape=(None,) + data.shape,
+                                      chunks=(1,) + data.shape)
+            self._file.create_dataset('mask', shape=shape, dtype=bool,
+                                      maxshape=(None,) + data.shape,
+                                      chunks=(1,) + data.shape)
+        if index >= self._file['data'].shape[0]:
+            self._file['data'].resize(index + 1, axis=0)
+            self._file['mask'].resize(index + 1, axis=0)
+        self._file['data'][index] = data
+        self._file['mask'][index] = np.ma.getmaskarray(masked_image)
+
+    def read(self, index):
+        """
+        Parameters
+        ----------
+        index: int
+            frame index
+
+        Returns
+        -------
+        masked_ima: numpy masked array
+            frame of index
+        """
+        if index >= len(self):
+            raise IndexError('Frame %d not in %s' % (index, self._fileName))
+        return np.ma.masked_array(self._file['data'][index],
+                                  self._file['mask'][index])
+
+    def __len__(self):
+        if 'data' not in self._file:
+            return 0
+        return self._file['data'].shape[0]
+
+    def flush(self):
+        ''' Writes the buffered frames to disk '''
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+class FitsFrameStorage():
+    """
+    Frames of an acquisition stored as one fits file per frame
+    (image_0000.fits, image_0001.fits...)
+    """
+
+    def __init__(self, location, mode='r'):
+        """The constructor
+
+        Parameters
+        ----------
+        location: string
+            measurement file path
+        mode: string
+            not used, for compatibility with H5FrameContainer
+        """
+        self._location = location
+
+    def save(self, index, masked_image):
+        file_name = os.path.join(self._location, 'image_%04d.fits' % index)
+        if os.path.exists(file_name):
+            # frame measured again by a resumed acquisition
+            os.remove(file_name)
+        interf_saveFrame(self._location, index, masked_image)
+
+    def read(self, index):
+        return interf_readImage(
+            os.path.join(self._location, 'image_%04d.fits' % index))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+def openFrameStorage(location, storage='fits', mode='r'):
+    """
+    Parameters
+    ----------
+    location: string
+        measurement file path
+    storage: string
+        'fits' for one fits file per frame, 'h5' for a single container
+    mode: string
+        'r' to read, 'w' to create the storage, 'a' to append
+
+    Returns
+    -------
+    storage: H5FrameContainer or FitsFrameStorage
+        object to save and read the frames by index
+    """
+    if storage == 'h5':
+        return H5FrameContainer(location, mode)
+    if storage == 'fits':
+        return FitsFrameStorage(location, mode)
+    raise ValueError('Unknown frame storage %s' % storage)
+
+def frameStorageType(location):
+    """
+    Returns
+    -------
+    storage: string
+        'h5' if the frames of location are in a single container,
+        'fits' otherwise
+    """
+    if os.path.exists(os.path.join(location, FRAMES_CONTAINER_NAME)):
+        return 'h5'
+    return 'fits'
+
+class FrameReader():
+    """
+    Callable reading the frames of a measurement folder by index,
+    whatever the storage of the frames is.
+    The storage is opened at the first read in each process, so that
+    the reader can be passed to a process pool.
+    """
+
+    def __init__(self, location):
+        self._location = location
+        self._storage = None
+
+    def __call__(self, index):
+        if self._storage is None:
+            self._storage = openFrameStorage(self._location,
+                                             frameStorageType(self._location))
+        return self._storage.read(index)
+
+    def close(self):
+        if self._storage is not None:
+            self._storage.close()
+            self._storage = None
+
+    def __getstate__(self):
+        return {'_location': self._location, '_storage': None}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
 def interf_readImage4D4020(file_name):
     """
@@ -70,7 +397,7 @@ def interf_readImage(file_name):
     file_name: string
         fits file path name of image to read
     '''
-    hduList = fits.open(file_name)
-    masked_ima = np.ma.masked_array(hduList[0].data,
-                                    hduList[1].data.astype(bool))
+    with fits.open(file_name, memmap=False) as hduList:
+        masked_ima = np.ma.masked_array(hduList[0].data,
+                                        maskFromHDU(hduList[1]))
     return masked_ima
@@ -4,13 +4,23 @@ Authors
 '''
 import os
 import copy
+import contextlib
 import numpy as np
 from astropy.io import fits as pyfits
 from plico_dm_characterization.type.modalAmplitude import ModalAmplitude
 from plico_dm_characterization.type.modalBase import ModalBase
-from plico_dm_characterization.type.commandHistory import CmdHistory
+from plico_dm_characterization.type.commandHistory import CmdHistory, \
+    LazyCmdHistory
 from plico_dm_characterization.ground.tracking_number_folder import TtFolder
 from plico_dm_characterization.ground import temp
+from plico_dm_characterization.ground import geo
+from plico_dm_characterization.ground.lazy_cube import LazyCube
+from plico_dm_characterization.ground.cube_file import FitsCubeFile
+from plico_dm_characterization.ground.frame_writer import FrameWriter
+from plico_dm_characterization.ground.acquisition_journal import \
+    AcquisitionJournal
+from plico_dm_characterization.cubeBuilder import StreamingReducer, \
+    CubeEngine, DriftCorrector, modeSequence
 from plico_dm_characterization.configuration import config
 
 class IFMaker():
@@ -48,10 +58,25 @@ class IFMaker():
         self._tt_cmdH = None
         self._indexingList = None
         self._tt = None
+        self._folder = None
         self._type_of_cmd_matrix = None
+        self._repetitions = None
+        self._cropToPupil = False
+        self._roiMargin = 0
+        self._roi = None
+        self._fullFrameShape = None
+        self._cubeDtype = np.dtype(np.float64)
+        self._journal = None
+        self._snrTarget = None
+        self._maxRepetitions = None
+        self._parentTt = None
+        self._mergedTts = None
+        self._referenceEvery = None
+        self._driftModel = None
 
         #analisi
         self._cube = None
+        self._variance = None
 
     @staticmethod
     def _storageFolder():
@@ -60,7 +85,15 @@ class IFMaker():
 
     def acquisitionAndAnalysis(self, cmd_matrix_tag,
                                amplitude_tag,
-                               shuffle=False, template=None, n_rep=1):
+                               shuffle=False, template=None, n_rep=1,
+                               pipelined=False, queue_size=8, n_writers=1,
+                               streaming=False, save_frames=None,
+                               storage='fits', crop_to_pupil=False,
+                               pupil_mask=None, roi_margin=0,
+                               cube_dtype=np.float64, checkpoint_every=None,
+                               snr_target=None, max_rep=None,
+                               memory_budget=None, reference_every=None,
+                               drift_model='linear'):
         '''
         Performs the process of acquiring interferograms
 
@@ -83,15 +116,92 @@ class IFMaker():
              template: numpy array, optional
                        vector composed by 1 and -1
                        if not indicated, the function use the vector [1, -1, 1]
+             pipelined: boolean, optional
+                       if True the frames are saved by background writers
+                       while the next command is applied and measured
+             queue_size: int, optional
+                       maximum number of frames waiting to be saved
+                       in pipelined mode
+             n_writers: int, optional
+                       number of writer threads in pipelined mode
+             streaming: boolean, optional
+                       if True each frame is reduced into the cube as soon
+                       as it is measured, instead of re-reading all the
+                       frames from disk at the end of the acquisition
+             save_frames: boolean, optional
+                       if True the raw frames are saved in the tracking
+                       number folder. If not indicated, the frames are
+                       saved only when streaming is False.
+                       save_frames=False requires streaming=True
+             storage: string, optional
+                       'fits' to save each frame in its own fits file,
+                       'h5' to append the frames to a single h5 container
+                       (frames.h5) in the tracking number folder
+             crop_to_pupil: boolean, optional
+                       if True frames and cube are stored cropped to the
+                       bounding box of the pupil, computed from pupil_mask
+                       or, if not indicated, from the first frame
+             pupil_mask: numpy array, optional
+                       boolean mask of the pupil (True outside) used to
+                       compute the region of interest
+             roi_margin: int, optional
+                       pixels added on each side of the pupil bounding box
+             cube_dtype: numpy dtype, optional
+                       float type of the cube (np.float32 or np.float64)
+                       used to create, save and load it
+             checkpoint_every: int, optional
+                       number of saved frames between two updates of the
+                       progress journal (journal.fits) used by resume;
+                       if not indicated, once per template sequence
+             snr_target: float, optional
+                       if indicated, after the n_rep repetitions the modes
+                       whose signal to noise ratio, estimated from the
+                       scatter between repetitions, is below snr_target
+                       are measured again, one pass at a time, until they
+                       reach it or max_rep repetitions
+             max_rep: int, optional
+                       maximum number of repetitions of a mode in the
+                       adaptive acquisition; if not indicated, 4 * n_rep
+             memory_budget: int, optional
+                       if indicated (in bytes), the cube is built from the
+                       frames in blocks of actuators fitting the budget and
+                       written directly to Cube.fits, which is then
+                       returned by getCube as a LazyCube.
+                       Not available with streaming
+             reference_every: int, optional
+                       if indicated, a reference frame at the baseline
+                       shape is measured before the first template
+                       sequence, after every reference_every sequences
+                       and at the end. The drift interpolated between
+                       the references is subtracted from each frame
+                       when the cube is created.
+                       Not available with streaming or snr_target
+             drift_model: string, optional
+                       model of the drift between two references
+                       ('linear')
 
         Returns
         -------
                 tt: string
                     tracking number of measurements made
         '''
+        if save_frames is None:
+            save_frames = not streaming
+        if not save_frames and not streaming:
+            raise ValueError('Frames must be saved when streaming is False')
+        if streaming and memory_budget is not None:
+            raise ValueError('memory_budget requires streaming=False')
+        if reference_every is not None:
+            if streaming or snr_target is not None:
+                raise ValueError('reference_every requires streaming=False '
+                                 'and snr_target=None')
+            if int(reference_every) < 1:
+                raise ValueError('reference_every must be positive')
+            if drift_model not in DriftCorrector.MODELS:
+                raise ValueError('Unknown drift model %s' % drift_model)
         amplitude, cmd_matrix = self._readTypeFromFitsNameTag(amplitude_tag,
                                                               cmd_matrix_tag)
-        type_of_cmd_matrix = self._checkIfCmdMatrixIsAZonalMatrix(cmd_matrix)
+        type_of_cmd_matrix = cmd_matrix.getType()
 
         self._nRepetitions = n_rep
         if template is None:
@@ -108,6 +218,22 @@ class IFMaker():
         indexing_input = copy.copy(self._actsVector)
         dove, tt = TtFolder(self._storageFolder()).createFolderToStoreMeasurements()
         self._tt = tt
+        self._folder = dove
+        self._repetitions = None
+        self._cropToPupil = crop_to_pupil
+        self._roi = None
+        self._fullFrameShape = None
+        if crop_to_pupil and pupil_mask is not None:
+            self._setRoi(pupil_mask, roi_margin)
+        self._roiMargin = roi_margin
+        self._cubeDtype = np.dtype(cube_dtype)
+        self._snrTarget = snr_target
+        self._maxRepetitions = None
+        self._parentTt = None
+        self._referenceEvery = reference_every
+        self._driftModel = None if reference_every is None else drift_model
+        if snr_target is not None:
+            self._maxRepetitions = 4 * n_rep if max_rep is None else max_rep
 
         cmdH = CmdHistory(self._nActs)
         if shuffle is False:
@@ -116,32 +242,475 @@ class IFMaker():
                                                  amplitude,
                                                  cmd_matrix,
                                                  n_rep,
-                                                 template)
+                                                 template,
+                                                 lazy=True)
         if shuffle is True:
             command_history_matrix_to_apply, self._tt_cmdH = \
                     cmdH.shuffleCommandHistoryMaker(indexing_input,
                                                     amplitude,
                                                     cmd_matrix,
                                                     n_rep,
-                                                    template)
+                                                    template,
+                                                    lazy=True)
         self._indexingList = cmdH.getIndexingList()
 
-        n_images = 1
-        pos = self._dm.get_shape()
-        for i in range(command_history_matrix_to_apply.shape[1]):
-            self._dm.set_shape(pos + command_history_matrix_to_apply[:, i])
-            masked_image = self._interf.wavefront(n_images)
-            file_name = 'image_%04d.fits' %i
-            temp.interf_save_phasemap(dove, file_name, masked_image)
-
-        self._dm.set_shape(np.zeros(self._nActs))
+        reducer = None
+        if streaming or snr_target is not None:
+            reducer = StreamingReducer(self._indexingList, self._amplitude,
+                                       self._template, self._actsVector,
+                                       self._cubeDtype)
+        storage = storage if save_frames else None
+        baseline = np.array(self._dm.get_shape())
+        journal = None
+        if storage is not None:
+            journal = self._startJournal(
+                storage, baseline, command_history_matrix_to_apply.shape[1],
+                checkpoint_every)
+        self._acquireFrames(command_history_matrix_to_apply, reducer, storage,
+                            pipelined, queue_size, n_writers, journal)
+        if snr_target is not None:
+            self._acquireAdaptiveRepetitions(reducer, storage, shuffle,
+                                             baseline, pipelined, queue_size,
+                                             n_writers)
 
         #import code
         #code.interact(local=dict(globals(), **locals()))
-        cube = self._createCube()
+        if streaming:
+            self._cube = reducer.getCube()
+            self._variance = reducer.getVariance()
+            self._saveCube('Cube.fits')
+        elif memory_budget is not None:
+            self._createCubeOnDisk('Cube.fits', memory_budget)
+        else:
+            self._createCube()
+            self._saveCube('Cube.fits')
+        return tt
+
+    def remeasureActuators(self, tt, act_list, n_rep=None, shuffle=False,
+                           pipelined=False, queue_size=8, n_writers=1,
+                           storage='fits', checkpoint_every=None):
+        '''
+        Measures again only some modes of an influence functions
+        acquisition, with its amplitude, template and region of interest,
+        and creates a new cube in which their slices replace the ones of
+        the parent cube
+
+        Parameters
+        ----------
+             tt: string
+                 tracking number of the parent influence functions
+             act_list: list or numpy array
+                 modes (actuators for a zonal command matrix) to measure
+        Other Parameters
+        ----------------
+             n_rep: int, optional
+                 number of repetitions; if not indicated, the one of the
+                 parent
+             shuffle, pipelined, queue_size, n_writers, storage,
+             checkpoint_every:
+                 same of acquisitionAndAnalysis
+
+        Returns
+        -------
+                tt: string
+                    tracking number of the new cube, whose header
+                    records the parent (PARENT)
+        '''
+        parent = IFMaker.loadInfoFromIFMaker(tt)
+        act_list = np.array(act_list, dtype=int)
+        if parent._nActs != self._nActs:
+            raise ValueError('Acquisition %s was made with %d actuators, '
+                             'the DM has %d' % (tt, parent._nActs,
+                                                self._nActs))
+        if act_list.size == 0 or \
+                not np.all(np.isin(act_list, parent._actsVector)):
+            raise ValueError('Modes %s not in the cube %s' % (act_list, tt))
+        if np.unique(act_list).size != act_list.size:
+            raise ValueError('Repeated modes in %s' % act_list)
+        self._amplitude, self._cmdMatrix = self._readTypeFromFitsNameTag(
+            parent._amplitudeTag, parent._cmdMatrixTag)
+        self._nRepetitions = parent._nRepetitions if n_rep is None else n_rep
+        self._template = np.array(parent._template)
+        self._amplitudeTag = parent._amplitudeTag
+        self._cmdMatrixTag = parent._cmdMatrixTag
+        self._type_of_cmd_matrix = parent._type_of_cmd_matrix
+        self._actsVector = np.array(parent._actsVector)
+        self._cubeDtype = parent._cubeDtype
+        self._cropToPupil = parent._roi is not None
+        self._roi = parent._roi
+        self._fullFrameShape = parent._fullFrameShape
+        self._roiMargin = 0
+        self._repetitions = None
+        self._snrTarget = None
+        self._maxRepetitions = None
+        self._parentTt = tt
+        self._referenceEvery = None
+        self._driftModel = None
+        self._folder, self._tt = \
+            TtFolder(self._storageFolder()).createFolderToStoreMeasurements()
+
+        cmdH = CmdHistory(self._nActs)
+        if shuffle is True:
+            make_command_history = cmdH.shuffleCommandHistoryMaker
+        else:
+            make_command_history = cmdH.tidyCommandHistoryMaker
+        command_history_matrix_to_apply, self._tt_cmdH = make_command_history(
+            act_list.copy(), self._amplitude[act_list], self._cmdMatrix,
+            self._nRepetitions, self._template, lazy=True)
+        self._indexingList = np.array(cmdH.getIndexingList())
+
+        journal = self._startJournal(
+            storage, np.array(self._dm.get_shape()),
+            command_history_matrix_to_apply.shape[1], checkpoint_every)
+        self._acquireFrames(command_history_matrix_to_apply, None, storage,
+                            pipelined, queue_size, n_writers, journal)
+        self._createCube()
+        self._saveCube('Cube.fits')
+        return self._tt
+
+    def getParentTrackingNumber(self):
+        '''
+        Returns
+        -------
+                tt: string
+                    tracking number of the cube whose slices were
+                    replaced by remeasureActuators, None if the cube
+                    was measured from scratch
+        '''
+        return self._parentTt
+
+    def getMergedTrackingNumbers(self):
+        '''
+        Returns
+        -------
+                tt_list: list
+                    tracking numbers averaged in this cube by
+                    cubeMerging.mergeCubes, None if not a merged cube
+        '''
+        return self._mergedTts
+
+    def getRemeasuredModes(self):
+        '''
+        Returns
+        -------
+                modes: numpy array
+                    modes measured in this tracking number (all the modes
+                    of the cube if it has no parent)
+        '''
+        return np.unique(modeSequence(self._indexingList))
+
+    def _checkpointPeriod(self, checkpoint_every):
+        ''' Frames between two journal updates: by default a template
+        sequence, so that the journal is not written after every frame '''
+        if checkpoint_every is None:
+            return self._template.size
+        return checkpoint_every
+
+    def _startJournal(self, storage, baseline, n_frames, checkpoint_every):
+        journal = AcquisitionJournal(
+            self._folder, self._journalHeader(storage), baseline, n_frames,
+            checkpoint_every=self._checkpointPeriod(checkpoint_every))
+        journal.flush()
+        return journal
+
+    def resume(self, tt, pipelined=False, queue_size=8, n_writers=1,
+               checkpoint_every=None):
+        '''
+        Continues an interrupted acquisition from the first frame missing
+        in its progress journal (from the first frame after the last
+        reference, for acquisitions with reference frames), on the DM
+        baseline recorded in it, and creates the cube from the complete
+        set of frames of the command history. The extra passes of an adaptive
+        acquisition are not journaled and are not measured again.
+
+        Parameters
+        ----------
+             tt: string
+                 tracking number of the interrupted acquisition
+        Other Parameters
+        ----------------
+             pipelined, queue_size, n_writers, checkpoint_every:
+                 same of acquisitionAndAnalysis
+
+        Returns
+        -------
+                tt: string
+                    tracking number of measurements made
+        '''
+        folder = os.path.join(self._storageFolder(), tt)
+        journal = AcquisitionJournal.load(folder)
+        header = journal.getHeader()
+        cmdH = CmdHistory.load(header['TT_CMDH'])
+        if header['NACTS'] != self._nActs:
+            raise ValueError('Acquisition %s was made with %d actuators, '
+                             'the DM has %d' % (tt, header['NACTS'],
+                                                self._nActs))
+        self._tt = tt
+        self._folder = folder
+        self._nRepetitions = header['NREP']
+        self._tt_cmdH = header['TT_CMDH']
+        self._amplitudeTag = header['AMPTAG']
+        self._cmdMatrixTag = header['CMDMTAG']
+        self._amplitude, self._cmdMatrix = self._readTypeFromFitsNameTag(
+            self._amplitudeTag, self._cmdMatrixTag)
+        self._type_of_cmd_matrix = header['TYPECMD']
+        self._template = np.array(
+            [int(k) for k in header['TEMPLATE'].split(',')])
+        self._cubeDtype = np.dtype(header['CUBEDTYP'])
+        self._cropToPupil = header['CROP']
+        self._roiMargin = header['ROIMARG']
+        self._roi = None
+        self._fullFrameShape = None
+        if 'ROIY0' in header:
+            self._roi = (header['ROIY0'], header['ROIX0'],
+                         header['ROINY'], header['ROINX'])
+            self._fullFrameShape = (header['FULLNY'], header['FULLNX'])
+        self._actsVector = np.arange(self._nActs)
+        self._indexingList = np.array(cmdH.getIndexingList())
+        self._repetitions = None
+        self._snrTarget = None
+        self._maxRepetitions = None
+        self._parentTt = header.get('PARENT')
+        self._referenceEvery = header.get('REFEVERY')
+        self._driftModel = header.get('DRIFTMOD')
+        journal.setCheckpointEvery(self._checkpointPeriod(checkpoint_every))
+        command_history_matrix_to_apply = self._passCommandHistory(
+            modeSequence(self._indexingList))
+        if command_history_matrix_to_apply.shape[1] != \
+                journal.getNumberOfFrames():
+            raise ValueError('Command history %s has %d frames, journal of '
+                             '%s expects %d' % (
+                                 header['TT_CMDH'],
+                                 command_history_matrix_to_apply.shape[1],
+                                 tt, journal.getNumberOfFrames()))
+
+        self._acquireFrames(command_history_matrix_to_apply, None,
+                            header['STORAGE'], pipelined, queue_size,
+                            n_writers, journal)
+        self._createCube()
         self._saveCube('Cube.fits')
         return tt
 
+    def _acquireAdaptiveRepetitions(self, reducer, storage, shuffle,
+                                    baseline, pipelined, queue_size,
+                                    n_writers):
+        '''
+        Measures again, one pass at a time, the modes whose signal to
+        noise ratio is below the target. Each pass is appended to the
+        indexing list as a row padded with -1.
+        '''
+        while True:
+            counts = reducer.getRepetitionCounts()
+            snr = reducer.getSnr()
+            modes = self._actsVector[(snr < self._snrTarget) &
+                                     (counts < self._maxRepetitions)]
+            if modes.size == 0:
+                return
+            if shuffle is True:
+                np.random.shuffle(modes)
+            first_index = reducer.getNumberOfFrames()
+            reducer.appendModes(modes)
+            row = np.full(self._indexingList.shape[1], -1)
+            row[:modes.size] = modes
+            self._indexingList = np.vstack((self._indexingList, row))
+            self._acquireFrames(self._passCommandHistory(modes), reducer,
+                                storage, pipelined, queue_size, n_writers,
+                                baseline=baseline, first_index=first_index)
+
+    def _passCommandHistory(self, modes):
+        '''
+        Parameters
+        ----------
+                modes: numpy array
+                    modes in the order in which they are applied
+
+        Returns
+        -------
+                matrix_to_apply: LazyCmdHistory
+                    command history [nActs, modes.size x template.size]
+                    of the template sequences of the modes
+        '''
+        return LazyCmdHistory(modes, self._amplitude[modes], self._cmdMatrix,
+                              self._template)
+
+    def _journalHeader(self, storage):
+        header = self._cubeHeader()
+        header['STORAGE'] = storage
+        header['TEMPLATE'] = ','.join(str(k) for k in self._template)
+        header['CROP'] = self._cropToPupil
+        header['ROIMARG'] = self._roiMargin
+        return header
+
+    def _acquireFrames(self, command_history_matrix_to_apply, reducer,
+                       storage, pipelined, queue_size, n_writers,
+                       journal=None, baseline=None, first_index=0):
+        '''
+        Applies the command history saving the frames in the storage
+        ('fits', 'h5' or None not to save them) and passing them to
+        the reducer (if not None). The frames saved are recorded in the
+        journal (if not None), from whose first missing frame the
+        command history is applied around the journal baseline.
+        Frames are numbered from first_index.
+        '''
+        if storage is None:
+            self._applyCommandHistory(
+                command_history_matrix_to_apply,
+                self._frameConsumer(None, reducer, first_index), baseline)
+            return
+        if storage == 'h5':
+            n_writers = 1
+        start = 0
+        if journal is not None:
+            baseline = journal.getBaseline()
+            start = journal.getNextFrameIndex()
+        reference_period = None
+        if self._referenceEvery is not None:
+            reference_period = self._referenceEvery * self._template.size
+            last = min(start, command_history_matrix_to_apply.shape[1] - 1)
+            start = last // reference_period * reference_period
+        self._journal = journal
+        try:
+            with temp.openFrameStorage(self._folder, storage, 'a') as frames, \
+                    self._openReferenceStorage(storage) as references:
+                save_frame = self._journaledSave(frames, journal)
+                if journal is not None:
+                    # frames reach the disk only when a checkpoint is written
+                    journal.setFlushFunction(frames.flush)
+                store_reference = None
+                if references is not None:
+                    store_reference = references.save
+                if pipelined:
+                    with FrameWriter(save_frame, queue_size,
+                                     n_writers) as writer:
+                        self._applyCommandHistory(
+                            command_history_matrix_to_apply,
+                            self._frameConsumer(writer.put, reducer,
+                                                first_index),
+                            baseline, start, store_reference,
+                            reference_period)
+                else:
+                    self._applyCommandHistory(
+                        command_history_matrix_to_apply,
+                        self._frameConsumer(save_frame, reducer,
+                                            first_index),
+                        baseline, start, store_reference, reference_period)
+        finally:
+            self._journal = None
+            if journal is not None:
+                # the storage is closed: its frames are on disk
+                journal.setFlushFunction(None)
+                journal.flush()
+
+    @staticmethod
+    def _journaledSave(frames, journal):
+        if journal is None:
+            return frames.save
+
+        def save(index, masked_image):
+            frames.save(index, masked_image)
+            journal.frameSaved(index)
+        return save
+
+    def _referenceFolder(self):
+        return os.path.join(self._folder, 'references')
+
+    def _openReferenceStorage(self, storage):
+        if self._referenceEvery is None:
+            return contextlib.nullcontext()
+        os.makedirs(self._referenceFolder(), exist_ok=True)
+        return temp.openFrameStorage(self._referenceFolder(), storage, 'a')
+
+    def _applyCommandHistory(self, command_history_matrix_to_apply,
+                             store_frame, baseline=None, start=0,
+                             store_reference=None, reference_period=None):
+        '''
+        Applies the command history from the frame of index start to the
+        DM, around baseline (if not indicated, the current DM shape), and
+        passes each measured frame to store_frame(index, masked_image).
+        If reference_period is indicated, a frame at the baseline is
+        measured every reference_period frames and at the end, and passed
+        to store_reference(reference_index, masked_image).
+        '''
+        n_images = 1
+        n_frames = command_history_matrix_to_apply.shape[1]
+        pos = self._dm.get_shape() if baseline is None else baseline
+        try:
+            for i in range(start, n_frames):
+                if reference_period is not None and i % reference_period == 0:
+                    self._measureReference(pos, i // reference_period,
+                                           store_reference)
+                self._dm.set_shape(pos + command_history_matrix_to_apply[:, i])
+                masked_image = self._interf.wavefront(n_images)
+                store_frame(i, self._cropFrame(masked_image))
+            if reference_period is not None and start < n_frames:
+                self._measureReference(pos, -(-n_frames // reference_period),
+                                       store_reference)
+        finally:
+            self._dm.set_shape(np.zeros(self._nActs))
+
+    def _measureReference(self, baseline, index, store_reference):
+        self._dm.set_shape(baseline)
+        store_reference(index, self._cropFrame(self._interf.wavefront(1)))
+
+    def _openFrameReader(self):
+        '''
+        Returns
+        -------
+                reader: FrameReader or DriftCorrector
+                    callable reading the frames by index, with the drift
+                    subtracted if the acquisition has reference frames
+        '''
+        reader = temp.FrameReader(self._folder)
+        if self._referenceEvery is None:
+            return reader
+        n_frames = modeSequence(self._indexingList).size * self._template.size
+        return DriftCorrector(reader, temp.FrameReader(self._referenceFolder()),
+                              self._template.size, self._referenceEvery,
+                              n_frames, self._driftModel)
+
+    def _setRoi(self, pupil_mask, margin=0):
+        self._fullFrameShape = np.shape(pupil_mask)
+        self._roi = geo.pupilRoi(pupil_mask, margin)
+
+    def _cropFrame(self, masked_image):
+        ''' Crops the frame to the pupil region of interest, computed from
+        the first frame if not known yet '''
+        if not self._cropToPupil:
+            return masked_image
+        if self._roi is None:
+            self._setRoi(np.ma.getmaskarray(masked_image), self._roiMargin)
+            if self._journal is not None:
+                self._journal.update(**self._roiKeywords())
+        return geo.cropToRoi(masked_image, self._roi)
+
+    def getCubeDtype(self):
+        '''
+        Returns
+        -------
+                dtype: numpy dtype
+                    float type of the cube
+        '''
+        return self._cubeDtype
+
+    def getRoi(self):
+        '''
+        Returns
+        -------
+                roi: tuple
+                    (y0, x0, ny, nx) region of interest of frames and cube
+                    in the full interferometer frame, None if not cropped
+        '''
+        return self._roi
+
+    @staticmethod
+    def _frameConsumer(save_frame, reducer, first_index=0):
+        def consume(index, masked_image):
+            index = index + first_index
+            if save_frame is not None:
+                save_frame(index, masked_image)
+            if reducer is not None:
+                reducer.addFrame(index, masked_image)
+        return consume
 
     def _readTypeFromFitsNameTag(self, amplitude_fits_file_name,
                                  cmd_matrix_fits_file_name):
@@ -157,177 +726,103 @@ class IFMaker():
         -------
             amplitude: numpy array
                     vector with mode amplitude
-            cmd_matrix: numpy array [nActs x nModes]
-                        matrix of mode commands
-                        diagonal matrix in case of zonal commands
+            cmd_matrix: CommandMatrix
+                        matrix of mode commands [nActs x nModes],
+                        classified as zonal, diagonal, hadamard or dense
         '''
         ma = ModalAmplitude.loadFromFits(amplitude_fits_file_name)
         amplitude = ma.getModalAmplitude()
 
         mb = ModalBase.loadFromFits(cmd_matrix_fits_file_name)
-        cmd_matrix = mb.getModalBase()
+        cmd_matrix = mb.getCommandMatrix()
         return amplitude, cmd_matrix
     
-    def _isDiagonal(self, matrix):
+    def _createCube(self, n_workers=1):
         '''
         Parameters
         ----------
-        matrix: numpy array
-            matrix to be tested
-    
-        Returns
-        -------
-        bool: True if matrix is diagonal
-        '''
-        # Controlla se la matrice è quadrata
-        if len(matrix) != len(matrix[0]):
-            return False
-        
-        # Itera su tutti gli elementi della matrice
-        for i in range(len(matrix)):
-            for j in range(len(matrix[i])):
-                if i != j and matrix[i][j] != 0:
-                    return False
-        return True
-    
-    def _checkIfCmdMatrixIsAZonalMatrix(self, cmd_matrix):
-        '''
-        Parameters
-        ----------
-        cmd_matrix: numpy array
-            matrix to be tested
-            
+                n_workers: int, optional
+                    number of processes reading the frames
+
         Returns
         -------
-        string: string
-            'zonal' or 'hadamard'
+                cube = masked array [pixels, pixels, number of images]
+                        cube from analysis
+
+        The per-pixel variance of the repetitions is kept too
+        (see getVariance). The slices of a cube with a parent are
+        spliced into the parent cube.
         '''
-        if self._isDiagonal(cmd_matrix):
-            string = 'zonal'
+        if self._parentTt is None:
+            acts_vector = self._actsVector
         else:
-            string = 'hadamard'
-        return string
+            acts_vector = self.getRemeasuredModes()
+        engine = CubeEngine(self._indexingList, self._amplitude,
+                            self._template, acts_vector,
+                            self._repetitions, self._cubeDtype)
+        with self._openFrameReader() as reader:
+            self._cube, self._variance = engine.buildCubeInParallel(
+                reader, n_workers, with_variance=True)
+        if self._parentTt is not None:
+            self._spliceIntoParent(acts_vector)
+        return self._cube
 
-    def _createCube(self):
+    def _spliceIntoParent(self, modes):
+        parent = IFMaker.loadAnalyzerFromIFMaker(
+            self._parentTt, os.path.dirname(self._folder))
+        slots = np.array([np.flatnonzero(self._actsVector == mode)[0]
+                          for mode in modes])
+        cube = parent.getCube()
+        cube[:, :, slots] = self._cube
+        variance = parent.getVariance()
+        if variance is None:
+            variance = np.ma.masked_all(cube.shape, dtype=self._cubeDtype)
+        variance[:, :, slots] = self._variance
+        self._cube = cube
+        self._variance = variance
+
+    def _createCubeOnDisk(self, cube_name, memory_budget, n_workers=1):
         '''
+        Builds the cube in blocks of actuators fitting memory_budget and
+        writes them in the preallocated cube file, through actuator-major
+        scratch files moved there in bands of pixel rows
+
         Parameters
         ----------
-                tt: string
+                cube_name: string
+                    name of the cube file (example 'Cube.fits')
+                memory_budget: int
+                    bytes available for the blocks being built
+                n_workers: int, optional
+                    number of processes reading the frames
 
         Returns
         -------
-                cube = masked array [pixels, pixels, number of images]
-                        cube from analysis
+                cube: LazyCube
+                    cube memory-mapped from the file written
         '''
-
-        #cube_all_act = None
-        where = self._indexReorganization(self._indexingList, self._actsVector,
-                                          self._nRepetitions)
-        ampl_reorg = self._amplitudeReorganization(self._actsVector,
-                                                   self._indexingList,
-                                                   self._amplitude,
-                                                   self._nRepetitions)
-
-        cube_all_act = []
-        for i in range(self._actsVector.shape[0]):
-            print(i)
-            for k in range(self._nRepetitions):
-                p = self._nRepetitions * i + k
-                n = where[p]
-                mis_amp = k* self._indexingList.shape[1] + n
-                mis = (k * self._indexingList.shape[1]+ n) * self._template.shape[0]
-                #mis_pull = self._template.shape[0] + mis_push
-                #mis_list = [mis_push, mis_pull]
-                print(mis)
-
-                #pp_images = []
-                name = 'image_%04d.fits' %mis
-                print(name)
-                file_name = os.path.join(self._storageFolder(), self._tt, name)
-                image0 = temp.interf_readImage(file_name) 
-                image_list = [image0]
-                for l in range(1, self._template.size):
-                    name = 'image_%04d.fits' %(mis+l)
-                    print(name)
-                    file_name = os.path.join(self._storageFolder(), self._tt, name)
-                    ima = temp.interf_readImage(file_name)
-                    image_list.append(ima)
-
-                image = np.zeros((image0.shape[0], image0.shape[1]))
-                for p in range(1, len(image_list)):
-                    opd2add = image_list[p] * self._template[p] + image_list[p-1] * self._template[p-1]
-                    master_mask2add = np.ma.mask_or(image_list[p].mask, image_list[p-1].mask)
-                    if p == 1:
-                        master_mask = master_mask2add
-                    else:
-                        master_mask = np.ma.mask_or(master_mask, master_mask2add)
-                    image += opd2add
-                image = np.ma.masked_array(image, mask=master_mask)
-                img_if = image / (2 * ampl_reorg[mis_amp] * (self._template.shape[0] - 1))
-                img_if = img_if - np.ma.median(img_if)
-
-                if_push_pull_kth = img_if
-
-                if k == 0:
-                    all_push_pull_act_jth = if_push_pull_kth
-                else:
-                    all_push_pull_act_jth = np.ma.dstack((all_push_pull_act_jth,
-                                                          if_push_pull_kth))
-
-            if self._nRepetitions == 1:
-                if_act_jth = all_push_pull_act_jth
-            else:
-                if_act_jth = np.ma.mean(all_push_pull_act_jth, axis=2)
-
-            cube_all_act.append(if_act_jth)
-#             if cube_all_act is None:
-#                 cube_all_act = if_act_jth
-#             else:
-#                 cube_all_act = np.ma.dstack((cube_all_act, if_act_jth))
-        self._cube = np.ma.dstack(cube_all_act)
-
+        if self._parentTt is not None:
+            raise ValueError('Cubes with a parent are built in memory')
+        file_name = os.path.join(self._folder, cube_name)
+        engine = CubeEngine(self._indexingList, self._amplitude,
+                            self._template, self._actsVector,
+                            self._repetitions, self._cubeDtype)
+        with_variance = engine.getFrameIndexes().shape[1] >= 2
+        with self._openFrameReader() as reader:
+            shape = engine.readFrameShape(reader) + (self._actsVector.size,)
+            with FitsCubeFile(file_name, shape, self._cubeDtype,
+                              self._cubeHeader(), self._cubeExtensions(),
+                              with_variance, memory_budget) as cube_file:
+                engine.buildCubeOnDisk(reader, cube_file.writeBlock,
+                                       memory_budget, n_workers,
+                                       with_variance)
+        self._cube = LazyCube(file_name)
+        self._variance = None
         return self._cube
 
-    def _indexReorganization(self, indexingList, actsVector, nPushPull):
-        """ Returns the index position """
-        indv = np.array(indexingList)
-        where = []
-        for ind in range(actsVector.shape[0]):
-            for j in range(nPushPull):
-                a = np.where(indv[j] == ind)
-                where.append(a[0][0])
-        return where
-
-    def _amplitudeReorganization(self, indexing_input, indexing_list,
-                                 amplitude, n_push_pull):
-        '''
-            Args:
-                indexing_input = vector of selected modes for carrying out
-                                 the influence functions
-
-                indexing_list = tuple indicating how the modes were applied
-
-                amplitude = amplitude of applied modes
-
-            Returns:
-                vect = vector (amp.shape x n_push_pull.shape) with the
-                        amplitudes ordered in the same way as indexing_list
-
-        '''
-        where = []
-        for i in indexing_input:
-            for j in range(n_push_pull):
-                a = np.where(indexing_list[j] == i)
-                where.append(a)
-        where = np.array(where)
-        vect = np.zeros(amplitude.shape[0]*n_push_pull)
-
-        for i in range(amplitude.shape[0]):
-            for k in range(n_push_pull):
-                p = n_push_pull * i + k
-                indvect = where[p]+ indexing_input.shape[0] * k
-                vect[indvect] = amplitude[i]
-        return vect
+    def _cubeExtensions(self):
+        return [self._amplitude, self._actsVector, self._template,
+                self._indexingList]
 
     def _saveCube(self, cube_name):
         """
@@ -336,9 +831,41 @@ class IFMaker():
                 cube_name: string
                             name to save the cube
                             example 'Cube.fits'
+
+        The cube is written in a temporary file that replaces
+        cube_name only when it is complete.
         """
-        dove = os.path.join(self._storageFolder(), self._tt)
-        file_name = os.path.join(dove, cube_name)
+        file_name = os.path.join(self._folder, cube_name)
+        header = self._cubeHeader()
+        hduList = pyfits.HDUList([
+            pyfits.PrimaryHDU(self._cube.data.astype(self._cubeDtype,
+                                                     copy=False), header),
+            temp.maskToHDU(np.ma.getmaskarray(self._cube), packed=False)] +
+            [pyfits.ImageHDU(extension)
+             for extension in self._cubeExtensions()])
+        if self._variance is not None and \
+                not np.all(np.ma.getmaskarray(self._variance)):
+            hduList.append(pyfits.ImageHDU(
+                np.ma.filled(self._variance, np.nan).astype(self._cubeDtype,
+                                                            copy=False),
+                name='VARIANCE'))
+        tmp_file_name = temp.temporaryFileName(self._folder)
+        try:
+            hduList.writeto(tmp_file_name, overwrite=True)
+            os.replace(tmp_file_name, file_name)
+        except BaseException:
+            os.remove(tmp_file_name)
+            raise
+
+    def _roiKeywords(self):
+        keywords = {}
+        if self._roi is not None:
+            keywords['ROIY0'], keywords['ROIX0'], keywords['ROINY'], \
+                keywords['ROINX'] = self._roi
+            keywords['FULLNY'], keywords['FULLNX'] = self._fullFrameShape
+        return keywords
+
+    def _cubeHeader(self):
         header = pyfits.Header()
         header['NREP'] = self._nRepetitions
         header['TT_CMDH'] = self._tt_cmdH
@@ -346,30 +873,57 @@ class IFMaker():
         header['AMPTAG'] = self._amplitudeTag
         header['NACTS'] = self._nActs
         header['TYPECMD'] = self._type_of_cmd_matrix
-        pyfits.writeto(file_name, self._cube.data, header)
-        pyfits.append(file_name, self._cube.mask.astype(int))
-        pyfits.append(file_name, self._amplitude)
-        pyfits.append(file_name, self._actsVector)
-        pyfits.append(file_name, self._template)
-        pyfits.append(file_name, self._indexingList)
+        header['CUBEDTYP'] = self._cubeDtype.name
+        if self._parentTt is not None:
+            header['PARENT'] = self._parentTt
+        if self._mergedTts is not None:
+            header['MERGED'] = ','.join(self._mergedTts)
+        if self._referenceEvery is not None:
+            header['REFEVERY'] = self._referenceEvery
+            header['DRIFTMOD'] = self._driftModel
+        if self._snrTarget is not None:
+            header['SNRTGT'] = self._snrTarget
+            header['MAXREP'] = self._maxRepetitions
+        if self._repetitions is not None:
+            header['REPSUSED'] = ','.join(str(k) for k in self._repetitions)
+        for key, value in self._roiKeywords().items():
+            header[key] = value
+        return header
 
     def getCube(self):
         '''
         Returns
         -------
                 cube: masked array [pixels, pixels, number of images]
-                    cube from analysis
+                    cube from analysis (LazyCube if loaded with lazy=True)
         '''
         return self._cube
 
+    def getVariance(self):
+        '''
+        Returns
+        -------
+                variance: masked array [pixels, pixels, number of images]
+                    per-pixel variance of the repetitions of each
+                    influence function, masked where less than two
+                    repetitions are valid; None if not available
+                    (cubes saved before the variance was introduced)
+        '''
+        if self._variance is None and isinstance(self._cube, LazyCube):
+            return self._cube.getVariance()
+        return self._variance
+
     @staticmethod
-    def loadAnalyzerFromIFMaker(tt, storageFolder=None):
-        """ Creates the object using information contained in Cube
+    def loadInfoFromIFMaker(tt, storageFolder=None):
+        """ Creates the object using the information contained in Cube
+        without reading the cube data
 
         Parameters
         ----------
-                fits_file_name: string
-                                cube file name path
+                tt: string
+                    tracking number of the influence functions
+                storageFolder: string, optional
+                    root folder of the tracking numbers
 
         Returns
         -------
@@ -377,21 +931,42 @@ class IFMaker():
                             analyzerIFF class object
         """
         theObject = IFMaker(None, None)
-        file_name = os.path.join(theObject._storageFolder(), tt, 'Cube.fits')
-        if storageFolder is not None:
-            file_name = os.path.join(storageFolder, tt, 'Cube.fits')
-        header = pyfits.getheader(file_name, ignore_missing_simple=True)
-        hduList = pyfits.open(file_name)
-        theObject._cube = np.ma.masked_array(hduList[0].data,
-                                             hduList[1].data.astype(bool))
-        theObject._amplitude = hduList[2].data
-        theObject._actsVector = hduList[3].data
-        theObject._template = hduList[4].data
-        theObject._indexingList = hduList[5].data
+        if storageFolder is None:
+            storageFolder = theObject._storageFolder()
+        theObject._tt = tt
+        theObject._folder = os.path.join(storageFolder, tt)
+        file_name = os.path.join(theObject._folder, 'Cube.fits')
+        with pyfits.open(file_name, memmap=False,
+                         ignore_missing_simple=True) as hduList:
+            header = hduList[0].header
+            theObject._amplitude = hduList[2].data
+            theObject._actsVector = hduList[3].data
+            theObject._template = hduList[4].data
+            theObject._indexingList = hduList[5].data
         try:
             theObject._nRepetitions = header['NREP']
         except KeyError:
             theObject._nRepetitions = 1
+        if 'CUBEDTYP' in header:
+            theObject._cubeDtype = np.dtype(header['CUBEDTYP'])
+        else:
+            theObject._cubeDtype = np.dtype(np.float32) \
+                if header['BITPIX'] == -32 else np.dtype(np.float64)
+        if 'ROIY0' in header:
+            theObject._roi = (header['ROIY0'], header['ROIX0'],
+                              header['ROINY'], header['ROINX'])
+            theObject._fullFrameShape = (header['FULLNY'], header['FULLNX'])
+        theObject._parentTt = header.get('PARENT')
+        if 'MERGED' in header:
+            theObject._mergedTts = header['MERGED'].split(',')
+        theObject._referenceEvery = header.get('REFEVERY')
+        theObject._driftModel = header.get('DRIFTMOD')
+        if 'SNRTGT' in header:
+            theObject._snrTarget = header['SNRTGT']
+            theObject._maxRepetitions = header['MAXREP']
+        if 'REPSUSED' in header:
+            theObject._repetitions = np.array(
+                [int(k) for k in header['REPSUSED'].split(',')])
 
         theObject._nActs = header['NACTS']
         theObject._tt_cmdH = header['TT_CMDH']
@@ -399,3 +974,37 @@ class IFMaker():
         theObject._amplitudeTag = header['AMPTAG']
         theObject._type_of_cmd_matrix = header['TYPECMD']
         return theObject
+
+    @staticmethod
+    def loadAnalyzerFromIFMaker(tt, storageFolder=None, lazy=False):
+        """ Creates the object using information contained in Cube
+
+        Parameters
+        ----------
+                tt: string
+                    tracking number of the influence functions
+                storageFolder: string, optional
+                    root folder of the tracking numbers
+                lazy: boolean, optional
+                    if True the cube is memory-mapped as a LazyCube and
+                    actuator slices are read from disk only when requested
+
+        Returns
+        -------
+                theObject: object
+                            analyzerIFF class object
+        """
+        theObject = IFMaker.loadInfoFromIFMaker(tt, storageFolder)
+        file_name = os.path.join(theObject._folder, 'Cube.fits')
+        if lazy:
+            theObject._cube = LazyCube(file_name)
+            return theObject
+        with pyfits.open(file_name, memmap=False,
+                         ignore_missing_simple=True) as hduList:
+            theObject._cube = np.ma.masked_array(
+                np.asarray(hduList[0].data, dtype=theObject._cubeDtype),
+                temp.maskFromHDU(hduList[1]))
+            if 'VARIANCE' in hduList:
+                theObject._variance = np.ma.masked_invalid(np.asarray(
+                    hduList['VARIANCE'].data, dtype=theObject._cubeDtype))
+        return theObject
@@ -10,6 +10,7 @@ import h5py
 import numpy as np
 from plico_dm_characterization.ground.tracking_number_folder import TtFolder
 from plico_dm_characterization.configuration import config
+from plico_dm_characterization.type.commandMatrix import CommandMatrix
 
 
 class CmdHistory():
@@ -35,16 +36,30 @@ class CmdHistory():
         self._indexingList = None
         self._cmdSequence = None
         self._cmdHToApply = None
+        self._lazyCmdHistory = None
 
     def getCommandHistory(self):
         '''
         Returns
         -------
         ccmdHToApply: numpy array
-                    command history matrix to apply
+                    command history matrix to apply, built from the lazy
+                    command history if it was not built yet
         '''
+        if self._cmdHToApply is None and self._lazyCmdHistory is not None:
+            self._cmdHToApply = self._lazyCmdHistory.toDense()
         return self._cmdHToApply
 
+    def getLazyCommandHistory(self):
+        '''
+        Returns
+        -------
+        lazyCmdH: LazyCmdHistory
+                    command history computing the commands on request;
+                    None for command histories loaded from legacy files
+        '''
+        return self._lazyCmdHistory
+
     def getIndexingList(self):
         '''
         Returns
@@ -62,7 +77,7 @@ class CmdHistory():
 
 
     def tidyCommandHistoryMaker(self, mode_vector, amp_vector,
-                                cmd_matrix, n_rep, template=None):
+                                cmd_matrix, n_rep, template=None, lazy=False):
         '''
         Parameters
         ----------
@@ -70,7 +85,7 @@ class CmdHistory():
                          Mode or actuator index vector to apply
             ampVector: numpy array
                         amplitude mode vector
-            cmdMatrix: numpy array [nActs x nModes]
+            cmdMatrix: numpy array [nActs x nModes] or CommandMatrix
                         mode command matrix
                         diagonal matrix in case of zonal commands
             n_rep: int
@@ -80,6 +95,9 @@ class CmdHistory():
             template: numpy array  , optional
                     vector composed by 1 and -1
                     (es. np.array([1, -1, 1]))
+            lazy: boolean, optional
+                    if True the command history is returned as a
+                    LazyCmdHistory and the matrix is not built
         Returns
         -------
              matrixToApply: numpy array [nAct, nModes x n_rep x template.size]
@@ -88,20 +106,27 @@ class CmdHistory():
                  tracking number
         '''
         self._ampVect = amp_vector
-        self._cmdSequence = self._tidyCmdSequence(mode_vector, n_rep, cmd_matrix)
-        aa = np.arange(self._cmdSequence.shape[1])
-        bb = np.tile(amp_vector, n_rep)
-        zipped = zip(aa, bb)
-        self._cmdHToApply = self._cmdHistoryToApply(zipped, template)
+        self._template = self._templateOrDefault(template)
+        amplitude_sequence = np.tile(amp_vector, n_rep)
+        if lazy:
+            self._tidyIndexingList(mode_vector, n_rep, cmd_matrix)
+            history = self._lazyHistory(amplitude_sequence)
+        else:
+            self._cmdSequence = self._tidyCmdSequence(mode_vector, n_rep,
+                                                      cmd_matrix)
+            self._cmdHToApply = self._cmdHistoryToApply(amplitude_sequence,
+                                                        template)
+            history = self._cmdHToApply
         tt = self.saveInfo(0)
         self._logger.info('Creation of the ordered commandHistoryMatrix %s', tt)
         print(tt)
 
-        return self._cmdHToApply, tt
+        return history, tt
 
 
     def shuffleCommandHistoryMaker(self, mode_vector, amp_vector,
-                                   cmd_matrix, n_rep, template=None):
+                                   cmd_matrix, n_rep, template=None,
+                                   lazy=False):
         '''
         Parameters
         ----------
@@ -109,7 +134,7 @@ class CmdHistory():
                          Mode or actuator index vector to apply
             ampVector: numpy array
                         amplitude mode vector
-            cmdMatrix: numpy array [nActs x nModes]
+            cmdMatrix: numpy array [nActs x nModes] or CommandMatrix
                         mode command matrix
                         diagonal matrix in case of zonal commands
             n_rep: int
@@ -119,6 +144,9 @@ class CmdHistory():
             template: numpy array  , optional
                     vector composed by 1 and -1
                     (es. np.array([1, -1, 1]))
+            lazy: boolean, optional
+                    if True the command history is returned as a
+                    LazyCmdHistory and the matrix is not built
         Returns
         -------
              matrixToApply: numpy array [nAct, nModes x n_rep x template.size]
@@ -127,165 +155,196 @@ class CmdHistory():
                  tracking number
         '''
         self._ampVect = amp_vector
-        self._cmdSequence, self._indexingList = self._shuffleCmdSequence(
-            mode_vector, n_rep, cmd_matrix)
-        zipped = self._zippedAmplitude(amp_vector)
-        self._cmdHToApply = self._cmdHistoryToApply(zipped, template)
+        self._template = self._templateOrDefault(template)
+        if lazy:
+            self._indexingList = self._shuffleIndexingList(mode_vector, n_rep,
+                                                           cmd_matrix)
+        else:
+            self._cmdSequence, self._indexingList = self._shuffleCmdSequence(
+                mode_vector, n_rep, cmd_matrix)
+        amplitude_sequence = self._amplitudeReorganization(
+            self._modeVector, self._indexingList, amp_vector,
+            self._nRepetitions)
+        if lazy:
+            history = self._lazyHistory(amplitude_sequence)
+        else:
+            self._cmdHToApply = self._cmdHistoryToApply(amplitude_sequence,
+                                                        template)
+            history = self._cmdHToApply
         tt = self.saveInfo(0)
         self._logger.info('Creation of the shuffle commandHistoryMatrix %s', tt)
         print(tt)
 
-        return self._cmdHToApply, tt
+        return history, tt
 
-    def _shuffleCmdSequence(self, mode_vector, n_rep, cmd_matrix):
-        ''' Usa il numero di ripetioni e crea la sequenza dei comandi
+    @staticmethod
+    def _templateOrDefault(template):
+        if template is None:
+            return np.array((1, -1, 1))
+        return np.asarray(template)
+
+    def _lazyHistory(self, amplitude_sequence):
+        self._lazyCmdHistory = LazyCmdHistory(
+            self._indexingList.ravel(), amplitude_sequence, self._cmdMatrix,
+            self._template)
+        return self._lazyCmdHistory
+
+    def _shuffleIndexingList(self, mode_vector, n_rep, cmd_matrix):
+        ''' Usa il numero di ripetioni e crea la sequenza dei modi
         '''
         self._modeVector = copy.copy(mode_vector)
         self._nRepetitions = n_rep
-        self._cmdMatrix = cmd_matrix
-
-        n_frame = mode_vector.size * n_rep
-        matrix_for_seq = np.zeros((self._nActs, n_frame))
+        self._cmdMatrix = self._toCommandMatrix(cmd_matrix)
 
         indexingList = []
         for j in range(n_rep):
             np.random.shuffle(mode_vector)
             indexingList.append(list(mode_vector))
+        return np.array(indexingList)
 
-            cmdList = []
-            for i in mode_vector:
-                cmd = cmd_matrix[:, i]
-                cmdList.append(cmd)
-
-            for i in range(len(cmdList)):
-                k = len(cmdList)*j + i
-                matrix_for_seq.T[k] = cmdList[i]
+    def _shuffleCmdSequence(self, mode_vector, n_rep, cmd_matrix):
+        ''' Usa il numero di ripetioni e crea la sequenza dei comandi
+        '''
+        indexingVec = self._shuffleIndexingList(mode_vector, n_rep, cmd_matrix)
 
-        cmdSequence = matrix_for_seq
-        indexingVec = np.array(indexingList)
+        cmdSequence = self._cmdMatrix.getColumns(
+            indexingVec.ravel()).astype(float)
 
         return cmdSequence, indexingVec
 
 
-    def _tidyCmdSequence(self, mode_vector, n_rep, cmd_matrix):
-        ''' Usa il numero di ripetioni e crea la sequenza dei comandi
+    def _tidyIndexingList(self, mode_vector, n_rep, cmd_matrix):
+        ''' Usa il numero di ripetioni e crea la sequenza dei modi
         '''
         self._modeVector = copy.copy(mode_vector)
         self._nRepetitions = n_rep
-        self._cmdMatrix = cmd_matrix
-        indList = []
-        for i in range(n_rep):
-            indList.append(mode_vector)
-        self._indexingList = np.array(indList)
-        #self._indexingList= np.tile(mode_vector, n_push_pull)
+        self._cmdMatrix = self._toCommandMatrix(cmd_matrix)
+        self._indexingList = np.tile(mode_vector, (n_rep, 1))
 
-        n_frame = mode_vector.size * n_rep
-        matrix_for_seq = np.zeros((self._nActs, n_frame))
+    def _tidyCmdSequence(self, mode_vector, n_rep, cmd_matrix):
+        ''' Usa il numero di ripetioni e crea la sequenza dei comandi
+        '''
+        self._tidyIndexingList(mode_vector, n_rep, cmd_matrix)
 
-        cmdList = []
-        for i in mode_vector:
-            cmd = cmd_matrix[:, i]
-            cmdList.append(cmd)
+        columns = self._cmdMatrix.getColumns(mode_vector)
+        cmdSequence = np.tile(columns, (1, n_rep)).astype(float)
 
-        for j in range(n_rep):
-            for i in range(len(cmdList)):
-                k = len(cmdList)*j + i
-                matrix_for_seq.T[k] = cmdList[i]
+        return cmdSequence
 
-        cmdSequence = matrix_for_seq
 
-        return cmdSequence
+    @staticmethod
+    def _toCommandMatrix(cmd_matrix):
+        if isinstance(cmd_matrix, CommandMatrix):
+            return cmd_matrix
+        return CommandMatrix(cmd_matrix)
 
+    def getCommandMatrix(self):
+        '''
+        Returns
+        -------
+        cmd_matrix: object
+                    CommandMatrix class object of the modes applied
+        '''
+        return self._cmdMatrix
 
     def _amplitudeReorganization(self, indexing_input, indexing_list,
                                  amplitude, n_push_pull):
-        where = []
-        for i in indexing_input:
-            for j in range(n_push_pull):
-                a = np.where(indexing_list[j] == i)
-                where.append(a)
-
-
-        where = np.array(where)
-        vect = np.zeros(amplitude.shape[0]*n_push_pull)
-
-        for i in range(amplitude.shape[0]):
-            for k in range(n_push_pull):
-                p = n_push_pull * i + k
-                indvect = where[p][0][0]+ indexing_input.shape[0] * k
-                vect[indvect] = amplitude[i]
-
-        return vect
-
-
-    def _zippedAmplitude(self, amplitude):
-        aa = np.arange(self._cmdSequence.shape[1])
-        reorganized_amplitude = \
-                self._amplitudeReorganization(self._modeVector,
-                                              self._indexingList,
-                                              amplitude,
-                                              self._nRepetitions)
-        #zipped= np.dstack((aa, reorganized_amplitude))
-        zipped = zip(aa, reorganized_amplitude)
-        return zipped
+        ''' Amplitude of each column of the command sequence: the modes
+        of each repetition of indexing_list are looked up in indexing_input,
+        whose order is the one of amplitude
+        '''
+        order = np.argsort(indexing_input, kind='stable')
+        positions = order[np.searchsorted(indexing_input,
+                                          indexing_list[:n_push_pull],
+                                          sorter=order)]
+        return np.asarray(amplitude, dtype=float)[positions].ravel()
 
-    def _cmdHistoryToApply(self, zipped, template=None):
+    def _cmdHistoryToApply(self, amplitude_sequence, template=None):
         ''' Usa l'informazione sul template per creare la sequenza di comandi
         da applicare allo specchio (il numero di ripetioni è già stato usato
         in precedenza per creare 
         '''
-        matrix_with_amp = self._cmdSequence
-        for i, amp in zipped:
-            matrix_with_amp.T[i] = matrix_with_amp.T[i] * amp
+        self._cmdSequence *= amplitude_sequence
 
         if template is None:
             template = np.array((1, -1, 1))
         else:
             template = template
 
-        matrix_to_apply = np.zeros((self._nActs,
-                                    self._cmdSequence.shape[1] *
-                                    template.shape[0]))
+        matrix_to_apply = self._cmdSequence[:, :, np.newaxis] * template
+        return matrix_to_apply.reshape(self._nActs, -1).astype(float,
+                                                               copy=False)
 
-        for i in range(self._cmdSequence.shape[1]):
-            j = template.shape[0] * i
-            for k in range(template.shape[0]):
-                matrix_to_apply.T[j+k] = matrix_with_amp.T[i]* template[k]
-
-        return matrix_to_apply
 
+    @staticmethod
+    def _commandMatrixFolder():
+        """ Folder of the command matrices, one file per content hash """
+        return os.path.join(CmdHistory._storageFolder(), 'CommandMatrix')
+
+    def _saveCommandMatrix(self):
+        ''' Saves the command matrix in the shared folder, unless a
+        matrix with the same content is already there '''
+        cmd_hash = self._cmdMatrix.getHash()
+        folder = CmdHistory._commandMatrixFolder()
+        file_name = os.path.join(folder, cmd_hash + '.fits')
+        if not os.path.exists(file_name):
+            os.makedirs(folder, exist_ok=True)
+            self._cmdMatrix.saveAsFits(file_name)
+        return cmd_hash
 
     def saveInfo(self, fits_or_h5):
         """ Save the data in fits format
 
+        Only the modes, the order in which they are applied, the amplitudes,
+        the template and the content hash of the command matrix are saved:
+        the command matrix is stored once in the CommandMatrix folder for
+        all the command histories using it, and the command history matrix
+        is rebuilt when loaded.
+
         Returns
         -------
         tt: string
             tracking number
         """
         store_in_folder = CmdHistory._storageFolder()
+        cmd_hash = self._saveCommandMatrix()
         dove, tt = TtFolder(store_in_folder).createFolderToStoreMeasurements()
+        template = ','.join(str(k) for k in self._template)
 
         if fits_or_h5 == 0:
             fits_file_name = os.path.join(dove, 'info.fits')
             header = pyfits.Header()
             header['NREP'] = self._nRepetitions
+            header['CMDTYPE'] = self._cmdMatrix.getType()
+            header['CMDHASH'] = cmd_hash
+            header['TEMPLATE'] = template
             pyfits.writeto(fits_file_name, self._modeVector, header)
             pyfits.append(fits_file_name, self._indexingList, header)
-            pyfits.append(fits_file_name, self._cmdMatrix, header)
-            pyfits.append(fits_file_name, self._cmdHToApply, header)
             pyfits.append(fits_file_name, self._ampVect, header)
         else:
             fits_file_name = os.path.join(dove, 'info.h5')
             hf = h5py.File(fits_file_name, 'w')
             hf.create_dataset('dataset_1', data=self._modeVector)
             hf.create_dataset('dataset_2', data=self._indexingList)
-            hf.create_dataset('dataset_3', data=self._cmdHToApply)
             hf.create_dataset('dataset_4', data=self._ampVect)
             hf.attrs['NREP'] = self._nRepetitions
+            hf.attrs['CMDHASH'] = cmd_hash
+            hf.attrs['TEMPLATE'] = template
             hf.close()
         return tt
 
+    def _rebuild(self, cmd_hash, template):
+        ''' Creates the lazy command history of a compact info file '''
+        self._cmdMatrix = CommandMatrix.loadFromFits(os.path.join(
+            CmdHistory._commandMatrixFolder(), cmd_hash + '.fits'))
+        self._template = np.array([float(k) for k in template.split(',')])
+        if np.all(self._template == np.round(self._template)):
+            self._template = self._template.astype(int)
+        amplitude_sequence = self._amplitudeReorganization(
+            self._modeVector, self._indexingList, self._ampVect,
+            self._nRepetitions)
+        self._lazyHistory(amplitude_sequence)
+
     @staticmethod
     def load(tt, fits_or_h5=0):
         """ Creates the object from the info.fits file located in tt
@@ -310,7 +369,12 @@ class CmdHistory():
             hduList = pyfits.open(additional_info_fits_file_name)
             theObject._modeVector = hduList[0].data
             theObject._indexingList = hduList[1].data
-            theObject._cmdMatrix = hduList[2].data
+            if 'CMDHASH' in header:
+                theObject._ampVect = hduList[2].data
+                theObject._nRepetitions = header['NREP']
+                theObject._rebuild(header['CMDHASH'], header['TEMPLATE'])
+                return theObject
+            theObject._cmdMatrix = CommandMatrix(hduList[2].data)
             theObject._cmdHToApply = hduList[3].data
             theObject._ampVect = hduList[4].data
             try:
@@ -323,12 +387,156 @@ class CmdHistory():
             hf.keys()
             data1 = hf.get('dataset_1')
             data2 = hf.get('dataset_2')
-            data3 = hf.get('dataset_3')
             data4 = hf.get('dataset_4')
             theObject._nRepetitions = hf.attrs['NREP']
             theObject._modeVector = np.array(data1)
             theObject._indexingList = np.array(data2)
-            theObject._cmdHToApply = np.array(data3)
             theObject._ampVect = np.array(data4)
+            if 'CMDHASH' in hf.attrs:
+                cmd_hash = hf.attrs['CMDHASH']
+                template = hf.attrs['TEMPLATE']
+            else:
+                theObject._cmdHToApply = np.array(hf.get('dataset_3'))
             hf.close()
+            if theObject._cmdHToApply is None:
+                theObject._rebuild(cmd_hash, template)
         return theObject
+
+
+class LazyCmdHistory():
+    '''
+    Command history whose commands are computed on request from the
+    sequence of the modes, their amplitude, the command matrix and the
+    template, without building the [nActs x nFrames] matrix.
+
+    The frame of index i is the mode of the column i // template.size
+    times its amplitude times template[i % template.size]. The object is
+    indexed as the command history matrix.
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.type.commandHistory import \
+            LazyCmdHistory
+        cmdH = LazyCmdHistory(mode_sequence, amplitudes, cmd_matrix, template)
+        cmdH.shape
+        command = cmdH[:, 10]
+        matrix = cmdH.toDense()
+    '''
+
+    def __init__(self, mode_sequence, amplitude_sequence, cmd_matrix,
+                 template):
+        """The constructor
+
+        Parameters
+        ----------
+        mode_sequence: numpy array [nColumns]
+            modes in the order in which they are applied
+        amplitude_sequence: numpy array [nColumns]
+            amplitude of each mode of the sequence
+        cmd_matrix: numpy array [nActs x nModes] or CommandMatrix
+            mode command matrix
+        template: numpy array
+            vector composed by 1 and -1 (es. np.array([1, -1, 1]))
+        """
+        self._modeSequence = np.asarray(mode_sequence, dtype=int)
+        self._amplitudeSequence = np.asarray(amplitude_sequence, dtype=float)
+        if self._amplitudeSequence.shape != self._modeSequence.shape:
+            raise ValueError('%d amplitudes for %d modes' % (
+                self._amplitudeSequence.size, self._modeSequence.size))
+        if not isinstance(cmd_matrix, CommandMatrix):
+            cmd_matrix = CommandMatrix(cmd_matrix)
+        self._cmdMatrix = cmd_matrix
+        self._template = np.asarray(template)
+
+    @property
+    def shape(self):
+        ''' shape of the command history matrix [nActs, nFrames] '''
+        return (self._cmdMatrix.shape[0],
+                self._modeSequence.size * self._template.size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def getModeSequence(self):
+        '''
+        Returns
+        -------
+        mode_sequence: numpy array [nColumns]
+            modes in the order in which they are applied
+        '''
+        return self._modeSequence
+
+    def getAmplitudeSequence(self):
+        '''
+        Returns
+        -------
+        amplitude_sequence: numpy array [nColumns]
+            amplitude of each mode of the sequence
+        '''
+        return self._amplitudeSequence
+
+    def getTemplate(self):
+        '''
+        Returns
+        -------
+        template: numpy array
+            vector composed by 1 and -1
+        '''
+        return self._template
+
+    def getCommandMatrix(self):
+        '''
+        Returns
+        -------
+        cmd_matrix: object
+            CommandMatrix class object
+        '''
+        return self._cmdMatrix
+
+    def getCommands(self, frame_indexes):
+        '''
+        Parameters
+        ----------
+        frame_indexes: list or numpy array
+            index of the frames
+
+        Returns
+        -------
+        commands: numpy array [nActs, len(frame_indexes)]
+            commands of the frames
+        '''
+        frame_indexes = np.asarray(frame_indexes, dtype=int)
+        column, step = np.divmod(frame_indexes, self._template.size)
+        commands = self._cmdMatrix.getColumns(self._modeSequence[column]) * \
+            self._amplitudeSequence[column]
+        return commands * self._template[step]
+
+    def __getitem__(self, key):
+        '''
+        Returns
+        -------
+        commands: numpy array
+            matrix[key], es. the command of frame i for key (slice(None), i)
+        '''
+        rows, frames = key if isinstance(key, tuple) else (key, slice(None))
+        n_frames = self.shape[1]
+        if isinstance(frames, (int, np.integer)):
+            if not -n_frames <= frames < n_frames:
+                raise IndexError('Frame %d out of %d' % (frames, n_frames))
+            return self.getCommands([frames % n_frames])[:, 0][rows]
+        return self.getCommands(np.arange(n_frames)[frames])[rows]
+
+    def __iter__(self):
+        ''' Iterates on the rows, as the command history matrix: the
+        commands of all the frames are computed '''
+        return iter(self.toDense())
+
+    def toDense(self):
+        '''
+        Returns
+        -------
+        matrix: numpy array [nActs, nFrames]
+            command history matrix
+        '''
+        return self.getCommands(np.arange(self.shape[1]))
+
@@ -0,0 +1,354 @@
+import os
+import hashlib
+import numpy as np
+from astropy.io import fits as pyfits
+from plico_dm_characterization.ground import temp
+
+#: identity matrix, one actuator per mode
+ZONAL = 'zonal'
+#: diagonal matrix, one actuator per mode with its own gain
+DIAGONAL = 'diagonal'
+#: Sylvester Hadamard matrix with permuted rows and columns
+HADAMARD = 'hadamard'
+#: any other matrix
+DENSE = 'dense'
+
+
+def _parity(labels):
+    ''' Parity of the number of bits set in each element of labels '''
+    x = np.array(labels, dtype=np.uint64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        x ^= x >> np.uint64(shift)
+    return (x & np.uint64(1)).astype(bool)
+
+
+def _bitsToLabels(bits):
+    weights = np.left_shift(1, np.arange(bits.shape[1], dtype=np.int64))
+    return bits.astype(np.int64) @ weights
+
+
+def _gf2Factorization(bits, max_rank):
+    '''
+    Factorizes the boolean matrix bits [n, m] as (rows @ cols.T) % 2,
+    with rows [n, k] and cols [m, k], by Gauss-Jordan elimination over
+    GF(2). Returns None if the rank of bits is larger than max_rank.
+    '''
+    reduced = bits.copy()
+    pivots = []
+    while True:
+        k = len(pivots)
+        rows_with_ones = reduced[k:].any(axis=1)
+        if not rows_with_ones.any():
+            break
+        if k == max_rank:
+            return None
+        r = k + np.argmax(rows_with_ones)
+        c = np.argmax(reduced[r])
+        reduced[[k, r]] = reduced[[r, k]]
+        to_reduce = reduced[:, c].copy()
+        to_reduce[k] = False
+        reduced[to_reduce] ^= reduced[k]
+        pivots.append(c)
+    return bits[:, pivots], reduced[:len(pivots)].T
+
+
+def walshHadamardTransform(data):
+    '''
+    Product of the Sylvester Hadamard matrix (scipy.linalg.hadamard) and
+    data, in N log N operations
+
+    Parameters
+    ----------
+    data: numpy array [N, ...]
+        vectors to transform along the first axis; N must be a power of 2
+
+    Returns
+    -------
+    transform: numpy array [N, ...]
+        hadamard(N) @ data
+    '''
+    data = np.asarray(data)
+    n = data.shape[0]
+    if n & (n - 1):
+        raise ValueError('Length %d is not a power of 2' % n)
+    rest = data.shape[1:]
+    h = 1
+    while h < n:
+        blocks = data.reshape((n // (2 * h), 2, h) + rest)
+        data = np.stack((blocks[:, 0] + blocks[:, 1],
+                         blocks[:, 0] - blocks[:, 1]), axis=1)
+        h *= 2
+    return data.reshape((n,) + rest)
+
+
+class CommandMatrix():
+    '''
+    Command matrix [nActs x nModes] kept in the form of its structure
+
+    The matrix is classified once when the object is created: for zonal
+    and diagonal matrices only the diagonal is kept, for Sylvester
+    Hadamard matrices with permuted rows and columns only the
+    permutations, so that the dense matrix is never materialized again.
+    Subsets of rows or columns of a Hadamard matrix are kept as dense
+    matrices. The products use the structure (scaling, fast
+    Walsh-Hadamard transform).
+
+    HOW TO USE IT::
+
+        from plico_dm_characterization.type.commandMatrix import \
+            CommandMatrix
+        cmd_matrix = CommandMatrix(modal_base)
+        cmd_matrix.getType()
+        commands = cmd_matrix.getColumns(modes)
+        command = cmd_matrix.dot(modal_coefficients)
+    '''
+
+    def __init__(self, matrix):
+        """The constructor
+
+        Parameters
+        ----------
+        matrix: numpy array [nActs x nModes]
+            command matrix
+        """
+        matrix = np.asarray(matrix)
+        if matrix.ndim != 2:
+            raise ValueError('Command matrix must be 2D, not %dD'
+                             % matrix.ndim)
+        self._shape = matrix.shape
+        self._dtype = matrix.dtype
+        self._diagonal = None
+        self._hadamardRows = None
+        self._hadamardCols = None
+        self._hadamardOrder = None
+        self._matrix = None
+        self._hash = None
+        self._type = self._classify(matrix)
+
+    @staticmethod
+    def fromDiagonal(diagonal):
+        ''' Creates a zonal or diagonal command matrix from its diagonal
+
+        Parameters
+        ----------
+        diagonal: numpy array [nActs]
+            diagonal of the matrix
+
+        Returns
+        -------
+        theObject: object
+            CommandMatrix class object
+        '''
+        diagonal = np.asarray(diagonal)
+        theObject = CommandMatrix._structured(
+            ZONAL if np.all(diagonal == 1) else DIAGONAL,
+            (diagonal.size, diagonal.size), diagonal.dtype)
+        theObject._diagonal = diagonal
+        return theObject
+
+    @staticmethod
+    def _structured(matrix_type, shape, dtype):
+        ''' Object of matrix_type without classifying a dense matrix '''
+        theObject = CommandMatrix(np.zeros((0, 0), dtype=dtype))
+        theObject._type = matrix_type
+        theObject._shape = tuple(shape)
+        theObject._diagonal = None
+        return theObject
+
+    def _classify(self, matrix):
+        n_acts, n_modes = matrix.shape
+        if n_acts == n_modes:
+            diagonal = np.diagonal(matrix)
+            if np.count_nonzero(matrix) == np.count_nonzero(diagonal):
+                self._diagonal = diagonal.copy()
+                return ZONAL if np.all(diagonal == 1) else DIAGONAL
+        if n_acts == n_modes and n_acts > 0 and \
+                not n_acts & (n_acts - 1) and np.all(np.abs(matrix) == 1):
+            order = n_acts.bit_length() - 1
+            factors = _gf2Factorization(matrix < 0, order)
+            if factors is not None and factors[0].shape[1] == order:
+                rows = _bitsToLabels(factors[0])
+                cols = _bitsToLabels(factors[1])
+                # full rank: the labels are permutations, no repeated
+                # rows or columns (e.g. np.ones((4, 4)) has rank 0)
+                if np.array_equal(np.sort(rows), np.arange(n_acts)) and \
+                        np.array_equal(np.sort(cols), np.arange(n_acts)):
+                    self._hadamardRows = rows
+                    self._hadamardCols = cols
+                    self._hadamardOrder = n_acts
+                    return HADAMARD
+        self._matrix = matrix
+        return DENSE
+
+    def getType(self):
+        '''
+        Returns
+        -------
+        type: string
+            'zonal', 'diagonal', 'hadamard' or 'dense'
+        '''
+        return self._type
+
+    @property
+    def shape(self):
+        ''' shape of the matrix [nActs, nModes] '''
+        return self._shape
+
+    def getDiagonal(self):
+        '''
+        Returns
+        -------
+        diagonal: numpy array [nActs]
+            diagonal of a zonal or diagonal matrix, None otherwise
+        '''
+        return self._diagonal
+
+    def getColumns(self, modes):
+        '''
+        Parameters
+        ----------
+        modes: list or numpy array
+            index of the modes
+
+        Returns
+        -------
+        commands: numpy array [nActs, len(modes)]
+            columns of the matrix
+        '''
+        modes = np.asarray(modes, dtype=int)
+        if self._diagonal is not None:
+            columns = np.zeros((self._shape[0], modes.size),
+                               dtype=self._diagonal.dtype)
+            columns[modes, np.arange(modes.size)] = self._diagonal[modes]
+            return columns
+        if self._type == HADAMARD:
+            odd = _parity(self._hadamardRows[:, np.newaxis] &
+                          self._hadamardCols[modes])
+            return np.where(odd, -1, 1).astype(self._dtype)
+        return self._matrix[:, modes]
+
+    def toDense(self):
+        '''
+        Returns
+        -------
+        matrix: numpy array [nActs x nModes]
+            dense command matrix
+        '''
+        return self.getColumns(np.arange(self._shape[1]))
+
+    def dot(self, coefficients):
+        '''
+        Parameters
+        ----------
+        coefficients: numpy array [nModes] or [nModes, N]
+            modal coefficients
+
+        Returns
+        -------
+        commands: numpy array [nActs] or [nActs, N]
+            matrix @ coefficients
+        '''
+        coefficients = np.asarray(coefficients)
+        if self._type == ZONAL:
+            return coefficients
+        if self._type == DIAGONAL:
+            return self._diagonal.reshape(
+                (-1,) + (1,) * (coefficients.ndim - 1)) * coefficients
+        if self._type == HADAMARD:
+            spread = np.zeros((self._hadamardOrder,) + coefficients.shape[1:],
+                              dtype=np.result_type(coefficients, float))
+            np.add.at(spread, self._hadamardCols, coefficients)
+            return walshHadamardTransform(spread)[self._hadamardRows]
+        return self._matrix @ coefficients
+
+    def getHash(self, block_size=256):
+        '''
+        Content hash of the matrix, equal for equal matrices whatever
+        their structure: sha256 of dtype, shape and values in column-major
+        order, computed by blocks of columns without building the matrix
+
+        Returns
+        -------
+        hash: string
+            hexadecimal sha256 digest
+        '''
+        if self._hash is None:
+            dtype = np.dtype(self._dtype).newbyteorder('<')
+            digest = hashlib.sha256(
+                ('%s%s' % (dtype.str, self._shape)).encode('ascii'))
+            for start in range(0, self._shape[1], block_size):
+                block = self.getColumns(
+                    np.arange(start, min(start + block_size, self._shape[1])))
+                digest.update(np.ascontiguousarray(
+                    block.T, dtype=dtype).tobytes())
+            self._hash = digest.hexdigest()
+        return self._hash
+
+    def saveAsFits(self, file_name):
+        ''' Saves the matrix in its compact form: the diagonal for zonal
+        and diagonal matrices, the row and column permutations for Hadamard
+        ones. The file is written atomically.
+
+        Parameters
+        ----------
+        file_name: string
+            path of the fits file
+        '''
+        header = pyfits.Header()
+        header['CMDTYPE'] = self._type
+        header['NACTS'] = self._shape[0]
+        header['NMODES'] = self._shape[1]
+        header['DTYPE'] = np.dtype(self._dtype).name
+        header['CMDHASH'] = self.getHash()
+        hduList = pyfits.HDUList()
+        if self._diagonal is not None:
+            hduList.append(pyfits.PrimaryHDU(self._diagonal, header))
+        elif self._type == HADAMARD:
+            header['HADORDER'] = self._hadamardOrder
+            hduList.append(pyfits.PrimaryHDU(self._hadamardRows, header))
+            hduList.append(pyfits.ImageHDU(self._hadamardCols))
+        else:
+            hduList.append(pyfits.PrimaryHDU(self._matrix, header))
+        tmp_file_name = temp.temporaryFileName(
+            os.path.dirname(os.path.abspath(file_name)))
+        try:
+            hduList.writeto(tmp_file_name, overwrite=True)
+            os.replace(tmp_file_name, file_name)
+        except BaseException:
+            os.remove(tmp_file_name)
+            raise
+
+    @staticmethod
+    def loadFromFits(file_name):
+        """ Creates the object from a file written by saveAsFits
+
+        Parameters
+        ----------
+        file_name: string
+            path of the fits file
+
+        Returns
+        -------
+        theObject: object
+            CommandMatrix class object
+        """
+        with pyfits.open(file_name, memmap=False) as hduList:
+            header = hduList[0].header
+            matrix_type = header['CMDTYPE']
+            shape = (header['NACTS'], header['NMODES'])
+            dtype = np.dtype(header['DTYPE'])
+            data = hduList[0].data
+            if matrix_type in (ZONAL, DIAGONAL):
+                theObject = CommandMatrix.fromDiagonal(
+                    np.asarray(data, dtype=dtype))
+            elif matrix_type == HADAMARD:
+                theObject = CommandMatrix._structured(HADAMARD, shape, dtype)
+                theObject._hadamardOrder = header['HADORDER']
+                theObject._hadamardRows = np.asarray(data, dtype=np.int64)
+                theObject._hadamardCols = np.asarray(hduList[1].data,
+                                                     dtype=np.int64)
+            else:
+                theObject = CommandMatrix._structured(DENSE, shape, dtype)
+                theObject._matrix = np.asarray(data, dtype=dtype)
+            theObject._hash = header['CMDHASH']
+        return theObject
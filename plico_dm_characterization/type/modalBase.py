@@ -8,6 +8,7 @@ import h5py
 import numpy as np
 from scipy.linalg import hadamard
 from plico_dm_characterization.configuration import config
+from plico_dm_characterization.type.commandMatrix import CommandMatrix
 
 
 class ModalBase():
@@ -51,6 +52,16 @@ class ModalBase():
         '''
         return self._modalBase
 
+    def getCommandMatrix(self):
+        '''
+        Returns
+        -------
+        cmd_matrix: object
+                    CommandMatrix class object of the modal base,
+                    classified as zonal, diagonal, hadamard or dense
+        '''
+        return CommandMatrix(self._modalBase)
+
     def getTag(self):
         '''
         Returns
@@ -86,6 +86,12 @@ setup(name=NAME,
           'plico_dm_characterization': ['test/data/*'],
       },
       include_package_data=True,
+      entry_points={
+          'console_scripts': [
+              'plico_dm_characterization='
+              'plico_dm_characterization.commandLine:main',
+          ],
+      },
       test_suite='test',
       cmdclass={'upload': UploadCommand,
                 },
@@ -0,0 +1,71 @@
+'''
+Timing of the construction of the command history matrix
+
+HOW TO USE IT::
+
+    python -m test.benchmark_commandHistory
+    python -m test.benchmark_commandHistory --n-acts 100 1000 --n-rep 3
+'''
+import argparse
+import contextlib
+import io
+import time
+import unittest.mock as mock
+import numpy as np
+from plico_dm_characterization.type.modalBase import ModalBase
+from plico_dm_characterization.type.commandHistory import CmdHistory
+
+
+def _modalBase(base, n_acts):
+    if base == 'zonal':
+        return ModalBase().getZonalMatrix(n_acts)
+    if base == 'hadamard':
+        from scipy.linalg import hadamard
+        order = 2**int(np.ceil(np.log2(n_acts)))
+        return hadamard(order)[:n_acts, :n_acts]
+    return np.random.default_rng(0).standard_normal((n_acts, n_acts))
+
+
+def timeCommandHistory(n_acts, n_rep, template, base='zonal'):
+    '''
+    Returns
+    -------
+    times: tuple
+        seconds of tidyCommandHistoryMaker and shuffleCommandHistoryMaker,
+        without saving the command histories
+    '''
+    cmd_matrix = _modalBase(base, n_acts)
+    amplitude = np.full(n_acts, 0.1)
+    times = []
+    with mock.patch.object(CmdHistory, 'saveInfo', return_value='tt'), \
+            contextlib.redirect_stdout(io.StringIO()):
+        for shuffle in (False, True):
+            cmdH = CmdHistory(n_acts)
+            maker = cmdH.shuffleCommandHistoryMaker if shuffle \
+                else cmdH.tidyCommandHistoryMaker
+            start = time.perf_counter()
+            maker(np.arange(n_acts), amplitude, cmd_matrix, n_rep, template)
+            times.append(time.perf_counter() - start)
+    return tuple(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Timing of the command history construction')
+    parser.add_argument('--n-acts', type=int, nargs='+',
+                        default=[100, 500, 1000, 2000, 5000])
+    parser.add_argument('--n-rep', type=int, default=1)
+    parser.add_argument('--template', type=int, nargs='+', default=[1, -1])
+    parser.add_argument('--base', default='zonal',
+                        choices=['zonal', 'hadamard', 'dense'])
+    args = parser.parse_args(argv)
+    template = np.array(args.template)
+    print('%8s %10s %12s' % ('nActs', 'tidy [s]', 'shuffle [s]'))
+    for n_acts in args.n_acts:
+        tidy, shuffle = timeCommandHistory(n_acts, args.n_rep, template,
+                                           args.base)
+        print('%8d %10.3f %12.3f' % (n_acts, tidy, shuffle))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from astropy.io import fits
+from plico_dm_characterization.ground.cube_file import FitsCubeFile
+from plico_dm_characterization.ground.lazy_cube import LazyCube
+
+
+class TestFitsCubeFile(unittest.TestCase):
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        self._fileName = os.path.join(self._folder, 'Cube.fits')
+        rng = np.random.default_rng(0)
+        self.cube = np.ma.masked_array(rng.standard_normal((6, 5, 7)),
+                                       mask=rng.random((6, 5, 7)) > 0.7)
+        self.variance = np.ma.masked_array(rng.random((6, 5, 7)),
+                                           mask=self.cube.mask)
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    def _cubeFile(self, band_bytes):
+        return FitsCubeFile(self._fileName, self.cube.shape, np.float64,
+                            fits.Header(), [np.arange(7)],
+                            with_variance=True, band_bytes=band_bytes)
+
+    def _checkCube(self):
+        self.assertEqual(os.listdir(self._folder), ['Cube.fits'])
+        with LazyCube(self._fileName) as lazy:
+            np.testing.assert_array_equal(lazy.toMaskedArray().data,
+                                          self.cube.data)
+            np.testing.assert_array_equal(lazy.mask, self.cube.mask)
+            np.testing.assert_array_equal(lazy.getVariance(), self.variance)
+
+    def testActuatorsAreGatheredInBandsOfRows(self):
+        with self._cubeFile(1) as cube_file:
+            cube_file.writeBlock(np.arange(7), self.cube, self.variance)
+        with LazyCube(self._fileName, band_bytes=1) as lazy:
+            ifs = lazy.getActuators([5, 2])
+            np.testing.assert_array_equal(ifs.data, self.cube.data[:, :, [5, 2]])
+            np.testing.assert_array_equal(ifs.mask, self.cube.mask[:, :, [5, 2]])
+            np.testing.assert_array_equal(lazy.getVariance([5, 2]),
+                                          self.variance[:, :, [5, 2]])
+
+    def testBlocksOfActuatorsAreMovedInBandsOfRows(self):
+        for band_bytes in (1, 2 * 5 * 7 * 17, 10**6):
+            with self._cubeFile(band_bytes) as cube_file:
+                for slots in ([4, 5, 6], [0, 1], [2, 3]):
+                    cube_file.writeBlock(slots, self.cube[:, :, slots],
+                                         self.variance[:, :, slots])
+            self._checkCube()
+
+    def testBandsOfRowsAreWrittenDirectly(self):
+        with self._cubeFile(1) as cube_file:
+            for start in (0, 4):
+                cube_file.writeRows(start, self.cube[start:start + 4],
+                                    self.variance[start:start + 4])
+        self._checkCube()
+
+    def testAbortRemovesTheScratchFiles(self):
+        with self.assertRaises(RuntimeError):
+            with self._cubeFile(1) as cube_file:
+                cube_file.writeBlock([0], self.cube[:, :, [0]],
+                                     self.variance[:, :, [0]])
+                raise RuntimeError('interrupted')
+        self.assertEqual(os.listdir(self._folder), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
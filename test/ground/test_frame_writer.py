@@ -0,0 +1,48 @@
+import time
+import threading
+import unittest
+import numpy as np
+from plico_dm_characterization.ground.frame_writer import FrameWriter
+
+
+class TestFrameWriter(unittest.TestCase):
+
+    def testAllFramesAreSavedBeforeClose(self):
+        saved = {}
+
+        def save(index, ima):
+            time.sleep(0.001)
+            saved[index] = ima
+
+        with FrameWriter(save, queue_size=2, n_writers=3) as writer:
+            for i in range(20):
+                writer.put(i, np.ma.masked_array(np.ones(3) * i))
+        self.assertEqual(sorted(saved.keys()), list(range(20)))
+        self.assertEqual(writer.getNumberOfWrittenFrames(), 20)
+
+    def testPutBlocksWhenQueueIsFull(self):
+        release = threading.Event()
+        writer = FrameWriter(lambda i, ima: release.wait(), queue_size=1)
+        writer.put(0, None)
+        writer.put(1, None)
+        t0 = time.time()
+        threading.Timer(0.2, release.set).start()
+        writer.put(2, None)
+        self.assertGreaterEqual(time.time() - t0, 0.15)
+        writer.close()
+
+    def testWriterErrorsAreReported(self):
+        def save(index, ima):
+            if index == 1:
+                raise IOError('disk full')
+
+        writer = FrameWriter(save, queue_size=4)
+        writer.put(0, None)
+        writer.put(1, None)
+        self.assertRaises(OSError, writer.flush)
+        self.assertRaises(OSError, writer.put, 2, None)
+        self.assertRaises(OSError, writer.close)
+
+
+if __name__ == "__main__":
+    unittest.main()
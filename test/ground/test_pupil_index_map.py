@@ -0,0 +1,36 @@
+import unittest
+import numpy as np
+from plico_dm_characterization.ground.pupil_index_map import PupilIndexMap
+
+
+class TestPupilIndexMap(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.mask = rng.random((6, 7)) > 0.6
+        self.cube = rng.standard_normal((6, 7, 3))
+        self.index_map = PupilIndexMap(self.mask)
+
+    def testCompressLikeMaskedArrays(self):
+        image = np.ma.masked_array(self.cube[:, :, 1], mask=~self.mask)
+        self.assertEqual(self.index_map.size, np.count_nonzero(~self.mask))
+        np.testing.assert_array_equal(
+            self.index_map.compress(image),
+            np.ma.masked_array(image.data, mask=self.mask).compressed())
+        np.testing.assert_array_equal(self.index_map.getMask(), self.mask)
+
+    def testCompressCube(self):
+        values = self.index_map.compressCube(self.cube)
+        self.assertEqual(values.shape, (self.index_map.size, 3))
+        for i in range(3):
+            np.testing.assert_array_equal(
+                values[:, i], self.index_map.compress(self.cube[:, :, i]))
+
+    def testWrongShape(self):
+        self.assertRaises(ValueError, self.index_map.compress, np.ones((7, 6)))
+        self.assertRaises(ValueError, self.index_map.compressCube,
+                          np.ones((6, 6, 2)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from plico_dm_characterization.ground.reconstructor_cache import \
+    ReconstructorCache, CACHE_FOLDER
+
+
+class TestReconstructorCache(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cube_file_name = os.path.join(self.folder, 'Cube.fits')
+        with open(self.cube_file_name, 'wb') as f:
+            f.write(b'cube')
+        self.rec = np.random.default_rng(0).standard_normal((4, 30))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testSaveAndLoad(self):
+        cache = ReconstructorCache(self.folder, 'tt')
+        self.assertIsNone(cache.load('mask', 1e-15, np.float64))
+        cache.save('mask', 1e-15, np.float64, self.rec)
+        np.testing.assert_array_equal(
+            ReconstructorCache(self.folder, 'tt').load(
+                'mask', 1e-15, np.float64), self.rec)
+        self.assertIsNone(cache.load('other', 1e-15, np.float64))
+        self.assertIsNone(cache.load('mask', 1e-3, np.float64))
+        self.assertIsNone(cache.load('mask', 1e-15, np.float32))
+
+    def testEntriesFollowTheUmask(self):
+        umask = os.umask(0o022)
+        try:
+            ReconstructorCache(self.folder, 'tt').save(
+                'mask', 1e-15, np.float64, self.rec)
+        finally:
+            os.umask(umask)
+        folder = os.path.join(self.folder, CACHE_FOLDER)
+        self.assertEqual(os.stat(os.path.join(
+            folder, os.listdir(folder)[0])).st_mode & 0o777, 0o644)
+
+    def testCubeChangeClearsTheCache(self):
+        cache = ReconstructorCache(self.folder, 'tt')
+        cache.save('mask', 1e-15, np.float64, self.rec)
+        time.sleep(0.01)
+        with open(self.cube_file_name, 'wb') as f:
+            f.write(b'new cube')
+        self.assertIsNone(cache.load('mask', 1e-15, np.float64))
+        self.assertEqual(cache.getSize(), 0)
+
+    def testLeastRecentlyUsedAreEvicted(self):
+        cache = ReconstructorCache(self.folder, 'tt')
+        cache.save('a', 1e-15, np.float64, self.rec)
+        entry_size = cache.getSize()
+        cache = ReconstructorCache(self.folder, 'tt', 2 * entry_size)
+        time.sleep(0.01)
+        cache.save('b', 1e-15, np.float64, self.rec)
+        time.sleep(0.01)
+        cache.load('a', 1e-15, np.float64)
+        time.sleep(0.01)
+        cache.save('c', 1e-15, np.float64, self.rec)
+        self.assertEqual(len(os.listdir(os.path.join(self.folder,
+                                                     CACHE_FOLDER))), 2)
+        self.assertIsNone(cache.load('b', 1e-15, np.float64))
+        self.assertIsNotNone(cache.load('a', 1e-15, np.float64))
+        self.assertIsNotNone(cache.load('c', 1e-15, np.float64))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+import numpy as np
+from astropy.io import fits
+from plico_dm_characterization.ground import temp
+
+
+class TestFrameStorage(unittest.TestCase):
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(3)
+        self.frames = [np.ma.masked_array(
+            rng.standard_normal((6, 7)).astype(np.float32),
+            mask=rng.random((6, 7)) < 0.3) for i in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    def _assertFramesEqual(self, ima, expected):
+        np.testing.assert_array_equal(ima.data, expected.data)
+        np.testing.assert_array_equal(ima.mask, expected.mask)
+        self.assertEqual(ima.dtype.itemsize, expected.dtype.itemsize)
+
+    def testH5ContainerRandomAccess(self):
+        with temp.H5FrameContainer(self._folder, 'w') as container:
+            for i in (2, 0, 3, 1):
+                container.save(i, self.frames[i])
+            self.assertEqual(len(container), 4)
+        self.assertEqual(os.listdir(self._folder), [temp.FRAMES_CONTAINER_NAME])
+        with temp.H5FrameContainer(self._folder) as container:
+            for i in (3, 1, 0, 2):
+                self._assertFramesEqual(container.read(i), self.frames[i])
+            self.assertRaises(IndexError, container.read, 4)
+
+    def testFrameReaderIsTransparent(self):
+        for storage in ('fits', 'h5'):
+            folder = os.path.join(self._folder, storage)
+            os.makedirs(folder)
+            with temp.openFrameStorage(folder, storage, 'w') as frames:
+                for i, ima in enumerate(self.frames):
+                    frames.save(i, ima)
+            self.assertEqual(temp.frameStorageType(folder), storage)
+            with temp.FrameReader(folder) as reader:
+                self._assertFramesEqual(reader(2), self.frames[2])
+                reader = pickle.loads(pickle.dumps(reader))
+                self._assertFramesEqual(reader(1), self.frames[1])
+            self._assertFramesEqual(temp.interf_readFrame(folder, 3),
+                                    self.frames[3])
+        self.assertRaises(ValueError, temp.openFrameStorage, self._folder,
+                          'tiff')
+
+
+class TestTemporaryFileName(unittest.TestCase):
+
+    def testPermissionsFollowTheUmask(self):
+        folder = tempfile.mkdtemp()
+        umask = os.umask(0o027)
+        try:
+            file_name = temp.temporaryFileName(folder)
+            self.assertEqual(os.path.dirname(file_name), folder)
+            self.assertEqual(os.stat(file_name).st_mode & 0o777, 0o640)
+        finally:
+            os.umask(umask)
+            shutil.rmtree(folder)
+
+    def testUmaskIsNotChanged(self):
+        folder = tempfile.mkdtemp()
+        try:
+            with mock.patch('os.umask', side_effect=AssertionError):
+                file_names = {temp.temporaryFileName(folder)
+                              for _ in range(10)}
+            self.assertEqual(len(file_names), 10)
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestMaskEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self._folder = tempfile.mkdtemp()
+        rng = np.random.default_rng(4)
+        self.ima = np.ma.masked_array(rng.standard_normal((30, 31)),
+                                      mask=rng.random((30, 31)) < 0.4)
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    def testEncodings(self):
+        mask = np.random.default_rng(5).random((5, 6, 7)) < 0.5
+        for packed in (True, False):
+            hdu = temp.maskToHDU(mask, packed)
+            decoded = temp.maskFromHDU(hdu)
+            self.assertEqual(decoded.dtype, bool)
+            np.testing.assert_array_equal(decoded, mask)
+        self.assertEqual(temp.maskToHDU(mask).data.nbytes,
+                         int(np.ceil(mask.size / 8)))
+
+    def testUnmaskedImages(self):
+        ima = np.ma.masked_array(self.ima.data)
+        self.assertRaises(ValueError, temp.maskToHDU, ima.mask)
+        hdu = temp.maskToHDU(np.ma.getmaskarray(ima))
+        np.testing.assert_array_equal(temp.maskFromHDU(hdu),
+                                      np.zeros(ima.shape, dtype=bool))
+
+    def testPhasemapIsSmallerAndLegacyFilesAreReadable(self):
+        temp.interf_save_phasemap(self._folder, 'new.fits', self.ima)
+        legacy = os.path.join(self._folder, 'legacy.fits')
+        fits.writeto(legacy, self.ima.data)
+        fits.append(legacy, self.ima.mask.astype(int))
+        for name in ('new.fits', 'legacy.fits'):
+            ima = temp.interf_readImage(os.path.join(self._folder, name))
+            np.testing.assert_array_equal(ima.data, self.ima.data)
+            np.testing.assert_array_equal(ima.mask, self.ima.mask)
+        self.assertLess(os.path.getsize(os.path.join(self._folder, 'new.fits')),
+                        os.path.getsize(legacy))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,9 +6,15 @@ import os
 import numpy as np
 from astropy.io import fits
 import shutil
+import tempfile
+import contextlib
 import unittest
 import unittest.mock as mock
-from test.test_helper import testDataRootDir
+from test.test_helper import testDataRootDir, SyntheticDM, \
+    SyntheticInterferometer, saveModalBaseAndAmplitude, patchStorageFolders, \
+    patchTrackingNumbers
+from plico_dm_characterization.influenceFunctionsMaker import IFMaker
+from plico_dm_characterization.ground import geo
 from plico_dm_characterization.convertWFToDmCommand import Converter
 
 class TestConverterWF(unittest.TestCase):
@@ -35,3 +41,287 @@ class TestConverterWF(unittest.TestCase):
         self.cc.getAnalysisMask()
         self.cc.getReconstructor()
         #zernike_matrix = self.cc.getCommandsForZernikeModeOnDM(3)
+
+
+class TestConverterOnSyntheticCube(unittest.TestCase):
+
+    def _acquire(self, modal_base=None, **kwargs):
+        root = tempfile.mkdtemp()
+        self._roots.append(root)
+        with contextlib.ExitStack() as stack:
+            for patch in patchStorageFolders(root):
+                stack.enter_context(patch)
+            cmd_matrix_tag, amplitude_tag = saveModalBaseAndAmplitude(root, 4)
+            if modal_base is not None:
+                from plico_dm_characterization.type.modalBase import ModalBase
+                cmd_matrix_tag = 'otherBase'
+                ModalBase().saveAsFits(cmd_matrix_tag, modal_base)
+            iff = IFMaker(self.interf, self.dm)
+            tt = iff.acquisitionAndAnalysis(cmd_matrix_tag, amplitude_tag,
+                                            **kwargs)
+            cc = Converter(tt)
+        return iff, cc
+
+    def setUp(self):
+        self._roots = []
+        self.dm = SyntheticDM(4)
+        self.interf = SyntheticInterferometer(self.dm, n_pixels=32, noise=0)
+
+    def tearDown(self):
+        for root in self._roots:
+            shutil.rmtree(root)
+
+    def _wavefront(self, cmd):
+        self.dm.set_shape(cmd)
+        wf = self.interf.wavefront()
+        self.dm.set_shape(np.zeros(4))
+        return wf
+
+    def testCroppedCubeGivesTheSameCommand(self):
+        iff, cc = self._acquire(streaming=True)
+        iff_crop, cc_crop = self._acquire(crop_to_pupil=True, roi_margin=1)
+        roi = iff_crop.getRoi()
+        self.assertEqual(roi, geo.pupilRoi(self.interf.mask, 1))
+        self.assertEqual(iff_crop.getCube().shape, (roi[2], roi[3], 4))
+        self.assertLess(roi[2], 32)
+        self.assertEqual(cc_crop._roi, roi)
+        np.testing.assert_allclose(
+            iff_crop.getCube(), geo.cropToRoi(iff.getCube(), roi), atol=1e-12)
+
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        np.testing.assert_allclose(cc_crop.fromWfToDmCommand(wf),
+                                   cc.fromWfToDmCommand(wf), atol=1e-9)
+        cc_crop.setAnalysisMask(self.interf.mask)
+        self.assertEqual(cc_crop.getAnalysisMask().shape, roi[2:])
+
+    def testRoiFromPupilMask(self):
+        pupil_mask = np.ones((32, 32), dtype=bool)
+        pupil_mask[10:20, 8:22] = False
+        iff, cc = self._acquire(crop_to_pupil=True, pupil_mask=pupil_mask)
+        self.assertEqual(iff.getRoi(), (10, 8, 10, 14))
+        self.assertEqual(cc.getMasterMask().shape, (10, 14))
+
+    def testFloat32Cube(self):
+        iff, cc = self._acquire(streaming=True)
+        iff32, cc32 = self._acquire(cube_dtype=np.float32)
+        self.assertEqual(iff32.getCube().dtype, np.float32)
+        an = IFMaker.loadAnalyzerFromIFMaker(cc32._tn, os.path.join(
+            self._roots[-1], 'IFFunctions'))
+        self.assertEqual(an.getCubeDtype(), np.float32)
+        self.assertEqual(an.getCube().dtype, np.float32)
+        self.assertEqual(cc32._cube.dtype, np.float32)
+        self.assertEqual(cc32.getInteractionMatrix().dtype, np.float32)
+        self.assertEqual(cc32.getReconstructor().dtype, np.float32)
+        np.testing.assert_allclose(iff32.getCube(), iff.getCube(),
+                                   rtol=1e-4, atol=1e-5)
+
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        np.testing.assert_allclose(cc32.fromWfToDmCommand(wf),
+                                   cc.fromWfToDmCommand(wf), atol=1e-4)
+
+    def testInteractionMatrixFromThePupilIndexMap(self):
+        iff, cc = self._acquire()
+        cube = iff.getCube()
+        np.testing.assert_array_equal(cc.getMasterMask(),
+                                      np.sum(cube.mask, axis=2) > 0)
+        int_mat = cc.getInteractionMatrix()
+        for i in range(cube.shape[2]):
+            expected = np.ma.masked_array(
+                cube.data[:, :, i], mask=cc.getMasterMask()).compressed()
+            np.testing.assert_allclose(int_mat[:, i], expected, atol=1e-12)
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        cc.fromWfToDmCommand(wf)
+        self.assertEqual(cc.getPupilIndexMap().size,
+                         np.count_nonzero(~cc.getAnalysisMask()))
+        zernike_commands = cc.getCommandsForZernikeModeOnDM(3)
+        self.assertEqual(zernike_commands.shape, (4, 3))
+
+    def testReconstructorIsCachedOnDisk(self):
+        iff, cc = self._acquire()
+        rec = cc.getReconstructor()
+        with contextlib.ExitStack() as stack:
+            for patch in patchStorageFolders(self._roots[-1]):
+                stack.enter_context(patch)
+            cc_again = Converter(cc._tn)
+            no_cache = Converter(cc._tn, cache_size=0)
+        with mock.patch.object(Converter, '_createRecWithPseudoInverse',
+                               side_effect=AssertionError):
+            np.testing.assert_array_equal(cc_again.getReconstructor(), rec)
+        self.assertIsNone(no_cache._recCache)
+        np.testing.assert_allclose(no_cache.getReconstructor(), rec)
+
+    def testWavefrontMasksAreCachedOnlyOnRequest(self):
+        from plico_dm_characterization.ground.reconstructor_cache import \
+            ReconstructorCache
+        iff, cc = self._acquire()
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        wf.mask[16, 10:20] = True
+        with mock.patch.object(ReconstructorCache, 'save') as save:
+            command = cc.fromWfToDmCommand(wf)
+            cc.fromWfStackToDmCommands([wf, wf])
+            self.assertEqual(save.call_count, 0)
+        cc.cacheReconstructor()
+        with contextlib.ExitStack() as stack:
+            for patch in patchStorageFolders(self._roots[-1]):
+                stack.enter_context(patch)
+            cc_again = Converter(cc._tn)
+        with mock.patch.object(Converter, '_createRecWithPseudoInverse',
+                               side_effect=AssertionError):
+            np.testing.assert_array_equal(cc_again.fromWfToDmCommand(wf),
+                                          command)
+
+    def testFlatteningLoadsTheCachedReconstructor(self):
+        from plico_dm_characterization.configuration import config
+        from plico_dm_characterization.ground.reconstructor_cache import \
+            ReconstructorCache
+        from plico_dm_characterization.characterization.measurements \
+            import MeasurementAcquisition
+        iff, cc = self._acquire()
+        ma = MeasurementAcquisition(self.dm, self.interf)
+        with contextlib.ExitStack() as stack:
+            for patch in patchStorageFolders(self._roots[-1]) + [
+                    patchTrackingNumbers(),
+                    mock.patch.object(config, 'FLAT_ROOT_FOLD', os.path.join(
+                        self._roots[-1], 'Flattening'))]:
+                stack.enter_context(patch)
+            self.dm.set_shape(np.array([0.1, -0.2, 0.05, 0.3]))
+            ma.flattening(cc._tn)
+            np.testing.assert_allclose(self.dm.get_shape(), 0, atol=1e-5)
+            self.dm.set_shape(np.array([0.1, -0.2, 0.05, 0.3]))
+            with mock.patch.object(Converter, '_createRecWithPseudoInverse',
+                                   side_effect=AssertionError), \
+                    mock.patch.object(ReconstructorCache, 'save',
+                                      side_effect=AssertionError):
+                ma.flattening(cc._tn)
+            np.testing.assert_allclose(self.dm.get_shape(), 0, atol=1e-5)
+
+    def testReconstructorsOfTheLastMasksAreKept(self):
+        iff, cc = self._acquire()
+        cc._recCache = None
+        cc._nMasks = 2
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        other_wf = np.ma.masked_array(wf.data, wf.mask.copy())
+        other_wf.mask[16, 10:20] = True
+        third_wf = np.ma.masked_array(wf.data, wf.mask.copy())
+        third_wf.mask[10, 10:20] = True
+        with mock.patch('numpy.linalg.pinv', wraps=np.linalg.pinv) as pinv:
+            command = cc.fromWfToDmCommand(wf)
+            np.testing.assert_array_equal(cc.fromWfToDmCommand(wf), command)
+            self.assertEqual(pinv.call_count, 1)
+            other_command = cc.fromWfToDmCommand(other_wf)
+            np.testing.assert_array_equal(cc.fromWfToDmCommand(wf), command)
+            np.testing.assert_array_equal(cc.fromWfToDmCommand(other_wf),
+                                          other_command)
+            self.assertEqual(pinv.call_count, 2)
+            cc.fromWfToDmCommand(third_wf)
+            cc.fromWfToDmCommand(wf)
+            self.assertEqual(pinv.call_count, 4)
+
+    def testReconstructorsFromTheSvd(self):
+        iff, cc = self._acquire()
+        int_mat = cc.getInteractionMatrix()
+        u, s, vt = np.linalg.svd(int_mat, full_matrices=False)
+        with mock.patch('numpy.linalg.svd', wraps=np.linalg.svd) as svd:
+            np.testing.assert_allclose(cc.getSingularValues(), s)
+            for rcond in (1e-15, 1e-2, 0.5):
+                np.testing.assert_allclose(
+                    cc.createReconstructor(rcond),
+                    np.linalg.pinv(int_mat, rcond=rcond), atol=1e-10)
+            truncated = (u[:, :2] * s[:2]) @ vt[:2]
+            np.testing.assert_allclose(cc.createReconstructor(n_modes=2),
+                                       np.linalg.pinv(truncated), atol=1e-10)
+            alpha = 0.1 * s[0]
+            np.testing.assert_allclose(
+                cc.createReconstructor(tikhonov=alpha),
+                np.linalg.solve(int_mat.T @ int_mat + alpha**2 * np.eye(4),
+                                int_mat.T), atol=1e-10)
+            self.assertEqual(svd.call_count, 1)
+
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        command = cc.fromWfToDmCommand(wf)
+        cc.setRegularization(n_modes=2)
+        truncated_command = cc.fromWfToDmCommand(wf)
+        np.testing.assert_allclose(
+            truncated_command, cc.createReconstructor(n_modes=2) @
+            cc.getPupilIndexMap().compress(wf), atol=1e-12)
+        self.assertGreater(np.abs(truncated_command - command).max(), 1e-6)
+        cc.setRegularization()
+        np.testing.assert_allclose(cc.fromWfToDmCommand(wf), command,
+                                   atol=1e-10)
+
+    def testSvdIsKeptOnlyForTheCurrentMask(self):
+        iff, cc = self._acquire()
+        cc._recCache = None
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        cc.fromWfToDmCommand(wf)
+        self.assertIsNone(cc._svd)
+        cc.getSingularValues()
+        self.assertIsNotNone(cc._svd)
+        other_mask = cc.getMasterMask().copy()
+        other_mask[16, 10:20] = True
+        cc.setAnalysisMask(other_mask)
+        self.assertIsNone(cc._svd)
+        for analysis in cc._analyses.values():
+            self.assertEqual(len(analysis), 4)
+
+    def testStackOfWavefronts(self):
+        from scipy.linalg import hadamard
+        rng = np.random.default_rng(4)
+        wfs = []
+        for i in range(7):
+            wf = self._wavefront(rng.normal(0, 0.1, 4))
+            if i % 2:
+                wf.mask[16, 10:20] = True
+            wfs.append(wf)
+        stack = np.ma.stack(wfs)
+        for modal_base in (None, hadamard(4)):
+            iff, cc = self._acquire(modal_base)
+            cc._recCache = None
+            expected = np.stack([cc.fromWfToDmCommand(wf) for wf in wfs],
+                                axis=1)
+            with mock.patch('numpy.linalg.pinv', wraps=np.linalg.pinv) \
+                    as pinv:
+                commands = cc.fromWfStackToDmCommands(stack)
+                self.assertEqual(pinv.call_count, 0)
+            self.assertEqual(commands.shape, (4, 7))
+            np.testing.assert_allclose(commands, expected, atol=1e-10)
+            np.testing.assert_allclose(
+                cc.fromWfStackToDmCommands(iter(wfs), batch_size=3),
+                expected, atol=1e-10)
+        self.assertEqual(cc.fromWfStackToDmCommands([]).shape, (4, 0))
+
+    def testCommandMatrixFromTheCommandHistory(self):
+        from plico_dm_characterization.type.modalBase import ModalBase
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        iff, cc = self._acquire(np.diag([1., 2., 0.5, 1.]))
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        expected = cc.fromWfToDmCommand(wf)
+        with contextlib.ExitStack() as stack:
+            for patch in patchStorageFolders(self._roots[-1]):
+                stack.enter_context(patch)
+            os.remove(os.path.join(ModalBase._storageFolder(),
+                                   'otherBase.fits'))
+            np.testing.assert_allclose(
+                Converter(cc._tn).fromWfToDmCommand(wf), expected,
+                atol=1e-10)
+            shutil.rmtree(CmdHistory._storageFolder())
+            with self.assertRaises(OSError) as context:
+                Converter(cc._tn)
+            self.assertIn('otherBase.fits', str(context.exception))
+
+    def testModalBasesGiveTheSameCommand(self):
+        from scipy.linalg import hadamard
+        iff, cc = self._acquire()
+        wf = self._wavefront(np.array([0.1, -0.2, 0.05, 0.3]))
+        expected = cc.fromWfToDmCommand(wf)
+        for modal_base, cmd_type in ((hadamard(4), 'hadamard'),
+                                     (np.diag([1., 2., 0.5, 1.]), 'diagonal'),
+                                     (np.array([[1., 0, 0, 0], [1, 1, 0, 0],
+                                                [0, 1, 1, 0], [0, 0, 1, 1]]),
+                                      'dense')):
+            iff_modal, cc_modal = self._acquire(modal_base)
+            self.assertEqual(cc_modal._type, cmd_type)
+            # the median subtracted from the IFs leaves the piston free
+            command = cc_modal.fromWfToDmCommand(wf)
+            np.testing.assert_allclose(command - command.mean(),
+                                       expected - expected.mean(), atol=1e-4)
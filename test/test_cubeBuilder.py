@@ -0,0 +1,271 @@
+import unittest
+import numpy as np
+from plico_dm_characterization import cubeBuilder
+
+
+def legacyCreateCube(indexingList, actsVector, amplitude, template,
+                     nRepetitions, read_frame):
+    ''' Reference copy of the original IFMaker._createCube loops '''
+    indv = np.array(indexingList)
+    where = []
+    for ind in range(actsVector.shape[0]):
+        for j in range(nRepetitions):
+            where.append(np.where(indv[j] == ind)[0][0])
+    wh = []
+    for i in actsVector:
+        for j in range(nRepetitions):
+            wh.append(np.where(indexingList[j] == i))
+    wh = np.array(wh)
+    ampl_reorg = np.zeros(amplitude.shape[0] * nRepetitions)
+    for i in range(amplitude.shape[0]):
+        for k in range(nRepetitions):
+            ampl_reorg[wh[nRepetitions * i + k] + actsVector.shape[0] * k] = \
+                amplitude[i]
+
+    cube_all_act = []
+    for i in range(actsVector.shape[0]):
+        for k in range(nRepetitions):
+            n = where[nRepetitions * i + k]
+            mis_amp = k * indexingList.shape[1] + n
+            mis = (k * indexingList.shape[1] + n) * template.shape[0]
+            image_list = [read_frame(mis + l) for l in range(template.size)]
+            image = np.zeros((image_list[0].shape[0], image_list[0].shape[1]))
+            for p in range(1, len(image_list)):
+                opd2add = image_list[p] * template[p] + \
+                    image_list[p-1] * template[p-1]
+                master_mask2add = np.ma.mask_or(image_list[p].mask,
+                                                image_list[p-1].mask)
+                if p == 1:
+                    master_mask = master_mask2add
+                else:
+                    master_mask = np.ma.mask_or(master_mask, master_mask2add)
+                image += opd2add
+            image = np.ma.masked_array(image, mask=master_mask)
+            img_if = image / (2 * ampl_reorg[mis_amp] * (template.shape[0] - 1))
+            img_if = img_if - np.ma.median(img_if)
+            if k == 0:
+                all_push_pull_act_jth = img_if
+            else:
+                all_push_pull_act_jth = np.ma.dstack((all_push_pull_act_jth,
+                                                      img_if))
+        if nRepetitions == 1:
+            if_act_jth = all_push_pull_act_jth
+        else:
+            if_act_jth = np.ma.mean(all_push_pull_act_jth, axis=2)
+        cube_all_act.append(if_act_jth)
+    return np.ma.dstack(cube_all_act)
+
+
+class TestCubeBuilder(unittest.TestCase):
+
+    def _frames(self, indexing_list, amplitude, template, ifs):
+        frames = []
+        for mode in np.ravel(indexing_list):
+            for sign in template:
+                frames.append(np.ma.masked_array(
+                    ifs[:, :, mode] * amplitude[mode] * sign + 3.,
+                    mask=np.zeros(ifs.shape[:2], dtype=bool)))
+        return frames
+
+    def testTemplateWeights(self):
+        np.testing.assert_array_equal(
+            cubeBuilder.templateWeights(np.array([1, -1, 1])), [1, -2, 1])
+        np.testing.assert_array_equal(
+            cubeBuilder.templateWeights(np.array([1, -1])), [1, -1])
+        self.assertRaises(ValueError, cubeBuilder.templateWeights, [1])
+
+    def testStreamingReducerAcceptsFramesInAnyOrder(self):
+        rng = np.random.default_rng(1)
+        ifs = rng.standard_normal((5, 6, 3))
+        indexing_list = np.array([[2, 0, 1], [1, 2, 0]])
+        amplitude = np.array([0.1, 0.2, 0.3])
+        template = np.array([1, -1, 1])
+        frames = self._frames(indexing_list, amplitude, template, ifs)
+        reducer = cubeBuilder.StreamingReducer(indexing_list, amplitude,
+                                               template)
+        self.assertEqual(reducer.getNumberOfFrames(), len(frames))
+        order = rng.permutation(len(frames))
+        for i in order[:-1]:
+            reducer.addFrame(i, frames[i])
+        self.assertFalse(reducer.isComplete())
+        self.assertRaises(ValueError, reducer.getCube)
+        reducer.addFrame(order[-1], frames[order[-1]])
+        cube = reducer.getCube()
+        expected = ifs - np.median(ifs, axis=(0, 1))
+        np.testing.assert_allclose(cube, expected, atol=1e-12)
+
+    def _randomFrames(self, rng, n_frames, shape=(9, 8)):
+        frames = []
+        for i in range(n_frames):
+            mask = rng.random(shape) < 0.1
+            mask[0, :] = True
+            frames.append(np.ma.masked_array(
+                rng.standard_normal(shape).astype(np.float32), mask=mask))
+        return frames
+
+    def testFrameIndexes(self):
+        indexing_list = np.array([[2, 0, 1], [1, 2, 0]])
+        indexes = cubeBuilder.frameIndexes(indexing_list, 2)
+        self.assertEqual(indexes.shape, (3, 2, 2))
+        np.testing.assert_array_equal(indexes[0], [[2, 3], [10, 11]])
+        np.testing.assert_array_equal(indexes[2], [[0, 1], [8, 9]])
+        self.assertRaises(ValueError, cubeBuilder.frameIndexes,
+                          indexing_list, 2, np.array([3]))
+
+    def testCubeEngineMatchesLegacyCube(self):
+        rng = np.random.default_rng(2)
+        n_acts = 5
+        amplitude = rng.random(n_acts) + 0.5
+        for template in (np.array([1, -1, 1]), np.array([1, -1]),
+                         np.array([1, -1, 1, -1])):
+            for n_rep in (1, 3):
+                indexing_list = np.array([rng.permutation(n_acts)
+                                          for k in range(n_rep)])
+                frames = self._randomFrames(rng,
+                                            n_acts * n_rep * template.size)
+                acts = np.arange(n_acts)
+                expected = legacyCreateCube(indexing_list, acts, amplitude,
+                                            template, n_rep,
+                                            lambda i: frames[i])
+                engine = cubeBuilder.CubeEngine(indexing_list, amplitude,
+                                                template)
+                cube = engine.buildCube(lambda i: frames[i])
+                np.testing.assert_array_equal(cube.mask, expected.mask)
+                np.testing.assert_allclose(cube.compressed(),
+                                           expected.compressed(),
+                                           rtol=1e-12, atol=1e-15)
+                part = engine.buildCube(lambda i: frames[i],
+                                        slots=np.array([3, 1]))
+                np.testing.assert_array_equal(part, cube[:, :, [3, 1]])
+
+
+    def testVariableRepetitions(self):
+        rng = np.random.default_rng(3)
+        indexing_list = np.array([[2, 0, 1], [1, 2, 0], [2, -1, -1]])
+        np.testing.assert_array_equal(
+            cubeBuilder.repetitionCounts(indexing_list), [2, 2, 3])
+        indexes = cubeBuilder.frameIndexes(indexing_list, 2)
+        self.assertEqual(indexes.shape, (3, 3, 2))
+        np.testing.assert_array_equal(indexes[2], [[0, 1], [8, 9], [12, 13]])
+        np.testing.assert_array_equal(indexes[0], [[2, 3], [10, 11], [-1, -1]])
+
+        amplitude = np.array([0.1, 0.2, 0.3])
+        template = np.array([1, -1, 1])
+        frames = self._randomFrames(rng, 7 * template.size)
+        engine = cubeBuilder.CubeEngine(indexing_list, amplitude, template)
+        cube = engine.buildCube(lambda i: frames[i])
+        reducer = cubeBuilder.StreamingReducer(indexing_list[:2], amplitude,
+                                               template)
+        reducer.appendModes([2])
+        for i, frame in enumerate(frames):
+            reducer.addFrame(i, frame)
+        np.testing.assert_array_equal(reducer.getRepetitionCounts(),
+                                      [2, 2, 3])
+        np.testing.assert_allclose(reducer.getCube(), cube, rtol=1e-12)
+        np.testing.assert_array_equal(reducer.getCube().mask, cube.mask)
+        single = [cubeBuilder.CubeEngine(
+            [indexing_list[k]], amplitude, template).buildCube(
+                lambda i, k=k: frames[i + 9 * k])[:, :, 2] for k in range(2)]
+        last = cubeBuilder.CubeEngine(
+            [[2]], amplitude, template, acts_vector=[2]).buildCube(
+                lambda i: frames[i + 18])[:, :, 0]
+        expected = np.ma.mean(np.ma.dstack(single + [last]), axis=2)
+        np.testing.assert_allclose(cube[:, :, 2].compressed(),
+                                   expected.compressed(), rtol=1e-6)
+        repetition2 = cubeBuilder.CubeEngine(
+            indexing_list, amplitude, template,
+            repetitions=[2]).buildCube(lambda i: frames[i])
+        self.assertTrue(np.all(repetition2.mask[:, :, :2]))
+        np.testing.assert_allclose(repetition2[:, :, 2], last, rtol=1e-6)
+
+    def testSnrEstimate(self):
+        rng = np.random.default_rng(4)
+        ifs = rng.standard_normal((10, 10, 2))
+        amplitude = np.array([0.1, 0.01])
+        template = np.array([1, -1, 1])
+        indexing_list = np.array([[0, 1]] * 4)
+        reducer = cubeBuilder.StreamingReducer(indexing_list[:1], amplitude,
+                                               template)
+        frames = self._frames(indexing_list, amplitude, template, ifs)
+        for i in range(6):
+            reducer.addFrame(i, frames[i] + 1e-3 * rng.standard_normal((10, 10)))
+        np.testing.assert_array_equal(reducer.getSnr(), [0, 0])
+        reducer.appendModes(np.ravel(indexing_list[1:]))
+        for i in range(6, 24):
+            reducer.addFrame(i, frames[i] + 1e-3 * rng.standard_normal((10, 10)))
+        snr = reducer.getSnr()
+        self.assertGreater(snr[0], 5 * snr[1])
+        self.assertGreater(snr[1], 1)
+
+
+    def testWelfordVarianceOfRepetitions(self):
+        rng = np.random.default_rng(5)
+        n_acts = 4
+        n_rep = 5
+        amplitude = rng.random(n_acts) + 0.5
+        template = np.array([1, -1, 1])
+        indexing_list = np.array([rng.permutation(n_acts)
+                                  for k in range(n_rep)])
+        frames = self._randomFrames(rng, n_acts * n_rep * template.size)
+        engine = cubeBuilder.CubeEngine(indexing_list, amplitude, template)
+        cube, variance = engine.buildCube(lambda i: frames[i],
+                                          with_variance=True)
+        repetitions = np.ma.stack([
+            cubeBuilder.CubeEngine(indexing_list, amplitude, template,
+                                   repetitions=[k]).buildCube(
+                                       lambda i: frames[i])
+            for k in range(n_rep)])
+        counts = np.ma.count(repetitions, axis=0)
+        expected = np.ma.var(repetitions, axis=0, ddof=1)
+        np.testing.assert_array_equal(variance.mask, counts < 2)
+        np.testing.assert_allclose(variance.compressed(),
+                                   expected[counts >= 2].compressed(),
+                                   rtol=1e-10)
+        np.testing.assert_allclose(cube.compressed(),
+                                   repetitions.mean(axis=0).compressed(),
+                                   rtol=1e-10)
+        reducer = cubeBuilder.StreamingReducer(indexing_list, amplitude,
+                                               template)
+        for i, frame in enumerate(frames):
+            reducer.addFrame(i, frame)
+        np.testing.assert_allclose(reducer.getVariance(), variance,
+                                   rtol=1e-10)
+        np.testing.assert_array_equal(reducer.getVariance().mask,
+                                      variance.mask)
+
+    def testDriftCorrectorRemovesLinearDrift(self):
+        rng = np.random.default_rng(2)
+        ifs = rng.standard_normal((6, 5, 3))
+        indexing_list = np.array([[0, 1, 2], [2, 0, 1]])
+        amplitude = np.array([0.1, 0.2, 0.3])
+        template = np.array([1, -1])
+        frames = self._frames(indexing_list, amplitude, template, ifs)
+        pattern = rng.standard_normal((6, 5))
+        reference_every = 2
+        period = reference_every * template.size
+        drifting, references, t = [], [], 0
+        for i, frame in enumerate(frames):
+            if i % period == 0:
+                references.append(np.ma.masked_array(0.01 * t * pattern))
+                t += 1
+            drifting.append(frame + 0.01 * t * pattern)
+            t += 1
+        references.append(np.ma.masked_array(0.01 * t * pattern))
+
+        engine = cubeBuilder.CubeEngine(indexing_list, amplitude, template)
+        expected = engine.buildCube(lambda i: frames[i])
+        self.assertGreater(
+            np.abs(engine.buildCube(lambda i: drifting[i]) - expected).max(),
+            1e-3)
+        with cubeBuilder.DriftCorrector(
+                lambda i: drifting[i], lambda i: references[i],
+                template.size, reference_every, len(frames)) as read_frame:
+            self.assertEqual(read_frame.driftWeight(period), (1, 0.2))
+            np.testing.assert_allclose(engine.buildCube(read_frame),
+                                       expected, atol=1e-12)
+        self.assertRaises(ValueError, cubeBuilder.DriftCorrector,
+                          None, None, 3, 1, 9, 'quadratic')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import unittest
+import numpy as np
+from astropy.io import fits
+from test.test_helper import SyntheticInterferometer, StorageTestCase
+from plico_dm_characterization.influenceFunctionsMaker import IFMaker
+from plico_dm_characterization import cubeMerging
+from plico_dm_characterization.commandLine import main
+
+
+class TestCubeMerging(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.tts = []
+        for seed, n_rep in ((0, 2), (1, 3)):
+            interf = SyntheticInterferometer(self.dm, noise=1e-2, seed=seed)
+            iff = IFMaker(interf, self.dm)
+            self.tts.append(iff.acquisitionAndAnalysis(
+                self.cmd_matrix_tag, self.amplitude_tag, shuffle=True,
+                n_rep=n_rep))
+
+    def _load(self, tt):
+        return IFMaker.loadAnalyzerFromIFMaker(tt)
+
+    def testWeightedMeanOfTheCubes(self):
+        cubes = [self._load(tt).getCube() for tt in self.tts]
+        tt = cubeMerging.mergeCubes(self.tts, block_rows=5)
+        merged = self._load(tt)
+        self.assertEqual(merged.getMergedTrackingNumbers(), self.tts)
+        self.assertEqual(merged._nRepetitions, 5)
+        expected = np.ma.average(np.ma.stack(cubes), axis=0,
+                                 weights=[2, 3])
+        np.testing.assert_array_equal(merged.getCube().mask, expected.mask)
+        np.testing.assert_allclose(merged.getCube(), expected, rtol=1e-10)
+        self.assertIsNone(merged.getVariance())
+
+    def testInverseVarianceWeights(self):
+        ans = [self._load(tt) for tt in self.tts]
+        tt = cubeMerging.mergeCubes(self.tts, weights='inverse_variance')
+        weights = np.ma.stack([1 / an.getVariance() for an in ans])
+        values = np.ma.stack([an.getCube() for an in ans])
+        expected = np.ma.sum(values * weights, axis=0) / \
+            np.ma.sum(np.ma.masked_array(weights, values.mask), axis=0)
+        merged = self._load(tt).getCube()
+        np.testing.assert_allclose(merged, expected, rtol=1e-8)
+
+    def testMergedCubesAreNotReprocessed(self):
+        from plico_dm_characterization import cubeReprocessing
+        tt = cubeMerging.mergeCubes(self.tts)
+        self.assertRaises(ValueError, cubeReprocessing.reprocessCube, tt)
+
+    def testIncompatibleCubesAreRejected(self):
+        folder = os.path.join(self._root, 'IFFunctions', self.tts[1])
+        with fits.open(os.path.join(folder, 'Cube.fits'), mode='update') as h:
+            h[0].header['CMDMTAG'] = 'otherBase'
+        self.assertRaises(ValueError, cubeMerging.mergeCubes, self.tts)
+        self.assertRaises(ValueError, cubeMerging.mergeCubes, self.tts[:1])
+
+    def testCommandLine(self):
+        main(['merge'] + self.tts + ['--weights', '1,0'])
+        merged_tt = sorted(os.listdir(os.path.join(self._root,
+                                                   'IFFunctions')))[-1]
+        merged = self._load(merged_tt).getCube()
+        np.testing.assert_allclose(merged, self._load(self.tts[0]).getCube(),
+                                   rtol=1e-12)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import os
+import shutil
+import unittest
+import numpy as np
+from test.test_helper import SyntheticInterferometer, StorageTestCase
+from plico_dm_characterization.influenceFunctionsMaker import IFMaker
+from plico_dm_characterization.ground.lazy_cube import LazyCube
+from plico_dm_characterization import cubeReprocessing
+from plico_dm_characterization.commandLine import main
+
+
+class TestCubeReprocessing(StorageTestCase):
+
+    N_ACTS = 5
+
+    def setUp(self):
+        super().setUp()
+        self._ifFolder = os.path.join(self._root, 'IFFunctions')
+        interf = SyntheticInterferometer(self.dm, noise=1e-2)
+        self.iff = IFMaker(interf, self.dm)
+        self.tt = self.iff.acquisitionAndAnalysis(self.cmd_matrix_tag,
+                                                  self.amplitude_tag,
+                                                  shuffle=True, n_rep=2)
+
+    def _loadCube(self, tt=None):
+        return IFMaker.loadAnalyzerFromIFMaker(tt or self.tt,
+                                               self._ifFolder).getCube()
+
+    def testCommandLineRebuildsTheSameCube(self):
+        cube = self._loadCube()
+        main(['reprocess', self.tt, '-j', '2',
+              '--storage-folder', self._ifFolder])
+        np.testing.assert_array_equal(self._loadCube(), cube)
+        self.assertEqual(sorted(f for f in os.listdir(
+            os.path.join(self._ifFolder, self.tt)) if not f.startswith('image')),
+            ['Cube.fits', 'journal.fits'])
+
+    def testCubeFollowsTheUmask(self):
+        umask = os.umask(0o022)
+        try:
+            file_name = cubeReprocessing.reprocessCube(
+                self.tt, storage_folder=self._ifFolder)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(file_name).st_mode & 0o777, 0o644)
+
+    def testRepetitionsSubset(self):
+        file_name = cubeReprocessing.reprocessCube(
+            self.tt, repetitions=[1], cube_name='CubeRep1.fits',
+            storage_folder=self._ifFolder)
+        an = IFMaker.loadInfoFromIFMaker(self.tt, self._ifFolder)
+        an._repetitions = np.array([1])
+        expected = an._createCube()
+        self.assertTrue(os.path.exists(file_name))
+        from astropy.io import fits
+        with fits.open(file_name) as hduList:
+            self.assertEqual(hduList[0].header['REPSUSED'], '1')
+            np.testing.assert_array_equal(hduList[0].data, expected.data)
+        self.assertRaises(ValueError, cubeReprocessing.reprocessCube,
+                          self.tt, repetitions=[2],
+                          storage_folder=self._ifFolder)
+        self.assertRaises(ValueError, cubeReprocessing.reprocessCube,
+                          self.tt, template=[1, -1],
+                          storage_folder=self._ifFolder)
+
+    def testReprocessingDoesNotInheritThePreviousOne(self):
+        cube = self._loadCube()
+        cubeReprocessing.reprocessCube(self.tt, repetitions=[0],
+                                       template=[-1, 1, -1],
+                                       storage_folder=self._ifFolder)
+        self.assertFalse(np.allclose(self._loadCube(), cube))
+        cubeReprocessing.reprocessCube(self.tt, storage_folder=self._ifFolder)
+        an = IFMaker.loadInfoFromIFMaker(self.tt, self._ifFolder)
+        self.assertIsNone(an._repetitions)
+        np.testing.assert_array_equal(an._template, [1, -1, 1])
+        np.testing.assert_array_equal(self._loadCube(), cube)
+
+    def testCubeBuiltOnDiskWithinMemoryBudget(self):
+        an = IFMaker.loadAnalyzerFromIFMaker(self.tt, self._ifFolder)
+        cube, variance = an.getCube(), an.getVariance()
+        for n_workers in (1, 2):
+            cubeReprocessing.reprocessCube(
+                self.tt, n_workers=n_workers, memory_budget=20000,
+                cube_name='CubeOnDisk.fits', storage_folder=self._ifFolder)
+            with LazyCube(os.path.join(self._ifFolder, self.tt,
+                                       'CubeOnDisk.fits')) as lazy:
+                self.assertEqual(lazy.header['NACTS'], 5)
+                np.testing.assert_array_equal(lazy.toMaskedArray(), cube)
+                np.testing.assert_array_equal(lazy.mask, cube.mask)
+                np.testing.assert_allclose(lazy.getVariance(), variance)
+                np.testing.assert_array_equal(lazy.getVariance().mask,
+                                              variance.mask)
+
+    def testCubeOnDiskFollowsTheUmask(self):
+        umask = os.umask(0o022)
+        try:
+            file_name = cubeReprocessing.reprocessCube(
+                self.tt, memory_budget=20000, storage_folder=self._ifFolder)
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(file_name).st_mode & 0o777, 0o644)
+
+    def testBlockSize(self):
+        from plico_dm_characterization.cubeBuilder import CubeEngine
+        engine = CubeEngine(self.iff._indexingList, self.iff._amplitude,
+                            self.iff._template)
+        self.assertEqual(engine.getBlockSize((24, 24), 0), 1)
+        self.assertEqual(engine.getBlockSize((24, 24), 10**6),
+                         (10**6 - 576 * 3 * 9) // (576 * 27))
+
+    def testSplitByTrackingNumbers(self):
+        cube = self._loadCube()
+        copy_tt = self.tt + '_copy'
+        shutil.copytree(os.path.join(self._ifFolder, self.tt),
+                        os.path.join(self._ifFolder, copy_tt))
+        file_names = cubeReprocessing.reprocessCubes(
+            [self.tt, copy_tt], n_workers=2, split='tracking_numbers',
+            storage_folder=self._ifFolder)
+        self.assertEqual(len(file_names), 2)
+        np.testing.assert_array_equal(self._loadCube(copy_tt), cube)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,7 +4,133 @@ Created on 19 mag 2021
 @author: lbusoni
 '''
 import os
+import datetime
+import itertools
+import shutil
+import tempfile
+import unittest
+import unittest.mock as mock
+import numpy as np
 
 
 def testDataRootDir():
     return os.path.join(os.path.dirname(__file__), 'data')
+
+
+class SyntheticDM():
+    ''' Deformable mirror simulator for tests '''
+
+    def __init__(self, nActs):
+        self.nActs = nActs
+        self.cmd = np.zeros(nActs)
+
+    def get_number_of_actuators(self):
+        return self.nActs
+
+    def get_shape(self):
+        return self.cmd
+
+    def set_shape(self, cmd):
+        self.cmd = np.array(cmd)
+        return self.cmd
+
+
+class SyntheticInterferometer():
+    ''' Interferometer simulator looking at a SyntheticDM
+
+    The wavefront is the linear combination of gaussian influence
+    functions inside a circular pupil, plus a small random noise
+    '''
+
+    def __init__(self, dm, n_pixels=24, noise=1e-3, seed=0):
+        self._dm = dm
+        self._rng = np.random.default_rng(seed)
+        self._noise = noise
+        yy, xx = np.mgrid[0:n_pixels, 0:n_pixels]
+        center = (n_pixels - 1) / 2.
+        self.mask = np.hypot(yy - center, xx - center) > n_pixels / 2. - 3
+        self.influenceFunctions = np.zeros((n_pixels, n_pixels, dm.nActs))
+        angles = np.linspace(0, 2 * np.pi, dm.nActs, endpoint=False)
+        for i, angle in enumerate(angles):
+            cy = center + n_pixels / 5. * np.sin(angle)
+            cx = center + n_pixels / 5. * np.cos(angle)
+            self.influenceFunctions[:, :, i] = \
+                np.exp(-((yy - cy)**2 + (xx - cx)**2) / 8.)
+
+    def wavefront(self, n_images=1):
+        wf = np.dot(self.influenceFunctions, self._dm.get_shape())
+        wf = wf + self._noise * self._rng.standard_normal(wf.shape)
+        return np.ma.masked_array(wf, mask=self.mask.copy())
+
+
+def saveModalBaseAndAmplitude(root_folder, n_acts, amp=0.1):
+    ''' Saves a zonal modal base and a constant amplitude for tests '''
+    from plico_dm_characterization.type.modalBase import ModalBase
+    from plico_dm_characterization.type.modalAmplitude import ModalAmplitude
+    for folder in ('ModalBase', 'ModalAmplitude', 'CommandHistory',
+                   'IFFunctions'):
+        os.makedirs(os.path.join(root_folder, folder), exist_ok=True)
+    mb = ModalBase()
+    with mock.patch.object(ModalBase, '_storageFolder',
+                           return_value=os.path.join(root_folder, 'ModalBase')):
+        mb.saveAsFits('zonalBase', mb.getZonalMatrix(n_acts))
+    with mock.patch.object(ModalAmplitude, '_storageFolder',
+                           return_value=os.path.join(root_folder, 'ModalAmplitude')):
+        ModalAmplitude().saveAsFits('ampBase', np.ones(n_acts) * amp)
+    return 'zonalBase', 'ampBase'
+
+
+def patchStorageFolders(root_folder):
+    ''' Returns the list of patches moving all the storage folders
+    to root_folder '''
+    folders = {
+        'plico_dm_characterization.influenceFunctionsMaker.IFMaker': 'IFFunctions',
+        'plico_dm_characterization.type.modalBase.ModalBase': 'ModalBase',
+        'plico_dm_characterization.type.modalAmplitude.ModalAmplitude': 'ModalAmplitude',
+        'plico_dm_characterization.type.commandHistory.CmdHistory': 'CommandHistory',
+    }
+    return [mock.patch(target + '._storageFolder',
+                       return_value=os.path.join(root_folder, folder))
+            for target, folder in folders.items()]
+
+
+def patchTrackingNumbers():
+    ''' Returns the patch giving to the folders created by TtFolder
+    tracking numbers one second apart, so that the tests creating many
+    of them do not wait for the clock '''
+    start = datetime.datetime.now()
+    seconds = itertools.count()
+
+    def now():
+        tt = start + datetime.timedelta(seconds=next(seconds))
+        return tt.strftime('%Y%m%d_%H%M%S')
+    return mock.patch(
+        'plico_dm_characterization.ground.tracking_number_folder.Timestamp',
+        **{'now.side_effect': now})
+
+
+class StorageTestCase(unittest.TestCase):
+    ''' Test case storing its data in a temporary folder, self._root
+
+    setUp moves all the storage folders and the tracking numbers as
+    patchStorageFolders and patchTrackingNumbers, creates a SyntheticDM
+    of N_ACTS actuators (self.dm) and saves its zonal modal base and
+    amplitude (self.cmd_matrix_tag, self.amplitude_tag)
+    '''
+
+    N_ACTS = 4
+
+    def setUp(self):
+        self._root = tempfile.mkdtemp()
+        self._patches = patchStorageFolders(self._root)
+        self._patches.append(patchTrackingNumbers())
+        for patch in self._patches:
+            patch.start()
+        self.dm = SyntheticDM(self.N_ACTS)
+        self.cmd_matrix_tag, self.amplitude_tag = \
+            saveModalBaseAndAmplitude(self._root, self.N_ACTS)
+
+    def tearDown(self):
+        for patch in self._patches:
+            patch.stop()
+        shutil.rmtree(self._root)
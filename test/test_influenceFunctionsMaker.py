@@ -9,17 +9,29 @@ from astropy.io import fits
 import shutil
 import unittest
 import unittest.mock as mock
-from test.test_helper import testDataRootDir
+from test.test_helper import testDataRootDir, SyntheticInterferometer, \
+    StorageTestCase
 from plico_dm_characterization.influenceFunctionsMaker import IFMaker
+from plico_dm_characterization.type.commandHistory import CmdHistory
 
 class TestInfluenceFunctionsMaker(unittest.TestCase):
     
     def setUp(self):
         self.dm, self.interf = self._createDMAndInterf()
         self.iff = IFMaker(self.interf, self.dm)
+        self._dataFolders = {
+            folder: set(os.listdir(folder)) if os.path.isdir(folder) else set()
+            for folder in (os.path.join(testDataRootDir(), 'IFFunctions'),
+                           os.path.join(testDataRootDir(), 'CommandHistory'))}
 
     def tearDown(self):
         del(self.dm, self.interf)
+        # tracking numbers (and their journal.fits) left by a failed test
+        for folder, before in self._dataFolders.items():
+            if os.path.isdir(folder):
+                for name in set(os.listdir(folder)) - before:
+                    shutil.rmtree(os.path.join(folder, name),
+                                  ignore_errors=True)
     
     def _createDMAndInterf(self):
         class DM():
@@ -71,3 +83,445 @@ class TestInfluenceFunctionsMaker(unittest.TestCase):
         else:
             shutil.rmtree(os.path.join(testDataRootDir(), 'IFFunctions', tt))
             shutil.rmtree(os.path.join(testDataRootDir(), 'IFFunctions', tt2))
+
+
+class TestPipelinedAcquisition(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.interf = SyntheticInterferometer(self.dm, noise=0)
+
+    def _framesAndCube(self, tt, n_frames):
+        from plico_dm_characterization.ground import temp
+        dove = os.path.join(self._root, 'IFFunctions', tt)
+        frames = [temp.interf_readImage(os.path.join(dove, 'image_%04d.fits' % i))
+                  for i in range(n_frames)]
+        return frames, IFMaker.loadAnalyzerFromIFMaker(tt).getCube()
+
+    def testPipelinedAcquisitionMatchesSerialAcquisition(self):
+        iff = IFMaker(self.interf, self.dm)
+        tt = iff.acquisitionAndAnalysis(self.cmd_matrix_tag,
+                                        self.amplitude_tag, n_rep=2)
+        frames, cube = self._framesAndCube(tt, 4 * 2 * 3)
+        tt2 = iff.acquisitionAndAnalysis(self.cmd_matrix_tag,
+                                         self.amplitude_tag, n_rep=2,
+                                         pipelined=True, queue_size=2,
+                                         n_writers=2)
+        frames2, cube2 = self._framesAndCube(tt2, 4 * 2 * 3)
+        for ima, ima2 in zip(frames, frames2):
+            np.testing.assert_array_equal(ima, ima2)
+        np.testing.assert_array_equal(cube, cube2)
+        np.testing.assert_array_equal(cube.mask, cube2.mask)
+        np.testing.assert_array_equal(self.dm.get_shape(), np.zeros(4))
+
+    def testPipelinedAcquisitionReportsWriterErrors(self):
+        iff = IFMaker(self.interf, self.dm)
+        with mock.patch('plico_dm_characterization.ground.temp.interf_save_phasemap',
+                        side_effect=IOError('disk full')):
+            self.assertRaises(OSError, iff.acquisitionAndAnalysis,
+                              self.cmd_matrix_tag, self.amplitude_tag,
+                              pipelined=True)
+        np.testing.assert_array_equal(self.dm.get_shape(), np.zeros(4))
+
+
+class TestResumeAcquisition(StorageTestCase):
+
+    class FailingInterferometer():
+
+        def __init__(self, interf, n_good_frames):
+            self._interf = interf
+            self.nGoodFrames = n_good_frames
+
+        def wavefront(self, n_images=1):
+            if self.nGoodFrames == 0:
+                raise IOError('connection lost')
+            self.nGoodFrames -= 1
+            return self._interf.wavefront(n_images)
+
+    def setUp(self):
+        super().setUp()
+        self.interf = SyntheticInterferometer(self.dm, noise=0)
+        self.baseline = np.array([0.1, -0.2, 0.05, 0.3])
+
+    def _interruptedAcquisition(self, n_good_frames, **kwargs):
+        failing = self.FailingInterferometer(self.interf, n_good_frames)
+        iff = IFMaker(failing, self.dm)
+        self.dm.set_shape(self.baseline)
+        self.assertRaises(IOError, iff.acquisitionAndAnalysis,
+                          self.cmd_matrix_tag, self.amplitude_tag,
+                          shuffle=True, n_rep=2, **kwargs)
+        tt = os.listdir(os.path.join(self._root, 'IFFunctions'))[0]
+        return tt
+
+    def testResumeCompletesTheAcquisition(self):
+        from plico_dm_characterization.ground import temp
+        from plico_dm_characterization.ground.acquisition_journal import \
+            AcquisitionJournal
+        tt = self._interruptedAcquisition(10)
+        dove = os.path.join(self._root, 'IFFunctions', tt)
+        journal = AcquisitionJournal.load(dove)
+        self.assertEqual(journal.getNextFrameIndex(), 10)
+        np.testing.assert_array_equal(journal.getBaseline(), self.baseline)
+        self.assertFalse(os.path.exists(os.path.join(dove, 'Cube.fits')))
+        np.testing.assert_array_equal(self.dm.get_shape(), np.zeros(4))
+
+        iff = IFMaker(self.interf, self.dm)
+        self.assertEqual(iff.resume(tt), tt)
+        self.assertTrue(AcquisitionJournal.load(dove).isComplete())
+        cmdH = CmdHistory.load(iff._tt_cmdH).getCommandHistory()
+        with temp.FrameReader(dove) as reader:
+            cube = iff.getCube()
+            for i in range(4 * 2 * 3):
+                command = self.baseline + cmdH[:, i]
+                np.testing.assert_allclose(
+                    reader(i), np.dot(self.interf.influenceFunctions, command),
+                    atol=1e-12)
+        loaded = IFMaker.loadAnalyzerFromIFMaker(tt).getCube()
+        np.testing.assert_array_equal(loaded, cube)
+        ifs = self.interf.influenceFunctions[:, :, 2][~cube.mask[:, :, 2]]
+        np.testing.assert_allclose(cube[:, :, 2].compressed(),
+                                   ifs - np.median(ifs), atol=1e-12)
+
+    def testResumeOverwritesFramesAfterTheJournal(self):
+        from plico_dm_characterization.ground import temp
+        tt = self._interruptedAcquisition(10)
+        dove = os.path.join(self._root, 'IFFunctions', tt)
+        # frame saved before the journal recorded it (hard kill)
+        temp.interf_saveFrame(dove, 10, np.ma.masked_array(
+            np.ones(self.interf.mask.shape), mask=self.interf.mask))
+        iff = IFMaker(self.interf, self.dm)
+        self.assertEqual(iff.resume(tt), tt)
+        cmdH = CmdHistory.load(iff._tt_cmdH).getCommandHistory()
+        with temp.FrameReader(dove) as reader:
+            np.testing.assert_allclose(
+                reader(10), np.dot(self.interf.influenceFunctions,
+                                   self.baseline + cmdH[:, 10]), atol=1e-12)
+
+    def testResumePipelinedH5CroppedAcquisition(self):
+        tt = self._interruptedAcquisition(7, storage='h5', pipelined=True,
+                                          crop_to_pupil=True,
+                                          checkpoint_every=3)
+        iff = IFMaker(self.interf, self.dm)
+        iff.resume(tt, pipelined=True)
+        self.assertEqual(iff.getRoi(), (3, 3, 18, 18))
+        cube = IFMaker.loadAnalyzerFromIFMaker(tt).getCube()
+        self.assertEqual(cube.shape, (18, 18, 4))
+        self.assertFalse(np.all(cube.mask))
+
+    def testResumeFromTheLastReference(self):
+        tt = self._interruptedAcquisition(12, reference_every=2)
+        iff = IFMaker(self.interf, self.dm)
+        iff.resume(tt)
+        self.assertEqual(iff._referenceEvery, 2)
+        dove = os.path.join(self._root, 'IFFunctions', tt)
+        self.assertEqual(len(os.listdir(os.path.join(dove, 'references'))),
+                         5)
+        cube = IFMaker.loadAnalyzerFromIFMaker(tt).getCube()
+        ifs = self.interf.influenceFunctions[:, :, 2][~cube.mask[:, :, 2]]
+        np.testing.assert_allclose(cube[:, :, 2].compressed(),
+                                   ifs - np.median(ifs), atol=1e-12)
+
+    def testJournalIsWrittenOncePerTemplateSequence(self):
+        from plico_dm_characterization.ground import temp
+        iff = IFMaker(self.interf, self.dm)
+        with mock.patch.object(temp.H5FrameContainer, 'flush',
+                               autospec=True,
+                               side_effect=temp.H5FrameContainer.flush) \
+                as flush:
+            tt = iff.acquisitionAndAnalysis(
+                self.cmd_matrix_tag, self.amplitude_tag, n_rep=2,
+                storage='h5')
+        # 4 modes, 2 repetitions, template of 3 frames
+        self.assertEqual(flush.call_count, 4 * 2)
+        from plico_dm_characterization.ground.acquisition_journal import \
+            AcquisitionJournal
+        self.assertTrue(AcquisitionJournal.load(
+            os.path.join(self._root, 'IFFunctions', tt)).isComplete())
+
+    def testJournalFollowsTheUmask(self):
+        from plico_dm_characterization.ground.acquisition_journal import \
+            AcquisitionJournal, JOURNAL_NAME
+        umask = os.umask(0o022)
+        try:
+            AcquisitionJournal(self._root, fits.Header(), self.baseline,
+                               3).flush()
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(os.path.join(
+            self._root, JOURNAL_NAME)).st_mode & 0o777, 0o644)
+
+    def testResumeWithoutJournal(self):
+        iff = IFMaker(self.interf, self.dm)
+        os.makedirs(os.path.join(self._root, 'IFFunctions', 'missing'))
+        self.assertRaises(OSError, iff.resume, 'missing')
+
+
+class TestAdaptiveAcquisition(StorageTestCase):
+
+    def setUp(self):
+        from plico_dm_characterization.type.modalAmplitude import \
+            ModalAmplitude
+        super().setUp()
+        self.interf = SyntheticInterferometer(self.dm, noise=1e-3)
+        self.amplitude_tag = 'ampAdaptive'
+        ModalAmplitude().saveAsFits(self.amplitude_tag,
+                                    np.array([0.1, 0.1, 0.002, 0.1]))
+
+    def testNoisyModeIsMeasuredMoreTimes(self):
+        from plico_dm_characterization.cubeBuilder import repetitionCounts
+        for streaming in (False, True):
+            root = os.path.join(self._root, 'IFFunctions')
+            for tt in os.listdir(root):
+                shutil.rmtree(os.path.join(root, tt))
+            iff = IFMaker(self.interf, self.dm)
+            tt = iff.acquisitionAndAnalysis(self.cmd_matrix_tag,
+                                            self.amplitude_tag, shuffle=True,
+                                            n_rep=2, snr_target=20,
+                                            max_rep=5, streaming=streaming,
+                                            save_frames=True)
+            counts = repetitionCounts(iff._indexingList)
+            np.testing.assert_array_equal(counts, [2, 2, 5, 2])
+            an = IFMaker.loadAnalyzerFromIFMaker(tt)
+            np.testing.assert_array_equal(an._indexingList, iff._indexingList)
+            self.assertEqual(an._snrTarget, 20)
+            cube = an.getCube()
+            reprocessed = an._createCube()
+            np.testing.assert_allclose(cube, reprocessed, rtol=1e-10)
+            ifs = self.interf.influenceFunctions[:, :, 0][~cube.mask[:, :, 0]]
+            np.testing.assert_allclose(cube[:, :, 0].compressed(),
+                                       ifs - np.median(ifs), atol=0.05)
+
+
+class TestRemeasureActuators(StorageTestCase):
+
+    N_ACTS = 5
+
+    def setUp(self):
+        super().setUp()
+        self.interf = SyntheticInterferometer(self.dm, noise=1e-3)
+        self.iff = IFMaker(self.interf, self.dm)
+        self.tt = self.iff.acquisitionAndAnalysis(
+            self.cmd_matrix_tag, self.amplitude_tag, n_rep=2,
+            crop_to_pupil=True, cube_dtype=np.float32)
+        self.parent = IFMaker.loadAnalyzerFromIFMaker(self.tt)
+
+    def testRemeasuredSlicesReplaceTheParentOnes(self):
+        from plico_dm_characterization import cubeReprocessing
+        self.interf.influenceFunctions[:, :, 3] *= 2
+        tt = self.iff.remeasureActuators(self.tt, [3, 1], shuffle=True)
+        dove = os.path.join(self._root, 'IFFunctions', tt)
+        self.assertEqual(len([f for f in os.listdir(dove)
+                              if f.startswith('image')]), 2 * 2 * 3)
+        child = IFMaker.loadAnalyzerFromIFMaker(tt)
+        self.assertEqual(child.getParentTrackingNumber(), self.tt)
+        np.testing.assert_array_equal(child.getRemeasuredModes(), [1, 3])
+        self.assertEqual(child.getRoi(), self.parent.getRoi())
+        self.assertEqual(child.getCubeDtype(), np.float32)
+        cube, parent_cube = child.getCube(), self.parent.getCube()
+        for act in (0, 2, 4):
+            np.testing.assert_array_equal(cube[:, :, act],
+                                          parent_cube[:, :, act])
+        np.testing.assert_allclose(cube[:, :, 1], parent_cube[:, :, 1],
+                                   atol=0.05)
+        np.testing.assert_allclose(
+            cube[:, :, 3].compressed() - np.ma.median(cube[:, :, 3]),
+            2 * (parent_cube[:, :, 3].compressed() -
+                 np.ma.median(parent_cube[:, :, 3])), atol=0.05)
+        variance = child.getVariance()
+        np.testing.assert_array_equal(variance[:, :, 0],
+                                      self.parent.getVariance()[:, :, 0])
+        cubeReprocessing.reprocessCube(tt, cube_name='Rebuilt.fits')
+        from plico_dm_characterization.ground.lazy_cube import LazyCube
+        with LazyCube(os.path.join(dove, 'Rebuilt.fits')) as lazy:
+            np.testing.assert_array_equal(lazy.toMaskedArray(), cube)
+            self.assertEqual(lazy.header['PARENT'], self.tt)
+
+    def testRemeasureChecksTheModes(self):
+        self.assertRaises(ValueError, self.iff.remeasureActuators,
+                          self.tt, [7])
+        self.assertRaises(ValueError, self.iff.remeasureActuators,
+                          self.tt, [1, 1])
+
+
+class TestReferenceFrames(StorageTestCase):
+
+    class DriftingInterferometer():
+        def __init__(self, interf, drift):
+            self._interf = interf
+            self._drift = drift
+            self._nImages = 0
+
+        def wavefront(self, n_images=1):
+            image = self._interf.wavefront(n_images)
+            self._nImages += 1
+            return image + self._nImages * self._drift
+
+    def setUp(self):
+        super().setUp()
+        interf = SyntheticInterferometer(self.dm, noise=0)
+        yy, xx = np.mgrid[0:24, 0:24]
+        self.interf = self.DriftingInterferometer(interf, 1e-3 * (xx - yy))
+        self.ifs = interf.influenceFunctions
+
+    def _error(self, tt):
+        cube = IFMaker.loadAnalyzerFromIFMaker(tt).getCube()
+        errors = []
+        for i in range(cube.shape[2]):
+            ifs = self.ifs[:, :, i][~cube.mask[:, :, i]]
+            errors.append(cube[:, :, i].compressed() - ifs + np.median(ifs))
+        return np.abs(errors).max()
+
+    def testReferencesRemoveTheDrift(self):
+        template = np.array([1, -1])
+        iff = IFMaker(self.interf, self.dm)
+        tt_drift = iff.acquisitionAndAnalysis('zonalBase', 'ampBase', n_rep=2,
+                                              template=template)
+        tt = iff.acquisitionAndAnalysis('zonalBase', 'ampBase', n_rep=2,
+                                        template=template, reference_every=3)
+        self.assertLess(self._error(tt), 1e-10)
+        self.assertGreater(self._error(tt_drift), 1e-3)
+
+        folder = os.path.join(self._root, 'IFFunctions', tt)
+        self.assertEqual(len(os.listdir(os.path.join(folder, 'references'))),
+                         4)
+        header = fits.getheader(os.path.join(folder, 'Cube.fits'))
+        self.assertEqual(header['REFEVERY'], 3)
+        self.assertEqual(header['DRIFTMOD'], 'linear')
+        an = IFMaker.loadAnalyzerFromIFMaker(tt)
+        self.assertEqual(an._referenceEvery, 3)
+        np.testing.assert_allclose(an._createCube(), an.getCube(),
+                                   rtol=1e-10)
+        self.assertRaises(ValueError, iff.acquisitionAndAnalysis,
+                          'zonalBase', 'ampBase', streaming=True,
+                          reference_every=3)
+
+
+class TestStreamingAcquisition(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.interf = SyntheticInterferometer(self.dm, noise=0)
+
+    def testStreamingCubeMatchesCubeFromDisk(self):
+        iff = IFMaker(self.interf, self.dm)
+        iff.acquisitionAndAnalysis(self.cmd_matrix_tag, self.amplitude_tag,
+                                   shuffle=True, n_rep=2,
+                                   streaming=True, save_frames=True)
+        streamed = iff.getCube()
+        cube = iff._createCube()
+        np.testing.assert_array_equal(streamed.mask, cube.mask)
+        np.testing.assert_allclose(streamed.compressed(), cube.compressed(),
+                                   rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(
+            streamed[:, :, 1].compressed(),
+            self.interf.influenceFunctions[:, :, 1][~cube.mask[:, :, 1]] -
+            np.median(self.interf.influenceFunctions[:, :, 1][~cube.mask[:, :, 1]]),
+            atol=1e-12)
+
+    def testStreamingWithoutSavingFrames(self):
+        iff = IFMaker(self.interf, self.dm)
+        tt = iff.acquisitionAndAnalysis(self.cmd_matrix_tag, self.amplitude_tag,
+                                        streaming=True, pipelined=True)
+        self.assertEqual(os.listdir(os.path.join(self._root, 'IFFunctions', tt)),
+                         ['Cube.fits'])
+        self.assertEqual(IFMaker.loadAnalyzerFromIFMaker(tt).getCube().shape,
+                         (24, 24, 4))
+
+    def testFramesMustBeSavedWithoutStreaming(self):
+        iff = IFMaker(self.interf, self.dm)
+        self.assertRaises(ValueError, iff.acquisitionAndAnalysis,
+                          self.cmd_matrix_tag, self.amplitude_tag,
+                          save_frames=False)
+
+
+class TestH5FrameStorage(StorageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.interf = SyntheticInterferometer(self.dm, noise=1e-2)
+
+    def testAcquisitionInH5Container(self):
+        from plico_dm_characterization.ground import temp
+        iff = IFMaker(self.interf, self.dm)
+        tt = iff.acquisitionAndAnalysis(self.cmd_matrix_tag, self.amplitude_tag,
+                                        n_rep=2, storage='h5',
+                                        pipelined=True, n_writers=4)
+        dove = os.path.join(self._root, 'IFFunctions', tt)
+        self.assertEqual(sorted(os.listdir(dove)),
+                         ['Cube.fits', temp.FRAMES_CONTAINER_NAME,
+                          'journal.fits'])
+        with temp.H5FrameContainer(dove) as container:
+            self.assertEqual(len(container), 4 * 2 * 3)
+        cube = iff.getCube()
+        np.testing.assert_array_equal(iff._createCube(), cube)
+
+
+class TestLazyCube(StorageTestCase):
+
+    N_ACTS = 5
+
+    def setUp(self):
+        super().setUp()
+        interf = SyntheticInterferometer(self.dm, noise=1e-2)
+        self.iff = IFMaker(interf, self.dm)
+        self.tt = self.iff.acquisitionAndAnalysis(self.cmd_matrix_tag,
+                                                  self.amplitude_tag,
+                                                  streaming=True)
+
+    def testLazyLoading(self):
+        from plico_dm_characterization.ground.lazy_cube import LazyCube
+        cube = self.iff.getCube()
+        info = IFMaker.loadInfoFromIFMaker(self.tt)
+        self.assertIsNone(info.getCube())
+        self.assertEqual(info._nActs, 5)
+        an = IFMaker.loadAnalyzerFromIFMaker(self.tt, lazy=True)
+        lazy = an.getCube()
+        self.assertIsInstance(lazy, LazyCube)
+        self.assertEqual(lazy.shape, cube.shape)
+        self.assertEqual(lazy.dtype, np.float64)
+        self.assertEqual(lazy.header['NACTS'], 5)
+        self.assertEqual(lazy.mask.dtype, bool)
+        ifs = lazy.getActuators([3, 1])
+        np.testing.assert_array_equal(ifs.data, cube.data[:, :, [3, 1]])
+        np.testing.assert_array_equal(ifs.mask, cube.mask[:, :, [3, 1]])
+        np.testing.assert_array_equal(lazy[:, :, 2], cube[:, :, 2])
+        lazy.close()
+        np.testing.assert_array_equal(ifs.data, cube.data[:, :, [3, 1]])
+
+    def testVarianceIsSavedAndLoaded(self):
+        self.assertIsNone(IFMaker.loadAnalyzerFromIFMaker(self.tt).getVariance())
+        tt = self.iff.acquisitionAndAnalysis('zonalBase', 'ampBase', n_rep=3)
+        variance = self.iff.getVariance()
+        self.assertEqual(variance.shape, self.iff.getCube().shape)
+        self.assertGreater(variance.mean(), 0)
+        loaded = IFMaker.loadAnalyzerFromIFMaker(tt).getVariance()
+        np.testing.assert_array_equal(loaded.mask, variance.mask)
+        np.testing.assert_allclose(loaded, variance)
+        an = IFMaker.loadAnalyzerFromIFMaker(tt, lazy=True)
+        np.testing.assert_allclose(an.getVariance(), variance)
+        an.getCube().close()
+
+    def testAcquisitionWithMemoryBudget(self):
+        from plico_dm_characterization.ground.lazy_cube import LazyCube
+        cube = self.iff.getCube()
+        tt = self.iff.acquisitionAndAnalysis('zonalBase', 'ampBase',
+                                             memory_budget=1)
+        self.assertIsInstance(self.iff.getCube(), LazyCube)
+        self.assertIsNone(self.iff.getVariance())
+        loaded = IFMaker.loadAnalyzerFromIFMaker(tt).getCube()
+        np.testing.assert_array_equal(loaded.mask, cube.mask)
+        self.assertEqual(loaded.dtype, cube.dtype)
+        self.iff.getCube().close()
+        self.assertRaises(ValueError, self.iff.acquisitionAndAnalysis,
+                          'zonalBase', 'ampBase', streaming=True,
+                          memory_budget=1)
+
+    def testLegacyIntMask(self):
+        from astropy.io import fits
+        from plico_dm_characterization.ground.lazy_cube import LazyCube
+        file_name = os.path.join(self._root, 'legacy.fits')
+        cube = self.iff.getCube()
+        fits.writeto(file_name, cube.data)
+        fits.append(file_name, cube.mask.astype(int))
+        with LazyCube(file_name) as lazy:
+            np.testing.assert_array_equal(lazy.toMaskedArray().mask, cube.mask)
@@ -6,9 +6,11 @@ import os
 import numpy as np
 import time
 import shutil
+import tempfile
 import unittest
 import unittest.mock as mock
-from test.test_helper import testDataRootDir
+from astropy.io import fits as pyfits
+from test.test_helper import testDataRootDir, patchTrackingNumbers
 
 class TestTypes(unittest.TestCase):
 
@@ -72,3 +74,252 @@ class TestTypes(unittest.TestCase):
         else:
             shutil.rmtree(os.path.join(testDataRootDir(), 'CommandHistory', tt1))
             shutil.rmtree(os.path.join(testDataRootDir(), 'CommandHistory', tt2))
+            shutil.rmtree(os.path.join(testDataRootDir(), 'CommandHistory',
+                                       'CommandMatrix'))
+
+
+class TestCommandHistoryConstruction(unittest.TestCase):
+
+    def _expectedHistory(self, indexing_list, modes, amplitude, cmd_matrix,
+                         template):
+        columns = []
+        for mode in np.ravel(indexing_list):
+            amp = amplitude[list(modes).index(mode)]
+            for sign in template:
+                columns.append(cmd_matrix[:, mode] * amp * sign)
+        return np.array(columns).T
+
+    def testHistoryColumns(self):
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        rng = np.random.default_rng(0)
+        cmd_matrix = rng.standard_normal((6, 6))
+        modes = np.array([4, 1, 3])
+        amplitude = np.array([0.1, 0.2, 0.3])
+        template = np.array([1, -1, 1])
+        for shuffle in (False, True):
+            cmdH = CmdHistory(6)
+            with mock.patch.object(CmdHistory, 'saveInfo', return_value='tt'):
+                if shuffle:
+                    cmd, _ = cmdH.shuffleCommandHistoryMaker(
+                        modes.copy(), amplitude, cmd_matrix, 2, template)
+                else:
+                    cmd, _ = cmdH.tidyCommandHistoryMaker(
+                        modes.copy(), amplitude, cmd_matrix, 2, template)
+            indexing_list = cmdH.getIndexingList()
+            self.assertEqual(indexing_list.shape, (2, 3))
+            self.assertEqual(cmd.dtype, np.float64)
+            np.testing.assert_array_equal(
+                cmd, self._expectedHistory(indexing_list, modes, amplitude,
+                                           cmd_matrix, template))
+
+    def testLazyHistoryMatchesTheMatrix(self):
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        from scipy.linalg import hadamard
+        modes = np.arange(8)
+        amplitude = np.linspace(0.1, 0.8, 8)
+        template = np.array([1, -1, 1])
+        for shuffle in (False, True):
+            histories = []
+            for lazy in (False, True):
+                cmdH = CmdHistory(8)
+                maker = cmdH.shuffleCommandHistoryMaker if shuffle \
+                    else cmdH.tidyCommandHistoryMaker
+                np.random.seed(1)
+                with mock.patch.object(CmdHistory, 'saveInfo',
+                                       return_value='tt'):
+                    history, _ = maker(modes.copy(), amplitude, hadamard(8),
+                                       2, template, lazy=lazy)
+                histories.append(history)
+            dense, lazy = histories
+            self.assertEqual(lazy.shape, dense.shape)
+            self.assertIs(cmdH.getLazyCommandHistory(), lazy)
+            np.testing.assert_array_equal(lazy.toDense(), dense)
+            np.testing.assert_array_equal(cmdH.getCommandHistory(), dense)
+            np.testing.assert_array_equal(lazy[:, 5], dense[:, 5])
+            np.testing.assert_array_equal(lazy[:, -1], dense[:, -1])
+            np.testing.assert_array_equal(lazy[2:4, 3:9:2], dense[2:4, 3:9:2])
+            self.assertEqual(len(lazy), len(dense))
+            np.testing.assert_array_equal(list(lazy), list(dense))
+            self.assertRaises(IndexError, lazy.__getitem__,
+                              (slice(None), dense.shape[1]))
+
+
+class TestCommandHistoryStorage(unittest.TestCase):
+
+    def setUp(self):
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        self._root = tempfile.mkdtemp()
+        for patcher in (mock.patch.object(CmdHistory, '_storageFolder',
+                                          return_value=self._root),
+                        patchTrackingNumbers()):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self._root)
+
+    def testCommandMatrixIsSavedOnce(self):
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        modal_base = np.random.default_rng(3).standard_normal((6, 6))
+        cmd1, tt1 = CmdHistory(6).tidyCommandHistoryMaker(
+            np.arange(6), np.full(6, 0.1), modal_base, 2, np.array([1, -1]))
+        cmd2, tt2 = CmdHistory(6).shuffleCommandHistoryMaker(
+            np.arange(6), np.full(6, 0.2), modal_base, 1)
+        self.assertEqual(
+            os.listdir(os.path.join(self._root, 'CommandMatrix')),
+            [CmdHistory.load(tt1).getCommandMatrix().getHash() + '.fits'])
+        with pyfits.open(os.path.join(self._root, tt1, 'info.fits')) as hdul:
+            self.assertEqual(len(hdul), 3)
+        for tt, cmd in ((tt1, cmd1), (tt2, cmd2)):
+            loaded = CmdHistory.load(tt)
+            self.assertIsNotNone(loaded.getLazyCommandHistory())
+            np.testing.assert_array_equal(loaded.getCommandHistory(), cmd)
+
+    def testSharedCommandMatrixFollowsTheUmask(self):
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        umask = os.umask(0o022)
+        try:
+            CmdHistory(4).tidyCommandHistoryMaker(
+                np.arange(4), np.full(4, 0.1), np.eye(4), 1)
+        finally:
+            os.umask(umask)
+        folder = os.path.join(self._root, 'CommandMatrix')
+        file_name = os.path.join(folder, os.listdir(folder)[0])
+        self.assertEqual(os.stat(file_name).st_mode & 0o777, 0o644)
+
+    def testH5RoundTrip(self):
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        cmdH = CmdHistory(4)
+        cmd, _ = cmdH.tidyCommandHistoryMaker(
+            np.arange(4), np.full(4, 0.1), np.eye(4), 1, np.array([1, -1]))
+        tt = cmdH.saveInfo(1)
+        loaded = CmdHistory.load(tt, 1)
+        np.testing.assert_array_equal(loaded.getCommandHistory(), cmd)
+        np.testing.assert_array_equal(
+            loaded.getLazyCommandHistory().getTemplate(), [1, -1])
+
+    def testLegacyFilesAreLoaded(self):
+        import h5py
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        modes = np.arange(3)
+        indexing_list = np.array([[0, 1, 2]])
+        modal_base = np.diag([1., 2., 3.])
+        amplitude = np.full(3, 0.5)
+        history = np.repeat(modal_base * 0.5, 2, axis=1) * \
+            np.tile([1, -1], 3)
+        folder = os.path.join(self._root, '20240101_000000')
+        os.makedirs(folder)
+        header = pyfits.Header()
+        header['NREP'] = 1
+        file_name = os.path.join(folder, 'info.fits')
+        pyfits.writeto(file_name, modes, header)
+        for data in (indexing_list, modal_base, history, amplitude):
+            pyfits.append(file_name, data, header)
+        with h5py.File(os.path.join(folder, 'info.h5'), 'w') as hf:
+            hf.create_dataset('dataset_1', data=modes)
+            hf.create_dataset('dataset_2', data=indexing_list)
+            hf.create_dataset('dataset_3', data=history)
+            hf.create_dataset('dataset_4', data=amplitude)
+            hf.attrs['NREP'] = 1
+        for fits_or_h5 in (0, 1):
+            loaded = CmdHistory.load('20240101_000000', fits_or_h5)
+            self.assertIsNone(loaded.getLazyCommandHistory())
+            np.testing.assert_array_equal(loaded.getCommandHistory(), history)
+            np.testing.assert_array_equal(loaded.getIndexingList(),
+                                          indexing_list)
+
+
+class TestCommandMatrix(unittest.TestCase):
+
+    def testClassification(self):
+        from scipy.linalg import hadamard
+        from plico_dm_characterization.type.commandMatrix import \
+            CommandMatrix
+        rng = np.random.default_rng(0)
+        permuted = hadamard(64)[rng.permutation(64)][:, rng.permutation(64)]
+        selected = hadamard(64)[rng.permutation(64)[:40]][
+            :, rng.permutation(64)[:50]]
+        matrices = [(np.eye(6), 'zonal'),
+                    (np.diag([0.5, 1., 2.]), 'diagonal'),
+                    (hadamard(128), 'hadamard'),
+                    (permuted, 'hadamard'),
+                    (-hadamard(4), 'dense'),
+                    (hadamard(128)[:88, :88], 'dense'),
+                    (selected, 'dense'),
+                    (np.ones((4, 4)), 'dense'),
+                    (rng.choice([-1, 1], (16, 16)), 'dense'),
+                    (rng.standard_normal((6, 4)), 'dense')]
+        for matrix, expected in matrices:
+            cmd_matrix = CommandMatrix(matrix)
+            self.assertEqual(cmd_matrix.getType(), expected)
+            self.assertEqual(cmd_matrix.shape, matrix.shape)
+            np.testing.assert_array_equal(cmd_matrix.toDense(), matrix)
+            np.testing.assert_array_equal(cmd_matrix.getColumns([2, 0]),
+                                          matrix[:, [2, 0]])
+            coefficients = rng.standard_normal((matrix.shape[1], 3))
+            np.testing.assert_allclose(cmd_matrix.dot(coefficients),
+                                       matrix @ coefficients, atol=1e-12)
+            np.testing.assert_allclose(cmd_matrix.dot(coefficients[:, 0]),
+                                       matrix @ coefficients[:, 0],
+                                       atol=1e-12)
+        self.assertIsNone(CommandMatrix(np.eye(4))._matrix)
+        self.assertRaises(ValueError, CommandMatrix, np.ones(3))
+
+    def testWalshHadamardTransform(self):
+        from scipy.linalg import hadamard
+        from plico_dm_characterization.type.commandMatrix import \
+            walshHadamardTransform
+        data = np.random.default_rng(1).standard_normal((16, 2))
+        np.testing.assert_allclose(walshHadamardTransform(data),
+                                   hadamard(16) @ data, atol=1e-12)
+        self.assertRaises(ValueError, walshHadamardTransform, np.ones(6))
+
+    def testHashDependsOnlyOnTheContent(self):
+        from scipy.linalg import hadamard
+        from plico_dm_characterization.type.commandMatrix import \
+            CommandMatrix
+        matrix = hadamard(8)[1:7, :5].astype(float)
+        dense = CommandMatrix._structured('dense', matrix.shape, matrix.dtype)
+        dense._matrix = matrix
+        self.assertEqual(CommandMatrix(matrix).getHash(), dense.getHash())
+        self.assertEqual(CommandMatrix(np.eye(4)).getHash(),
+                         CommandMatrix.fromDiagonal(np.ones(4)).getHash())
+        self.assertNotEqual(CommandMatrix(np.eye(4)).getHash(),
+                            CommandMatrix(2 * np.eye(4)).getHash())
+
+    def testSaveAndLoadFromFits(self):
+        from scipy.linalg import hadamard
+        from plico_dm_characterization.type.commandMatrix import \
+            CommandMatrix
+        rng = np.random.default_rng(2)
+        root = tempfile.mkdtemp()
+        try:
+            for matrix in (np.eye(5), np.diag([1., 2., 3.]),
+                           hadamard(16)[::-1, 3::-1].astype(float),
+                           rng.standard_normal((6, 4))):
+                cmd_matrix = CommandMatrix(matrix)
+                file_name = os.path.join(root, 'cmd.fits')
+                cmd_matrix.saveAsFits(file_name)
+                loaded = CommandMatrix.loadFromFits(file_name)
+                self.assertEqual(loaded.getType(), cmd_matrix.getType())
+                self.assertEqual(loaded.shape, matrix.shape)
+                self.assertEqual(loaded.getHash(), cmd_matrix.getHash())
+                np.testing.assert_array_equal(loaded.toDense(), matrix)
+        finally:
+            shutil.rmtree(root)
+
+    def testDiagonalIsSavedInCommandHistory(self):
+        from plico_dm_characterization.type.commandHistory import CmdHistory
+        root = tempfile.mkdtemp()
+        try:
+            with mock.patch.object(CmdHistory, '_storageFolder',
+                                   return_value=root):
+                diagonal = np.array([1., 2., 0.5])
+                cmd, tt = CmdHistory(3).tidyCommandHistoryMaker(
+                    np.arange(3), np.ones(3), np.diag(diagonal), 2,
+                    np.array([1, -1]))
+                loaded = CmdHistory.load(tt)
+            self.assertEqual(loaded.getCommandMatrix().getType(), 'diagonal')
+            np.testing.assert_array_equal(
+                loaded.getCommandMatrix().getDiagonal(), diagonal)
+            np.testing.assert_array_equal(loaded.getCommandHistory(), cmd)
+        finally:
+            shutil.rmtree(root)